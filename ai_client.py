@@ -0,0 +1,484 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import (Any, Callable, Dict, List, Optional, Sequence, Set,
+                    Tuple)
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class AIUnavailable(RuntimeError):
+    """Ни одна модель из цепочки не ответила"""
+
+
+class CircuitBreaker:
+    """Размыкатель для одной модели.
+
+    После failure_threshold ошибок подряд модель исключается на
+    reset_timeout секунд; затем пропускаются пробные запросы: успех
+    замыкает цепь, ошибка снова размыкает.
+    """
+
+    def __init__(self, failure_threshold: int = 5,
+                 reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        return self.state != "open"
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half-open" or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+class LatencyTracker:
+    """Скользящее окно времени ответа модели"""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+
+    def add(self, seconds: float):
+        self._samples.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class _SharedStream:
+    """Один поток модели на все одинаковые запросы.
+
+    Фрагменты копятся в chunks; каждый читатель follow() получает их с
+    начала, поэтому присоединиться можно и посреди ответа. Уход читателя
+    поток не останавливает — как и общий вызов в generate().
+    """
+
+    def __init__(self, source):
+        self.chunks: List[str] = []
+        self._changed = asyncio.Event()
+        self.task = asyncio.ensure_future(self._pump(source))
+        self.task.add_done_callback(
+            lambda task: task.cancelled() or task.exception())
+
+    async def _pump(self, source):
+        try:
+            async for delta in source:
+                self.chunks.append(delta)
+                self._wake()
+        finally:
+            self._wake()
+
+    def _wake(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def follow(self):
+        i = 0
+        while True:
+            while i < len(self.chunks):
+                yield self.chunks[i]
+                i += 1
+            if self.task.done():
+                if not self.task.cancelled() and self.task.exception():
+                    raise self.task.exception()
+                return
+            await self._changed.wait()
+
+
+class AIClient:
+    """Асинхронный клиент OpenRouter с общим пулом соединений.
+
+    Один экземпляр на процесс: все запросы идут через общий
+    httpx.AsyncClient, а число одновременных обращений к модели
+    ограничено семафором. Пакеты openai и httpx импортируются в отдельном
+    потоке, а клиент создается при первом запросе (или в warm_up).
+
+    generate() — слой надежности поверх complete(): одинаковые запросы,
+    пришедшие одновременно, схлопываются в один вызов; если основная модель
+    отвечает дольше своего p95, параллельно отправляется страхующий запрос
+    к следующей модели цепочки; модели с разомкнутым CircuitBreaker
+    пропускаются.
+
+    stream_generate() — то же для потокового ответа: одинаковые потоки
+    схлопываются в один, а страхующий поток к следующей модели открывается,
+    если первый фрагмент не пришел за p95 времени до первого фрагмента.
+    """
+
+    def __init__(self,
+                 api_key: str,
+                 base_url: str = "https://openrouter.ai/api/v1",
+                 max_concurrency: int = 16,
+                 max_connections: int = 32,
+                 timeout: float = 60.0,
+                 connect_timeout: float = 10.0,
+                 models: Sequence[str] = (),
+                 hedge_after: float = 20.0,
+                 hedge_first_token_after: float = 10.0,
+                 breaker_threshold: int = 5,
+                 breaker_timeout: float = 30.0):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.max_concurrency = max_concurrency
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.models = tuple(models)
+        # Задержка страхующего запроса, пока у модели мало замеров для p95
+        self.hedge_after = hedge_after
+        self.hedge_first_token_after = hedge_first_token_after
+        self._breaker_threshold = breaker_threshold
+        self._breaker_timeout = breaker_timeout
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._latency: Dict[str, LatencyTracker] = {}
+        self._first_token: Dict[str, LatencyTracker] = {}
+        self._inflight: Dict[tuple, asyncio.Future] = {}
+        self._streams: Dict[tuple, _SharedStream] = {}
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._http = None
+        self._client = None
+        self._building: Optional[asyncio.Future] = None
+
+    def _new_client(self):
+        import httpx
+        from openai import AsyncOpenAI
+        http = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections),
+            timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout))
+        client = AsyncOpenAI(base_url=self.base_url,
+                             api_key=self.api_key,
+                             http_client=http,
+                             max_retries=0)
+        # Ресурс chat.completions импортируется при первом обращении
+        client.chat.completions
+        return http, client
+
+    async def _build_client(self):
+        # Импорт openai, контекст SSL и ресурсы клиента — почти секунда;
+        # все это в отдельном потоке, а не в цикле событий
+        self._http, self._client = await asyncio.to_thread(self._new_client)
+
+    async def client(self):
+        """Клиент AsyncOpenAI; первый вызов создает его, остальные ждут"""
+        if self._client is None:
+            if self._building is None:
+                self._building = asyncio.ensure_future(self._build_client())
+
+                def retry_on_error(done: asyncio.Future):
+                    if done.cancelled() or done.exception():
+                        self._building = None
+
+                self._building.add_done_callback(retry_on_error)
+            await asyncio.shield(self._building)
+        return self._client
+
+    async def warm_up(self):
+        """Создает клиент заранее, до первого запроса"""
+        await self.client()
+
+    async def complete(self,
+                       prompt: str,
+                       model: str,
+                       max_tokens: int,
+                       temperature: float = 0.7) -> str:
+        client = await self.client()
+        async with self._semaphore:
+            completion = await client.chat.completions.create(
+                model=model,
+                messages=[{
+                    "role": "user",
+                    "content": prompt
+                }],
+                temperature=temperature,
+                max_tokens=max_tokens,
+                timeout=self.timeout)
+        content = completion.choices[0].message.content
+        if not content:
+            raise ValueError("Пустой ответ модели")
+        return content
+
+    async def stream(self,
+                     prompt: str,
+                     model: str,
+                     max_tokens: int,
+                     temperature: float = 0.7):
+        """Асинхронный генератор фрагментов ответа по мере их генерации"""
+        client = await self.client()
+        async with self._semaphore:
+            stream = await client.chat.completions.create(
+                model=model,
+                messages=[{
+                    "role": "user",
+                    "content": prompt
+                }],
+                temperature=temperature,
+                max_tokens=max_tokens,
+                stream=True,
+                timeout=self.timeout)
+            async with stream:
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        yield delta
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        if model not in self._breakers:
+            self._breakers[model] = CircuitBreaker(self._breaker_threshold,
+                                                   self._breaker_timeout)
+        return self._breakers[model]
+
+    def latency(self, model: str) -> LatencyTracker:
+        if model not in self._latency:
+            self._latency[model] = LatencyTracker()
+        return self._latency[model]
+
+    def first_token(self, model: str) -> LatencyTracker:
+        if model not in self._first_token:
+            self._first_token[model] = LatencyTracker()
+        return self._first_token[model]
+
+    def _hedge_delay(self, model: str) -> float:
+        p95 = self.latency(model).quantile(0.95)
+        return p95 if p95 is not None else self.hedge_after
+
+    def _first_token_delay(self, model: str) -> float:
+        p95 = self.first_token(model).quantile(0.95)
+        return p95 if p95 is not None else self.hedge_first_token_after
+
+    async def _attempt(self, prompt: str, model: str, max_tokens: int) -> str:
+        started = time.monotonic()
+        try:
+            text = await self.complete(prompt, model=model,
+                                       max_tokens=max_tokens)
+        except asyncio.CancelledError:
+            metrics.AI_REQUESTS.inc(model=model, result="cancelled")
+            raise
+        except Exception as e:
+            self.breaker(model).record_failure()
+            metrics.AI_REQUESTS.inc(model=model, result="error")
+            logger.warning("Модель %s не ответила: %s", model, e)
+            raise
+        elapsed = time.monotonic() - started
+        self.breaker(model).record_success()
+        self.latency(model).add(elapsed)
+        metrics.AI_REQUESTS.inc(model=model, result="ok")
+        metrics.AI_SECONDS.observe(elapsed, model=model)
+        return text
+
+    def _next_available(self, models: Sequence[str],
+                        start: int) -> Optional[int]:
+        for i in range(start, len(models)):
+            if self.breaker(models[i]).allow():
+                return i
+        return None
+
+    async def _race(self, models: Sequence[str], start: Callable,
+                    delay: Callable[[str], float], label: str,
+                    discard: Callable) -> Tuple[Any, str]:
+        """Попытки по цепочке models, не больше двух одновременно.
+
+        start(model) — корутина попытки. Если единственная идущая попытка
+        не закончилась за delay(model), параллельно начинается страхующая к
+        следующей модели; упавшая попытка сразу заменяется следующей моделью,
+        даже если другая еще идет. Модели с разомкнутым размыкателем
+        пропускаются. Возвращает (результат, модель) первой успешной
+        попытки; остальные передаются в discard(task).
+        """
+        errors: List[Exception] = []
+        attempts: Dict[asyncio.Task, str] = {}
+        following = 0
+
+        def launch() -> Optional[asyncio.Task]:
+            nonlocal following
+            i = self._next_available(models, following)
+            if i is None:
+                return None
+            following = i + 1
+            task = asyncio.create_task(start(models[i]))
+            attempts[task] = models[i]
+            pending.add(task)
+            return task
+
+        pending: Set[asyncio.Task] = set()
+        winner = None
+        launch()
+        try:
+            while pending and winner is None:
+                timeout = None
+                if (len(pending) == 1
+                        and self._next_available(models, following)
+                        is not None):
+                    timeout = delay(attempts[next(iter(pending))])
+                done, pending = await asyncio.wait(
+                    pending,
+                    timeout=timeout,
+                    return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    slow = attempts[next(iter(pending))]
+                    hedge = launch()
+                    logger.info("Страхующий %s: %s -> %s", label, slow,
+                                attempts[hedge])
+                    metrics.AI_REQUESTS.inc(model=attempts[hedge],
+                                            result="hedge")
+                    continue
+                for task in done:
+                    if task.exception() is not None:
+                        errors.append(task.exception())
+                        launch()
+                    elif winner is None:
+                        winner = task
+        finally:
+            for task in attempts:
+                if task is not winner:
+                    await discard(task)
+        if winner is None:
+            raise AIUnavailable(
+                f"Модели недоступны: {'; '.join(map(str, errors)) or 'все разомкнуты'}")
+        return winner.result(), attempts[winner]
+
+    @staticmethod
+    async def _cancel(task: asyncio.Task):
+        task.cancel()
+
+    async def _generate(self, prompt: str, models: Sequence[str],
+                        max_tokens: int) -> str:
+        text, _ = await self._race(
+            models, lambda model: self._attempt(prompt, model, max_tokens),
+            self._hedge_delay, "запрос", self._cancel)
+        return text
+
+    async def generate(self,
+                       prompt: str,
+                       max_tokens: int,
+                       models: Optional[Sequence[str]] = None) -> str:
+        """Ответ первой успешной модели цепочки (по умолчанию self.models)"""
+        models = tuple(models or self.models)
+        key = (models, max_tokens, prompt)
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(
+                self._generate(prompt, models, max_tokens))
+            self._inflight[key] = future
+
+            def forget(done: asyncio.Future):
+                self._inflight.pop(key, None)
+                if not done.cancelled():
+                    done.exception()
+
+            future.add_done_callback(forget)
+        else:
+            logger.info("Одинаковый запрос уже выполняется, ждем его ответ")
+        # shield: отмена одного ожидающего не отменяет общий вызов
+        return await asyncio.shield(future)
+
+    async def _open_stream(self, prompt: str, model: str, max_tokens: int):
+        """Открывает поток модели и ждет первого фрагмента.
+
+        Возвращает (поток, первый фрагмент, время начала); ошибка до первого
+        фрагмента засчитывается размыкателю модели.
+        """
+        begun = time.monotonic()
+        chunks = self.stream(prompt, model=model, max_tokens=max_tokens)
+        try:
+            first = await chunks.__anext__()
+        except asyncio.CancelledError:
+            await chunks.aclose()
+            metrics.AI_REQUESTS.inc(model=model, result="cancelled")
+            raise
+        except Exception as e:
+            await chunks.aclose()
+            if isinstance(e, StopAsyncIteration):
+                e = RuntimeError("пустой ответ")
+            self.breaker(model).record_failure()
+            metrics.AI_REQUESTS.inc(model=model, result="error")
+            logger.warning("Модель %s не ответила: %s", model, e)
+            raise e
+        elapsed = time.monotonic() - begun
+        self.first_token(model).add(elapsed)
+        metrics.record_span("ai_first_token", elapsed)
+        return chunks, first, begun
+
+    @staticmethod
+    async def _discard(task: asyncio.Task):
+        """Отменяет проигравшую попытку; открытый ею поток закрывается"""
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled() and task.exception() is None:
+            await task.result()[0].aclose()
+
+    async def _stream_chain(self, prompt: str, models: Sequence[str],
+                            max_tokens: int):
+        (chunks, first, begun), model = await self._race(
+            models,
+            lambda model: self._open_stream(prompt, model, max_tokens),
+            self._first_token_delay, "поток", self._discard)
+        try:
+            yield first
+            async for delta in chunks:
+                yield delta
+        except Exception as e:
+            self.breaker(model).record_failure()
+            metrics.AI_REQUESTS.inc(model=model, result="error")
+            logger.warning("Модель %s оборвала ответ: %s", model, e)
+            raise
+        finally:
+            await chunks.aclose()
+        self.breaker(model).record_success()
+        metrics.AI_REQUESTS.inc(model=model, result="ok")
+        metrics.AI_SECONDS.observe(time.monotonic() - begun, model=model)
+
+    async def stream_generate(self,
+                              prompt: str,
+                              max_tokens: int,
+                              models: Optional[Sequence[str]] = None):
+        """Потоковый ответ с переходом по цепочке моделей.
+
+        Одинаковые запросы, пришедшие во время генерации, читают тот же
+        поток. Если первый фрагмент задерживается, параллельно открывается
+        поток следующей модели и побеждает тот, что ответил раньше. Модель
+        меняется только до первого фрагмента; ошибка посреди ответа
+        пробрасывается вызывающему.
+        """
+        models = tuple(models or self.models)
+        key = (models, max_tokens, prompt)
+        shared = self._streams.get(key)
+        if shared is None:
+            shared = _SharedStream(
+                self._stream_chain(prompt, models, max_tokens))
+            self._streams[key] = shared
+            shared.task.add_done_callback(
+                lambda _: self._streams.pop(key, None))
+        else:
+            logger.info("Одинаковый поток уже идет, читаем его")
+        async for delta in shared.follow():
+            yield delta
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            await self._http.aclose()
@@ -1,53 +1,302 @@
+import argparse
+import csv
+import json
+import math
+import os
+import sys
+import threading
+import time
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import numpy as np
 import swisseph as swe
 import pytz
 from datetime import datetime
-from geopy.geocoders import Nominatim
-from timezonefinder import TimezoneFinder
-from typing import Dict, Any
+from typing import Dict, Any, Iterable, Iterator, List, Optional, Tuple, Union
 import logging
 
+import metrics
+from chart import BODIES, SIGNS, Chart
+from ephemeris_table import EphemerisTable, ephemeris_source, load_if_exists
+from gazetteer import Gazetteer
+from geo_cache import GeoCache, PlaceNotFound
+from synastry import aspects_between, synastry_score
+
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO,
-                    format="%(asctime)s - %(levelname)s - %(message)s")
+
+# Идентификаторы Swiss Ephemeris в порядке chart.BODIES;
+# южный узел (None) вычисляется как противоположная точка северного
+BODY_IDS = (swe.SUN, swe.MOON, swe.MERCURY, swe.VENUS, swe.MARS,
+            swe.JUPITER, swe.SATURN, swe.URANUS, swe.NEPTUNE, swe.PLUTO,
+            swe.TRUE_NODE, None, swe.CHIRON)
+assert len(BODY_IDS) == len(BODIES)
+# Тела, о недоступности которых уже предупредили в логе
+_unavailable_bodies = set()
+_moshier_warned = False
+
+# TimezoneFinder общий на процесс: таблица ячеек занимает десятки мегабайт
+# и грузится полсекунды. Созданный до fork экземпляр дочерние процессы
+# получают готовым (страницы общие, пока в них не пишут), а файлы полигонов
+# открывают заново — у унаследованных дескрипторов общая позиция чтения.
+_tz_finder = None
+# Файлы читаются через seek + read, поэтому обращения по одному
+_tz_lock = threading.Lock()
+
+
+def timezone_finder():
+    global _tz_finder
+    with _tz_lock:
+        if _tz_finder is None:
+            from timezonefinder import TimezoneFinder
+            _tz_finder = TimezoneFinder()
+        return _tz_finder
+
+
+def timezone_at(lat: float, lon: float) -> Optional[str]:
+    finder = timezone_finder()
+    with _tz_lock:
+        return finder.timezone_at(lat=lat, lng=lon)
+
+
+def _reopen_timezone_files():
+    global _tz_lock
+    _tz_lock = threading.Lock()
+    if _tz_finder is None:
+        return
+    for name in _tz_finder.binary_data_attributes:
+        inherited = getattr(_tz_finder, name)
+        setattr(_tz_finder, name, open(inherited.name, "rb"))
+        inherited.close()
+
+
+os.register_at_fork(after_in_child=_reopen_timezone_files)
+
+_EPOCH = datetime(1970, 1, 1)
+_UNIX_EPOCH_JD = 2440587.5
+# Переходы часовых поясов pytz как массивы: имя -> (моменты UTC, смещения)
+_tz_transitions: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+
+
+def _transitions(tz_name: str) -> Tuple[np.ndarray, np.ndarray]:
+    cached = _tz_transitions.get(tz_name)
+    if cached is None:
+        tz = pytz.timezone(tz_name)
+        if hasattr(tz, "_utc_transition_times"):
+            times = np.array([
+                int((t - _EPOCH).total_seconds())
+                for t in tz._utc_transition_times
+            ],
+                             dtype=np.int64)
+            offsets = np.array([
+                int(info[0].total_seconds()) for info in tz._transition_info
+            ],
+                               dtype=np.int64)
+        else:
+            times = np.array([np.iinfo(np.int64).min], dtype=np.int64)
+            offsets = np.array(
+                [int(tz.utcoffset(_EPOCH).total_seconds())], dtype=np.int64)
+        cached = _tz_transitions[tz_name] = (times, offsets)
+    return cached
+
+
+def _local_seconds(dates: List[str],
+                   times: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """ДД.ММ.ГГГГ и ЧЧ:ММ -> секунды местного времени от 1970 и маска
+    корректных строк"""
+    valid = np.ones(len(dates), dtype=bool)
+    iso = []
+    for i, (date_str, time_str) in enumerate(zip(dates, times)):
+        try:
+            day, month, year = date_str.strip().split(".")
+            hour, minute = time_str.strip().split(":")
+            iso.append(f"{int(year):04d}-{int(month):02d}-{int(day):02d}"
+                       f"T{int(hour):02d}:{int(minute):02d}")
+        except ValueError:
+            iso.append("NaT")
+            valid[i] = False
+    try:
+        local = np.array(iso, dtype="datetime64[s]")
+    except ValueError:
+        # В пачке есть несуществующая дата (31.02) — разбираем поштучно
+        local = np.array([_parse_iso(value) for value in iso],
+                         dtype="datetime64[s]")
+    valid &= ~np.isnat(local)
+    return local.astype(np.int64), valid
+
+
+def _parse_iso(value: str) -> np.datetime64:
+    try:
+        return np.datetime64(value, "s")
+    except ValueError:
+        return np.datetime64("NaT", "s")
+
+
+def julian_days(dates: List[str], times: List[str],
+                tz_name: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Юлианские даты (UT) для строк местных дат и времени одного пояса.
+
+    Перевод в UTC векторный: по таблице переходов pytz через searchsorted.
+    Вне часов перевода стрелок совпадает с pytz.localize(is_dst=False).
+    """
+    local, valid = _local_seconds(dates, times)
+    transitions, offsets = _transitions(tz_name)
+    idx = np.searchsorted(transitions, local, side="right") - 1
+    utc = local - offsets[np.maximum(idx, 0)]
+    idx = np.searchsorted(transitions, utc, side="right") - 1
+    utc = local - offsets[np.maximum(idx, 0)]
+    return utc / 86400.0 + _UNIX_EPOCH_JD, valid
+
+
+# Калькулятор процесса пакетного расчета
+_batch_calculator = None
+
+
+def _init_batch_worker(ephemeris_path: Optional[str]):
+    global _batch_calculator
+    _batch_calculator = AstroCalculator.from_paths(
+        geocache_path=None,
+        ephemeris_path=ephemeris_path,
+        ephemeris_max_error=math.inf)
+
+
+def _compute_batch(jds: List[float], lats: List[float],
+                   lons: List[float]) -> List[bytes]:
+    return [
+        _batch_calculator.compute_chart(jd, lat, lon).to_bytes()
+        for jd, lat, lon in zip(jds, lats, lons)
+    ]
 
 
 class AstroCalculator:
 
-    def __init__(self):
-        self.geolocator = Nominatim(user_agent="ascend_bot_geocoder")
-        self.tz_finder = TimezoneFinder()
-        self.signs = [
-            "Овен", "Телец", "Близнецы", "Рак", "Лев", "Дева", "Весы",
-            "Скорпион", "Стрелец", "Козерог", "Водолей", "Рыбы"
-        ]
-        swe.set_ephe_path(
-            '.')  # путь к эфемеридам (по умолчанию — текущая папка)
+    def __init__(self,
+                 geo_cache: Optional[GeoCache] = None,
+                 gazetteer: Optional[Gazetteer] = None,
+                 ephemeris_table: Optional[EphemerisTable] = None,
+                 ephe_path: str = '.',
+                 nominatim_url: Optional[str] = None):
+        self.geo_cache = geo_cache if geo_cache is not None else GeoCache()
+        self.gazetteer = gazetteer
+        self.ephemeris_table = ephemeris_table
+        self.nominatim_url = nominatim_url
+        self._geolocator = None
+        self.signs = SIGNS
+        # Путь к эфемеридам (по умолчанию — текущая папка). Настройки Swiss
+        # Ephemeris у каждого потока свои: другие потоки задают его заново
+        self.ephe_path = ephe_path
+        swe.set_ephe_path(ephe_path)
+        # Без файлов *.se1 Swiss Ephemeris молча переходит на Moshier
+        global _moshier_warned
+        if not _moshier_warned and ephemeris_source() == "moshier":
+            _moshier_warned = True
+            logger.warning(
+                "Файлы Swiss Ephemeris не найдены в '%s', "
+                "используются менее точные эфемериды Moshier", ephe_path)
+
+    @classmethod
+    def from_paths(cls,
+                   geocache_path: Optional[str] = "geocache.sqlite3",
+                   gazetteer_path: Optional[str] = None,
+                   ephemeris_path: Optional[str] = None,
+                   ephemeris_max_error: float = 1.0,
+                   nominatim_url: Optional[str] = None) -> "AstroCalculator":
+        """Сборка калькулятора по путям к кэшу, справочнику городов и
+        таблице эфемерид. Удобно как фабрика для пула процессов: аргументы
+        сериализуемы, а mmap-файлы каждый процесс открывает сам."""
+        gazetteer = None
+        if gazetteer_path and os.path.isdir(gazetteer_path):
+            gazetteer = Gazetteer(gazetteer_path)
+        return cls(geo_cache=GeoCache(geocache_path or None),
+                   gazetteer=gazetteer,
+                   ephemeris_table=load_if_exists(ephemeris_path,
+                                                  ephemeris_max_error),
+                   nominatim_url=nominatim_url)
+
+    @property
+    def geolocator(self):
+        """Клиент Nominatim; geopy импортируется при первом геокодинге"""
+        if self._geolocator is None:
+            from geopy.geocoders import Nominatim
+            if self.nominatim_url:
+                # Свой сервер Nominatim, например http://127.0.0.1:8000
+                scheme, _, domain = self.nominatim_url.rstrip("/").partition(
+                    "://")
+                self._geolocator = Nominatim(
+                    user_agent="ascend_bot_geocoder",
+                    domain=domain,
+                    scheme=scheme)
+            else:
+                self._geolocator = Nominatim(user_agent="ascend_bot_geocoder")
+        return self._geolocator
+
+    @property
+    def tz_finder(self):
+        return timezone_finder()
+
+    def warm_up(self):
+        """Загружает все, что иначе грузилось бы при первом запросе:
+        TimezoneFinder, клиент Nominatim, файлы эфемерид и справочник"""
+        timezone_at(55.7558, 37.6173)
+        self.geolocator
+        # Без записи в метрики этапов: прогрев — не запрос пользователя
+        for planet_id in BODY_IDS:
+            if planet_id is not None:
+                try:
+                    self._position(2451545.0, planet_id)
+                except swe.Error:
+                    pass
+        swe.houses(2451545.0, 55.7558, 37.6173, b'P')
+        if self.gazetteer is not None:
+            self.gazetteer.lookup("Москва")
 
     def get_coordinates_and_timezone(self, place: str) -> tuple:
+        # Локальный справочник отвечает без сети; Nominatim — запасной путь
+        if self.gazetteer is not None:
+            with metrics.span("gazetteer"):
+                found = self.gazetteer.lookup(place)
+            metrics.cache_result("gazetteer", found is not None)
+            if found is not None:
+                return found
+        return self.geo_cache.get_or_compute(place, self._geocode)
+
+    def _geocode(self, place: str) -> tuple:
         try:
-            location = self.geolocator.geocode(place)
+            with metrics.span("nominatim"):
+                location = self.geolocator.geocode(place)
             if not location:
-                raise ValueError("Место не найдено")
+                raise PlaceNotFound("Место не найдено")
 
             lat, lon = location.latitude, location.longitude
-            timezone_str = self.tz_finder.timezone_at(lat=lat, lng=lon)
+            with metrics.span("timezone"):
+                timezone_str = timezone_at(lat, lon)
 
             if not timezone_str:
-                raise ValueError("Часовой пояс не найден")
+                raise PlaceNotFound("Часовой пояс не найден")
 
-            logger.info(
-                f"Место: {place}, Координаты: {lat}, {lon}, Таймзона: {timezone_str}"
-            )
+            logger.info("Место: %s, Координаты: %s, %s, Таймзона: %s", place,
+                        lat, lon, timezone_str)
             return lat, lon, timezone_str
         except Exception as e:
-            logger.error(f"Ошибка геокодинга/таймзоны: {e}")
+            logger.error("Ошибка геокодинга/таймзоны: %s", e)
             raise
 
     def get_julian_day(self, dt: datetime) -> float:
         return swe.julday(dt.year, dt.month, dt.day, dt.hour + dt.minute / 60)
 
+    def _position(self, jd: float, planet_id: int) -> tuple:
+        """(долгота, скорость): из таблицы эфемерид, если она покрывает
+        момент, иначе живым расчетом Swiss Ephemeris"""
+        table = self.ephemeris_table
+        if table is not None and table.covers(jd, planet_id):
+            return table.position(jd, planet_id)
+        xx, _ = swe.calc_ut(jd, planet_id, swe.FLG_SWIEPH | swe.FLG_SPEED)
+        return xx[0], xx[3]
+
     def get_planet_info(self, jd: float, planet_id: int) -> Dict[str, Any]:
-        lon = swe.calc_ut(jd, planet_id)[0][0]
+        lon = self._position(jd, planet_id)[0]
         sign = self.signs[int(lon // 30)]
         degree = lon % 30
         return {"sign": sign, "degree": degree}
@@ -61,58 +310,177 @@ class AstroCalculator:
             degree = asc % 30
             return {"sign": sign, "degree": degree}
         except Exception as e:
-            logger.error(f"Ошибка расчета асцендента: {e}")
+            logger.error("Ошибка расчета асцендента: %s", e)
             raise
 
-    def calculate(self, date_str: str, time_str: str,
-                  place: str) -> Dict[str, Any]:
+    def compute_chart(self,
+                      jd: float,
+                      lat: float,
+                      lon: float,
+                      metadata: Optional[Dict[str, Any]] = None) -> Chart:
+        """Полная карта за один проход по одной юлианской дате:
+        все тела со скоростями, куспиды домов (Placidus), ASC и MC"""
+        longitudes = array("d", bytes(8 * len(BODIES)))
+        speeds = array("d", bytes(8 * len(BODIES)))
+        planets_started = time.perf_counter()
+        for i, planet_id in enumerate(BODY_IDS):
+            if planet_id is None:
+                # Южный узел: напротив предыдущего (северного)
+                longitudes[i] = (longitudes[i - 1] + 180) % 360
+                speeds[i] = speeds[i - 1]
+                continue
+            try:
+                longitudes[i], speeds[i] = self._position(jd, planet_id)
+            except swe.Error as e:
+                # Хирону нужны файлы эфемерид астероидов (seas_*.se1)
+                if BODIES[i] not in _unavailable_bodies:
+                    _unavailable_bodies.add(BODIES[i])
+                    logger.warning("Тело %s недоступно: %s", BODIES[i], e)
+                longitudes[i] = speeds[i] = math.nan
+        metrics.record_span("planets", time.perf_counter() - planets_started)
+
+        try:
+            with metrics.span("houses"):
+                cusps, ascmc = swe.houses(jd, lat, lon, b'P')  # P — Placidus
+        except Exception as e:
+            logger.error("Ошибка расчета домов: %s", e)
+            raise
+        return Chart(jd, lat, lon, longitudes, speeds, array("d", cusps),
+                     ascmc[0], ascmc[1], metadata)
+
+    def calculate(self, date_str: str, time_str: str, place: str) -> Chart:
+        """Карта по дате, времени и месту рождения.
+
+        Результат — Chart; по ключам "planets" и "metadata" он отдает
+        прежнее словарное представление.
+        """
         try:
             # Преобразуем дату и время
             dt_naive = datetime.strptime(f"{date_str} {time_str}",
                                          "%d.%m.%Y %H:%M")
-            lat, lon, tz_str = self.get_coordinates_and_timezone(place)
+            with metrics.span("geocode"):
+                lat, lon, tz_str = self.get_coordinates_and_timezone(place)
 
             tz = pytz.timezone(tz_str)
             dt_local = tz.localize(dt_naive)
             dt_utc = dt_local.astimezone(pytz.utc)
 
-            logger.info(f"Местное время: {dt_local}, UTC: {dt_utc}")
+            logger.debug("Местное время: %s, UTC: %s", dt_local, dt_utc)
 
             # Юлианская дата в UTC
             jd = self.get_julian_day(dt_utc)
 
-            sun = self.get_planet_info(jd, swe.SUN)
-            moon = self.get_planet_info(jd, swe.MOON)
-            ascendant = self.get_ascendant(jd, lat, lon)
-
-            return {
-                "planets": {
-                    "sun": sun,
-                    "moon": moon,
-                    "ascendant": ascendant
-                },
-                "metadata": {
+            return self.compute_chart(
+                jd, lat, lon, {
                     "place": place,
                     "date_local": dt_local.isoformat(),
                     "timezone": tz_str,
                     "coordinates": f"{lat:.4f}, {lon:.4f}"
-                }
-            }
+                })
         except Exception as e:
             logger.exception("Ошибка общего расчета")
             raise ValueError(f"Ошибка общего расчета: {str(e)}")
 
-    def calculate_compatibility(self, person1: dict, person2: dict) -> dict:
-        """
-        person1 и person2 — словари с ключами: date_str, time_str, place.
-        Возвращает позиции планет (солнце, луна, асцендент) для каждого,
-        а также простую оценку совпадений по знакам.
+    def _prepare_batch(self, chunk: List[Tuple[str, str, str]],
+                       places: Dict[str, Any]) -> tuple:
+        results: List[Any] = [None] * len(chunk)
+        coords: List[Any] = [None] * len(chunk)
+        by_tz: Dict[str, List[int]] = {}
+        for i, (_, _, place) in enumerate(chunk):
+            resolved = places.get(place)
+            if resolved is None:
+                try:
+                    resolved = self.get_coordinates_and_timezone(place)
+                except Exception as e:
+                    resolved = ValueError(f"Ошибка геокодинга: {e}")
+                places[place] = resolved
+            if isinstance(resolved, Exception):
+                results[i] = resolved
+                continue
+            coords[i] = resolved
+            by_tz.setdefault(resolved[2], []).append(i)
+
+        jds = np.full(len(chunk), np.nan)
+        for tz_name, rows in by_tz.items():
+            values, valid = julian_days([chunk[i][0] for i in rows],
+                                        [chunk[i][1] for i in rows], tz_name)
+            for i, ok, jd in zip(rows, valid, values):
+                if ok:
+                    jds[i] = jd
+                else:
+                    results[i] = ValueError(
+                        "Неверный формат даты или времени")
+        todo = [i for i in range(len(chunk)) if results[i] is None]
+        return results, coords, todo, jds
+
+    def calculate_many(
+            self,
+            records: Iterable[Tuple[str, str, str]],
+            workers: int = 1,
+            chunk_size: int = 2000) -> Iterator[Union[Chart, ValueError]]:
+        """Пакетный расчет карт для (date_str, time_str, place).
+
+        Результаты отдаются по одному в порядке входа: Chart или ValueError
+        для строки с ошибкой (пакет не прерывается). Каждое место
+        геокодируется один раз, юлианские даты считаются векторно по
+        часовым поясам, эфемериды — в workers процессах. Вход читается
+        порциями, поэтому память не растет с размером файла.
         """
-        data1 = self.calculate(person1['date_str'], person1['time_str'],
-                               person1['place'])
-        data2 = self.calculate(person2['date_str'], person2['time_str'],
-                               person2['place'])
+        records = iter(records)
+        places: Dict[str, Any] = {}
+        pool = None
+        if workers > 1:
+            # Воркеры открывают ту же таблицу эфемерид (проверенную здесь)
+            table = self.ephemeris_table
+            pool = ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_init_batch_worker,
+                initargs=(table.path if table is not None else None, ))
+        pending = deque()
+        try:
+            while True:
+                chunk = list(islice(records, chunk_size))
+                if not chunk:
+                    break
+                results, coords, todo, jds = self._prepare_batch(
+                    chunk, places)
+                args = ([float(jds[i]) for i in todo],
+                        [coords[i][0] for i in todo],
+                        [coords[i][1] for i in todo])
+                if pool is not None:
+                    charts = pool.submit(_compute_batch, *args)
+                else:
+                    charts = [
+                        self.compute_chart(*job) for job in zip(*args)
+                    ]
+                pending.append((chunk, results, coords, todo, charts))
+                # Не больше двух порций на процесс в работе
+                while len(pending) > 2 * workers:
+                    yield from self._finish_batch(*pending.popleft())
+            while pending:
+                yield from self._finish_batch(*pending.popleft())
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
 
+    @staticmethod
+    def _finish_batch(chunk, results, coords, todo, charts):
+        if not isinstance(charts, list):
+            charts = [Chart.from_bytes(data) for data in charts.result()]
+        for i, chart in zip(todo, charts):
+            lat, lon, tz_str = coords[i]
+            chart.metadata = {
+                "place": chunk[i][2],
+                "timezone": tz_str,
+                "coordinates": f"{lat:.4f}, {lon:.4f}"
+            }
+            results[i] = chart
+        return results
+
+    @staticmethod
+    def compare(data1: dict, data2: dict) -> dict:
+        """Совпадения по знакам для двух готовых карт; для Chart также
+        полный список аспектов синастрии и общая оценка"""
         matches = {
             'sun':
             data1['planets']['sun']['sign'] == data2['planets']['sun']['sign'],
@@ -124,8 +492,162 @@ class AstroCalculator:
             ['ascendant']['sign'],
         }
 
-        return {
+        result = {
             "person1": data1['planets'],
             "person2": data2['planets'],
             "matches": matches
         }
+        if isinstance(data1, Chart) and isinstance(data2, Chart):
+            result["aspects"] = aspects_between(data1, data2)
+            result["score"] = synastry_score(data1, data2)
+        return result
+
+    def calculate_compatibility(self, person1: dict, person2: dict) -> dict:
+        """
+        person1 и person2 — словари с ключами: date_str, time_str, place.
+        Возвращает позиции планет (солнце, луна, асцендент) для каждого,
+        а также простую оценку совпадений по знакам.
+        """
+        data1 = self.calculate(person1['date_str'], person1['time_str'],
+                               person1['place'])
+        data2 = self.calculate(person2['date_str'], person2['time_str'],
+                               person2['place'])
+        return self.compare(data1, data2)
+
+
+def _chart_row(chart: Chart) -> Dict[str, Any]:
+    row = {
+        "lat": chart.lat,
+        "lon": chart.lon,
+        "timezone": chart.metadata.get("timezone"),
+        "jd": chart.jd,
+    }
+    points = [(name, chart.longitude(name)) for name in BODIES]
+    points += [("ascendant", chart.ascendant), ("mc", chart.mc)]
+    for name, longitude in points:
+        missing = math.isnan(longitude)
+        row[f"{name}_lon"] = None if missing else round(longitude, 6)
+        row[f"{name}_sign"] = None if missing else SIGNS[int(longitude //
+                                                             30) % 12]
+    return row
+
+
+_RESULT_COLUMNS = ["lat", "lon", "timezone", "jd"] + [
+    f"{name}_{suffix}" for name in BODIES + ("ascendant", "mc")
+    for suffix in ("lon", "sign")
+] + ["error"]
+
+
+class _JsonlWriter:
+
+    def __init__(self, path: str, columns: List[str]):
+        self._file = open(path, "w", encoding="utf-8")
+
+    def write(self, row: Dict[str, Any]):
+        self._file.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+    def close(self):
+        self._file.close()
+
+
+class _ParquetWriter:
+    """Пишет строки группами, чтобы не держать весь результат в памяти"""
+
+    def __init__(self, path: str, columns: List[str], batch_rows=50000):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SystemExit("Для вывода в parquet установите pyarrow")
+        self._pa = pa
+        fields = []
+        for column in columns:
+            if column in ("lat", "lon", "jd") or column.endswith("_lon"):
+                fields.append(pa.field(column, pa.float64()))
+            else:
+                fields.append(pa.field(column, pa.string()))
+        self._schema = pa.schema(fields)
+        self._writer = pq.ParquetWriter(path, self._schema)
+        self._batch_rows = batch_rows
+        self._rows = []
+
+    def _flush(self):
+        if self._rows:
+            self._writer.write_table(
+                self._pa.Table.from_pylist(self._rows, schema=self._schema))
+            self._rows = []
+
+    def write(self, row: Dict[str, Any]):
+        self._rows.append(row)
+        if len(self._rows) >= self._batch_rows:
+            self._flush()
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+
+
+def _batch_cli(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog="python -m astro_engine")
+    commands = parser.add_subparsers(dest="command", required=True)
+    batch = commands.add_parser(
+        "batch",
+        help="пакетный расчет карт из CSV (колонки date, time, place)")
+    batch.add_argument("input", help="входной CSV")
+    batch.add_argument("output", help="результат: *.jsonl или *.parquet")
+    batch.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    batch.add_argument("--chunk-size", type=int, default=2000)
+    batch.add_argument("--geocache", default="geocache.sqlite3")
+    batch.add_argument("--gazetteer", default="gazetteer")
+    batch.add_argument("--ephemeris", default="ephemeris.npy")
+    args = parser.parse_args(argv)
+
+    calculator = AstroCalculator.from_paths(geocache_path=args.geocache,
+                                            gazetteer_path=args.gazetteer,
+                                            ephemeris_path=args.ephemeris)
+    with open(args.input, newline="", encoding="utf-8-sig") as f:
+        reader = csv.DictReader(f)
+        passthrough = [
+            name for name in reader.fieldnames or []
+            if name not in ("date", "time", "place")
+        ]
+        columns = passthrough + _RESULT_COLUMNS
+        writer_cls = (_ParquetWriter if args.output.endswith(".parquet") else
+                      _JsonlWriter)
+        writer = writer_cls(args.output, columns)
+        # Исходные строки ждут своих результатов (порядок сохраняется)
+        rows = deque()
+
+        def records():
+            for row in reader:
+                rows.append(row)
+                yield row.get("date", ""), row.get("time", ""), row.get(
+                    "place", "")
+
+        done = failed = 0
+        try:
+            for result in calculator.calculate_many(records(),
+                                                    workers=args.workers,
+                                                    chunk_size=args.chunk_size):
+                source = rows.popleft()
+                out = {name: source.get(name) for name in passthrough}
+                if isinstance(result, Exception):
+                    out.update(dict.fromkeys(_RESULT_COLUMNS))
+                    out["error"] = str(result)
+                    failed += 1
+                else:
+                    out.update(_chart_row(result))
+                    out["error"] = None
+                writer.write(out)
+                done += 1
+        finally:
+            writer.close()
+    logger.info("Пакетный расчет: %s строк, ошибок: %s", done, failed)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s - %(levelname)s - %(message)s")
+    # Через имя модуля, чтобы воркеры пула находили функции пакетного расчета
+    import astro_engine
+    astro_engine._batch_cli(sys.argv[1:])
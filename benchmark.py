@@ -0,0 +1,588 @@
+"""Нагрузочный тест и микробенчмарки.
+
+load — поднимает локальные замены внешних сервисов: Bot API
+(fake_telegram.FakeTelegram), Nominatim и OpenAI-совместимый API OpenRouter,
+у каждой настраиваются задержка и ошибки. Затем направляет на них bot.py и
+проводит users пользователей через полные диалоги натальной карты и
+совместимости (обновления идут прямо в Dispatcher, как в режиме вебхука).
+Замены работают в своем потоке со своим циклом событий: задержки цикла
+бота не превращаются в таймауты заглушек и не приписываются сервисам.
+Отчет: пропускная способность, исходы диалогов и p50/p95/p99 времени
+ответа и каждого этапа из metrics.span (геокодинг, эфемериды, ИИ, Telegram).
+
+micro — время одного вызова AstroCalculator.calculate, compute_chart и
+get_planet_info без сети (координаты заранее лежат в кэше).
+
+    python benchmark.py load --users 200 --concurrency 50 --ai-latency 2
+    python benchmark.py load --users 100 --nominatim-error-rate 0.05 --json
+    python benchmark.py micro --iterations 2000 --ephemeris ephemeris.npy
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import socket
+import statistics
+import sys
+import threading
+import time
+import timeit
+import zlib
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional, Sequence
+
+from aiohttp import web
+
+from fake_telegram import FakeTelegram, make_update
+
+logger = logging.getLogger(__name__)
+
+# Координаты, которые поддельный Nominatim отдает на любые запросы
+CITIES = [
+    ("Москва, Россия", 55.7558, 37.6173),
+    ("Санкт-Петербург, Россия", 59.9343, 30.3351),
+    ("Новосибирск, Россия", 55.0084, 82.9357),
+    ("Владивосток, Россия", 43.1155, 131.8855),
+    ("Киев, Украина", 50.4501, 30.5234),
+    ("Минск, Беларусь", 53.9045, 27.5615),
+    ("Алматы, Казахстан", 43.2220, 76.8512),
+    ("Берлин, Германия", 52.5200, 13.4050),
+    ("Нью-Йорк, США", 40.7128, -74.0060),
+    ("Токио, Япония", 35.6762, 139.6503),
+    ("Сидней, Австралия", -33.8688, 151.2093),
+    ("Буэнос-Айрес, Аргентина", -34.6037, -58.3816),
+]
+
+WORDS = ("Солнце в этом знаке придает характеру упорство и глубину, Луна "
+         "подсказывает, как человек переживает перемены, а Асцендент "
+         "показывает первое впечатление, которое он производит").split()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    """Квантиль q (0..1) по ближайшему рангу"""
+    if not values:
+        return math.nan
+    ordered = sorted(values)
+    return ordered[max(math.ceil(q * len(ordered)) - 1, 0)]
+
+
+class _FakeService:
+    """Общая часть поддельных HTTP-сервисов: задержка и доля ошибок"""
+
+    def __init__(self,
+                 host: str = "127.0.0.1",
+                 port: int = 0,
+                 latency: float = 0.0,
+                 error_rate: float = 0.0,
+                 seed: int = 0):
+        self.host = host
+        self.port = port or free_port()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def routes(self, app: web.Application):
+        raise NotImplementedError
+
+    async def _delay_or_fail(self) -> bool:
+        """Ждет latency (±50 %); True — ответить ошибкой"""
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency * self._random.uniform(0.5, 1.5))
+        if self._random.random() < self.error_rate:
+            self.errors += 1
+            return True
+        return False
+
+    async def start(self):
+        app = web.Application()
+        self.routes(app)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info("%s: %s", type(self).__name__, self.base_url)
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+class FakeNominatim(_FakeService):
+    """/search в формате Nominatim: место детерминированно отображается
+    на один из CITIES"""
+
+    def routes(self, app: web.Application):
+        app.router.add_get("/search", self._search)
+
+    async def _search(self, request: web.Request) -> web.Response:
+        if await self._delay_or_fail():
+            return web.Response(status=503, text="Service Unavailable")
+        query = request.query.get("q", "")
+        name, lat, lon = CITIES[zlib.crc32(query.encode()) % len(CITIES)]
+        return web.json_response([{
+            "place_id": zlib.crc32(query.encode()),
+            "lat": str(lat),
+            "lon": str(lon),
+            "display_name": name,
+            "class": "place",
+            "type": "city",
+            "importance": 0.9,
+        }])
+
+
+class FakeOpenRouter(_FakeService):
+    """/chat/completions OpenAI-совместимого API, обычный и потоковый (SSE).
+
+    latency — время до первого токена, tokens — длина ответа в словах,
+    token_interval — пауза между порциями потока.
+    """
+
+    def __init__(self,
+                 tokens: int = 300,
+                 token_interval: float = 0.02,
+                 chunk_words: int = 5,
+                 **kwargs):
+        super().__init__(**kwargs)
+        self.tokens = tokens
+        self.token_interval = token_interval
+        self.chunk_words = chunk_words
+        self._ids = itertools.count(1)
+
+    def routes(self, app: web.Application):
+        app.router.add_post("/chat/completions", self._completions)
+
+    def _text(self) -> List[str]:
+        words = [WORDS[i % len(WORDS)] for i in range(self.tokens)]
+        return [
+            " ".join(words[i:i + self.chunk_words]) + " "
+            for i in range(0, len(words), self.chunk_words)
+        ]
+
+    async def _completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        if await self._delay_or_fail():
+            return web.json_response(
+                {"error": {
+                    "message": "Upstream error",
+                    "code": 502
+                }},
+                status=502)
+        completion_id = f"chatcmpl-{next(self._ids)}"
+        model = body.get("model", "fake")
+        created = int(time.time())
+        chunks = self._text()
+        if not body.get("stream"):
+            await asyncio.sleep(self.token_interval * len(chunks))
+            return web.json_response({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {
+                        "role": "assistant",
+                        "content": "".join(chunks).strip()
+                    },
+                    "finish_reason": "stop",
+                }],
+                "usage": {
+                    "prompt_tokens": 100,
+                    "completion_tokens": self.tokens,
+                    "total_tokens": 100 + self.tokens,
+                },
+            })
+
+        response = web.StreamResponse(
+            headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        def event(delta: Dict[str, Any], finish: Optional[str]) -> bytes:
+            data = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "delta": delta,
+                    "finish_reason": finish
+                }],
+            }
+            return f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode()
+
+        for i, chunk in enumerate(chunks):
+            if i:
+                await asyncio.sleep(self.token_interval)
+            await response.write(event({"content": chunk}, None))
+        await response.write(event({}, "stop"))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+
+class StandIns(threading.Thread):
+    """Поток с отдельным циклом событий, в котором работают замены
+    внешних сервисов"""
+
+    def __init__(self, *services):
+        super().__init__(name="stand-ins", daemon=True)
+        self.services = services
+        self.loop = asyncio.new_event_loop()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+        self.loop.close()
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def start(self):
+        super().start()
+        for service in self.services:
+            self._call(service.start())
+
+    def stop(self):
+        for service in self.services:
+            self._call(service.stop())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.join()
+
+
+def random_birth(rng: random.Random) -> List[str]:
+    """Дата и время рождения в форматах диалога бота"""
+    return [
+        f"{rng.randint(1, 28):02d}.{rng.randint(1, 12):02d}."
+        f"{rng.randint(1950, 2010)}",
+        f"{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}",
+    ]
+
+
+class LoadTest:
+    """Симуляция пользователей над импортированным bot.py"""
+
+    def __init__(self, app, telegram: FakeTelegram, args):
+        self.app = app
+        self.telegram = telegram
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.places = [f"Город {i}" for i in range(args.places)]
+        self.update_ids = itertools.count(1)
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Counter = Counter()
+        self.outcomes: Counter = Counter()
+
+    def on_span(self, stage: str, duration: float, error: bool):
+        self.samples[stage].append(duration)
+        if error:
+            self.errors[stage] += 1
+
+    async def _say(self, chat_id: int, text: str) -> float:
+        started = time.perf_counter()
+        await self.app.dp.feed_raw_update(
+            self.app.bot, make_update(next(self.update_ids), chat_id, text))
+        return time.perf_counter() - started
+
+    def _person(self) -> List[str]:
+        return random_birth(self.rng) + [self.rng.choice(self.places)]
+
+    def _outcome(self, replies: List[str], marker: str) -> str:
+        text = "\n".join(replies)
+        if self.app.AI_FAILED_TEXT in text:
+            return "ai_failed"
+        if marker in text:
+            return "ok"
+        if self.app.BUSY_TEXT in text or "Слишком много запросов" in text:
+            return "busy"
+        return "error"
+
+    async def user(self, chat_id: int):
+        """Один пользователь: /start и один полный диалог"""
+        compatibility = self.rng.random() < self.args.compatibility_share
+        if compatibility:
+            kind, marker = "compatibility", "Совместимость пары"
+            steps = ["/compatibility"] + self._person() + self._person()
+        else:
+            kind, marker = "natal", "Натальная карта для"
+            steps = ["/natal"] + self._person()
+        self.samples["dialog_step"].append(await self._say(chat_id, "/start"))
+        for step in steps[:-1]:
+            if self.args.think:
+                await asyncio.sleep(
+                    self.rng.expovariate(1 / self.args.think))
+            self.samples["dialog_step"].append(await self._say(
+                chat_id, step))
+        seen = len(self.telegram.replies[chat_id])
+        self.samples[f"flow_{kind}"].append(await self._say(
+            chat_id, steps[-1]))
+        self.outcomes[(kind,
+                       self._outcome(self.telegram.replies[chat_id][seen:],
+                                     marker))] += 1
+
+    async def run(self) -> float:
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def limited(chat_id: int):
+            async with semaphore:
+                await self.user(chat_id)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(limited(chat_id)
+                               for chat_id in range(1, self.args.users + 1)))
+        return time.perf_counter() - started
+
+
+def _stage_rows(samples: Dict[str, List[float]],
+                errors: Counter) -> Dict[str, Dict[str, float]]:
+    return {
+        stage: {
+            "count": len(values),
+            "errors": errors.get(stage, 0),
+            "p50": percentile(values, 0.50),
+            "p95": percentile(values, 0.95),
+            "p99": percentile(values, 0.99),
+            "max": max(values),
+        }
+        for stage, values in sorted(samples.items())
+    }
+
+
+def _print_table(title: str, rows: Dict[str, Dict[str, float]]):
+    print(f"\n{title}")
+    print(f"{'':<22}{'n':>7}{'ошибок':>8}{'p50, мс':>11}{'p95, мс':>11}"
+          f"{'p99, мс':>11}{'max, мс':>11}")
+    for name, row in rows.items():
+        print(f"{name:<22}{row['count']:>7}{row['errors']:>8}"
+              f"{row['p50'] * 1000:>11.1f}{row['p95'] * 1000:>11.1f}"
+              f"{row['p99'] * 1000:>11.1f}{row['max'] * 1000:>11.1f}")
+
+
+async def run_load(args) -> Dict[str, Any]:
+    telegram = FakeTelegram(port=free_port(),
+                            retry_after_every=args.telegram_retry_after_every,
+                            latency=args.telegram_latency)
+    nominatim = FakeNominatim(latency=args.nominatim_latency,
+                              error_rate=args.nominatim_error_rate,
+                              seed=args.seed)
+    openrouter = FakeOpenRouter(latency=args.ai_latency,
+                                error_rate=args.ai_error_rate,
+                                tokens=args.ai_tokens,
+                                token_interval=args.ai_token_interval,
+                                seed=args.seed)
+    stand_ins = StandIns(telegram, nominatim, openrouter)
+    await asyncio.to_thread(stand_ins.start)
+
+    # bot.py читает настройки при импорте
+    os.environ.update(TELEGRAM_API_SERVER=telegram.base_url,
+                      NOMINATIM_URL=nominatim.base_url,
+                      OPENROUTER_BASE_URL=openrouter.base_url)
+    os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:benchmark")
+    os.environ.setdefault("OPENROUTER_API_KEY", "benchmark")
+    # Без справочника и постоянных кэшей — каждое место идет в Nominatim
+    for name in ("GAZETTEER_PATH", "GEOCACHE_PATH",
+                 "INTERPRETATION_CACHE_PATH", "FSM_STORAGE_PATH"):
+        os.environ.setdefault(name, "")
+    import bot as app
+    import metrics
+    if not args.verbose:
+        # Внедренные ошибки считаются в отчете, трассировки только мешают
+        logging.getLogger().setLevel(logging.CRITICAL)
+
+    test = LoadTest(app, telegram, args)
+    metrics.span_listeners.append(test.on_span)
+    try:
+        seconds = await test.run()
+    finally:
+        metrics.span_listeners.remove(test.on_span)
+        await app.shutdown()
+        await asyncio.to_thread(stand_ins.stop)
+
+    flows = sum(test.outcomes.values())
+    telegram_calls = Counter(method for method, _, _ in telegram.calls)
+    return {
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "seconds": seconds,
+        "flows_per_second": flows / seconds,
+        "outcomes": {
+            f"{kind}/{outcome}": count
+            for (kind, outcome), count in sorted(test.outcomes.items())
+        },
+        "requests": _stage_rows(
+            {
+                name: values
+                for name, values in test.samples.items()
+                if name.startswith(("flow_", "dialog_"))
+            }, Counter()),
+        "stages": _stage_rows(
+            {
+                name: values
+                for name, values in test.samples.items()
+                if not name.startswith(("flow_", "dialog_"))
+            }, test.errors),
+        "services": {
+            "telegram": dict(telegram_calls),
+            "nominatim": {
+                "requests": nominatim.requests,
+                "errors": nominatim.errors
+            },
+            "openrouter": {
+                "requests": openrouter.requests,
+                "errors": openrouter.errors
+            },
+        },
+    }
+
+
+def print_load(report: Dict[str, Any]):
+    print(f"Пользователей: {report['users']} (одновременно "
+          f"{report['concurrency']}), {report['seconds']:.1f} с, "
+          f"{report['flows_per_second']:.2f} диалогов/с")
+    print("Исходы: " + ", ".join(f"{name} {count}" for name, count in
+                                 report["outcomes"].items()))
+    _print_table("Время ответа", report["requests"])
+    _print_table("Этапы", report["stages"])
+    services = report["services"]
+    print(f"\nTelegram: {services['telegram']}")
+    print(f"Nominatim: {services['nominatim']}, "
+          f"OpenRouter: {services['openrouter']}")
+
+
+def run_micro(args) -> Dict[str, Dict[str, float]]:
+    import swisseph as swe
+
+    from astro_engine import AstroCalculator
+    from ephemeris_table import load_if_exists
+    from geo_cache import GeoCache
+
+    logging.getLogger().setLevel(logging.WARNING)
+    calculator = AstroCalculator(geo_cache=GeoCache(None),
+                                 ephemeris_table=load_if_exists(
+                                     args.ephemeris))
+    for name, lat, lon in CITIES:
+        calculator.geo_cache.get_or_compute(
+            name, lambda place, lat=lat, lon=lon:
+            (lat, lon, calculator.tz_finder.timezone_at(lat=lat, lng=lon)))
+
+    rng = random.Random(args.seed)
+    births = [random_birth(rng) + [rng.choice(CITIES)[0]]
+              for _ in range(args.iterations)]
+    jds = [2433282.5 + rng.random() * 22000 for _ in range(args.iterations)]
+    points = [(rng.uniform(-60, 60), rng.uniform(-180, 180))
+              for _ in range(args.iterations)]
+
+    def calculate():
+        for date, birth_time, place in births:
+            calculator.calculate(date, birth_time, place)
+
+    def compute_chart():
+        for jd, (lat, lon) in zip(jds, points):
+            calculator.compute_chart(jd, lat, lon)
+
+    def planet_info():
+        for jd in jds:
+            calculator.get_planet_info(jd, swe.SUN)
+            calculator.get_planet_info(jd, swe.MOON)
+
+    report = {}
+    for name, func, calls in (
+        ("calculate", calculate, len(births)),
+        ("compute_chart", compute_chart, len(jds)),
+        ("get_planet_info", planet_info, 2 * len(jds)),
+    ):
+        runs = [
+            seconds / calls
+            for seconds in timeit.repeat(func, number=1, repeat=args.repeat)
+        ]
+        report[name] = {
+            "best_us": min(runs) * 1e6,
+            "median_us": statistics.median(runs) * 1e6,
+            "calls_per_second": 1 / min(runs),
+        }
+    return report
+
+
+def print_micro(report: Dict[str, Dict[str, float]]):
+    print(f"{'':<18}{'лучшее, мкс':>14}{'медиана, мкс':>15}{'вызовов/с':>12}")
+    for name, row in report.items():
+        print(f"{name:<18}{row['best_us']:>14.1f}{row['median_us']:>15.1f}"
+              f"{row['calls_per_second']:>12.0f}")
+
+
+def main(argv: Optional[List[str]] = None):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--json", action="store_true", help="отчет в JSON")
+    common.add_argument("--seed", type=int, default=1)
+    common.add_argument("--verbose", action="store_true")
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    load = commands.add_parser("load",
+                               parents=[common],
+                               help="нагрузочный тест бота")
+    load.add_argument("--users", type=int, default=100)
+    load.add_argument("--concurrency", type=int, default=50,
+                      help="сколько пользователей ведут диалог одновременно")
+    load.add_argument("--compatibility-share", type=float, default=0.3,
+                      help="доля диалогов совместимости")
+    load.add_argument("--think", type=float, default=0.0,
+                      help="средняя пауза пользователя между шагами, с")
+    load.add_argument("--places", type=int, default=500,
+                      help="сколько разных мест рождения")
+    load.add_argument("--telegram-latency", type=float, default=0.0)
+    load.add_argument("--telegram-retry-after-every", type=int, default=0,
+                      help="каждый N-й sendMessage отвечает 429")
+    load.add_argument("--nominatim-latency", type=float, default=0.1)
+    load.add_argument("--nominatim-error-rate", type=float, default=0.0)
+    load.add_argument("--ai-latency", type=float, default=1.0,
+                      help="время до первого токена, с")
+    load.add_argument("--ai-error-rate", type=float, default=0.0)
+    load.add_argument("--ai-tokens", type=int, default=300)
+    load.add_argument("--ai-token-interval", type=float, default=0.02)
+
+    micro = commands.add_parser("micro",
+                                parents=[common],
+                                help="микробенчмарки расчетов")
+    micro.add_argument("--iterations", type=int, default=1000)
+    micro.add_argument("--repeat", type=int, default=5)
+    micro.add_argument("--ephemeris", default=None,
+                       help="таблица эфемерид (python ephemeris_table.py "
+                       "build ...)")
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else
+                        logging.WARNING,
+                        format="%(asctime)s - %(levelname)s - %(message)s")
+    if args.command == "load":
+        report = asyncio.run(run_load(args))
+        printer = print_load
+    else:
+        report = run_micro(args)
+        printer = print_micro
+    if args.json:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    else:
+        printer(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,132 @@
 import os
-import json
 import logging
+import time
 from datetime import datetime
+from typing import Optional
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import Command
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
-from openai import OpenAI
+import log_setup
+import metrics
+from ai_client import AIClient
 from astro_engine import AstroCalculator
+from broadcast import DailyBroadcast, SubscriberStore
+from compute_executor import ComputeExecutor, ComputeQueueFull
+from fsm_storage import SQLiteStorage
+from interpretation_cache import InterpretationCache, cache_key
+from outbound import OutboundDispatcher, cut_markdown, split_markdown
+from prompts import (compatibility_prompt, natal_prompt, placements,
+                     signature)
+from scheduler import JobScheduler, RateLimited, SchedulerOverloaded
 
 import asyncio
-
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler("bot.log", encoding="utf-8"),
-        logging.StreamHandler()
-    ])
-logger = logging.getLogger(__name__)
+import functools
 
 load_dotenv()
 
+# Настройка логирования (LOG_*): файл пишет отдельный поток. До создания
+# пула расчетов — его процессы пишут в журнал через этот процесс
+if __name__ == "__main__":
+    log_setup.setup()
+logger = logging.getLogger(__name__)
+
 
 class Config:
     BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+    # Свой сервер Bot API (локальный или fake_telegram.py для тестов)
+    TELEGRAM_API_SERVER = os.getenv('TELEGRAM_API_SERVER', '')
     OPENROUTER_API_KEY = os.getenv('OPENROUTER_API_KEY')
+    OPENROUTER_BASE_URL = os.getenv('OPENROUTER_BASE_URL',
+                                    "https://openrouter.ai/api/v1")
     MODEL_NAME = "deepseek/deepseek-r1-0528:free"
+    # Запасные модели через запятую: пробуются, если основная недоступна
+    FALLBACK_MODELS = [
+        name.strip() for name in os.getenv('FALLBACK_MODELS', '').split(',')
+        if name.strip()
+    ]
+    MODEL_CHAIN = [MODEL_NAME] + FALLBACK_MODELS
+    # Страхующий запрос, пока у модели мало замеров для p95 (секунды)
+    AI_HEDGE_AFTER = float(os.getenv('AI_HEDGE_AFTER', '20'))
+    # То же для первого фрагмента потокового ответа
+    AI_HEDGE_FIRST_TOKEN_AFTER = float(
+        os.getenv('AI_HEDGE_FIRST_TOKEN_AFTER', '10'))
     MAX_TOKENS = 2000
+    # Сколько запросов к ИИ выполняется одновременно (остальные ждут)
+    AI_MAX_CONCURRENCY = int(os.getenv('AI_MAX_CONCURRENCY', '16'))
+    AI_MAX_CONNECTIONS = int(os.getenv('AI_MAX_CONNECTIONS', '32'))
+    AI_TIMEOUT = float(os.getenv('AI_TIMEOUT', '90'))
+    # Потоковый вывод интерпретации правками одного сообщения
+    AI_STREAMING = os.getenv('AI_STREAMING', '1') == '1'
+    # Не чаще одной правки сообщения за столько секунд (лимиты Telegram)
+    STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.5'))
+    # После этой длины вывод продолжается в новом сообщении (предел 4096)
+    STREAM_MESSAGE_LIMIT = 4000
+    # Сколько процессов делят общие лимиты (вебхук задает число обработчиков):
+    # TELEGRAM_GLOBAL_RATE, AI_MAX_CONCURRENCY и BROADCAST_RATE — на всех
+    PROCESSES = int(os.getenv('BOT_PROCESSES', '1'))
+    # Номер этого процесса: его часть подписчиков в рассылке
+    PROCESS_INDEX = int(os.getenv('BOT_PROCESS_INDEX', '0'))
+    # Лимиты Telegram на исходящие сообщения (в секунду)
+    TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', '30'))
+    TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', '1'))
+    # Свой сервер Nominatim (по умолчанию — nominatim.openstreetmap.org)
+    NOMINATIM_URL = os.getenv('NOMINATIM_URL', '')
+    # Постоянный кэш геокодинга (пустая строка — только память)
+    GEOCACHE_PATH = os.getenv('GEOCACHE_PATH', 'geocache.sqlite3')
+    # Каталог индекса городов (python gazetteer.py build ...)
+    GAZETTEER_PATH = os.getenv('GAZETTEER_PATH', 'gazetteer')
+    # Предрасчитанная таблица эфемерид (python ephemeris_table.py build ...)
+    EPHEMERIS_TABLE_PATH = os.getenv('EPHEMERIS_TABLE_PATH', 'ephemeris.npy')
+    # Допустимая ошибка таблицы в угловых секундах
+    EPHEMERIS_MAX_ERROR = float(os.getenv('EPHEMERIS_MAX_ERROR', '1.0'))
+    # Кэш интерпретаций по сигнатуре карты
+    INTERPRETATION_CACHE_PATH = os.getenv('INTERPRETATION_CACHE_PATH',
+                                          'interpretations.sqlite3')
+    INTERPRETATION_CACHE_TTL = float(
+        os.getenv('INTERPRETATION_CACHE_TTL', str(30 * 24 * 3600)))
+    INTERPRETATION_CACHE_MAX_ENTRIES = int(
+        os.getenv('INTERPRETATION_CACHE_MAX_ENTRIES', '200000'))
+    # Шаг градусов в сигнатуре (30 — только знаки, 12³ натальных комбинаций)
+    INTERPRETATION_DEGREE_BUCKET = int(
+        os.getenv('INTERPRETATION_DEGREE_BUCKET', '30'))
+    # Состояния диалогов (пустая строка — только память, без перезапусков)
+    FSM_STORAGE_PATH = os.getenv('FSM_STORAGE_PATH', 'fsm.sqlite3')
+    # Брошенный диалог забывается после стольких секунд без активности
+    FSM_STATE_TTL = float(os.getenv('FSM_STATE_TTL', str(7 * 24 * 3600)))
+    # Ежедневная рассылка: подписчики, время (ЧЧ:ММ по UTC) и скорость
+    # (сообщений в секунду; остаток лимита TELEGRAM_GLOBAL_RATE — диалогам)
+    SUBSCRIBERS_PATH = os.getenv('SUBSCRIBERS_PATH', 'subscribers.sqlite3')
+    BROADCAST_ENABLED = os.getenv('BROADCAST_ENABLED', '1') == '1'
+    BROADCAST_TIME = os.getenv('BROADCAST_TIME', '06:00')
+    BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '20'))
+    BROADCAST_AI_CONCURRENCY = int(os.getenv('BROADCAST_AI_CONCURRENCY', '8'))
+    BROADCAST_MAX_TOKENS = 700
+    # Порт HTTP /metrics (0 — выключено); в режиме вебхука у обработчика N
+    # порт METRICS_PORT + N
+    METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+    METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+    # Запросы дольше этого попадают в журнал и /debug/slow
+    SLOW_REQUEST_SECONDS = float(os.getenv('SLOW_REQUEST_SECONDS', '10'))
+    # Шаг семплера стеков для медленных запросов, секунды (0 — выключен)
+    PROFILE_SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', '0'))
+    # Пул расчетов карт: thread или process
+    COMPUTE_MODE = os.getenv('COMPUTE_MODE', 'thread')
+    COMPUTE_WORKERS = int(os.getenv('COMPUTE_WORKERS', '0')) or None
+    COMPUTE_MAX_PENDING = int(os.getenv('COMPUTE_MAX_PENDING', '64'))
+    # Очередь тяжелых задач: натальная карта стоит 1, совместимость — 2
+    JOB_CAPACITY = float(os.getenv('JOB_CAPACITY', '16'))
+    JOB_QUEUE_LIMIT = float(os.getenv('JOB_QUEUE_LIMIT', '100'))
+    # Лимит пользователя: столько единиц в минуту, всплеск до USER_JOB_BURST
+    USER_JOBS_PER_MINUTE = float(os.getenv('USER_JOBS_PER_MINUTE', '3'))
+    USER_JOB_BURST = float(os.getenv('USER_JOB_BURST', '4'))
+    NATAL_JOB_COST = 1
+    COMPATIBILITY_JOB_COST = 2
 
 
 class AstroStates(StatesGroup):
@@ -51,17 +146,93 @@ class CompatibilityStates(StatesGroup):
     waiting_birth_place_2 = State()
 
 
-bot = Bot(token=Config.BOT_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
-astro = AstroCalculator()
+class SubscribeStates(StatesGroup):
+    waiting_birth_date = State()
+    waiting_birth_time = State()
+    waiting_birth_place = State()
 
-client = OpenAI(
-    base_url="https://openrouter.ai/api/v1",
+
+bot = Bot(token=Config.BOT_TOKEN,
+          session=AiohttpSession(api=TelegramAPIServer.from_base(
+              Config.TELEGRAM_API_SERVER)) if Config.TELEGRAM_API_SERVER else
+          None)
+storage = (SQLiteStorage(Config.FSM_STORAGE_PATH, ttl=Config.FSM_STATE_TTL)
+           if Config.FSM_STORAGE_PATH else MemoryStorage())
+dp = Dispatcher(storage=storage)
+outbound = OutboundDispatcher(bot,
+                              global_rate=Config.TELEGRAM_GLOBAL_RATE /
+                              Config.PROCESSES,
+                              chat_rate=Config.TELEGRAM_CHAT_RATE)
+compute = ComputeExecutor(
+    functools.partial(AstroCalculator.from_paths,
+                      geocache_path=Config.GEOCACHE_PATH,
+                      gazetteer_path=Config.GAZETTEER_PATH,
+                      ephemeris_path=Config.EPHEMERIS_TABLE_PATH,
+                      ephemeris_max_error=Config.EPHEMERIS_MAX_ERROR,
+                      nominatim_url=Config.NOMINATIM_URL or None),
+    mode=Config.COMPUTE_MODE,
+    workers=Config.COMPUTE_WORKERS,
+    max_pending=Config.COMPUTE_MAX_PENDING)
+
+scheduler = JobScheduler(capacity=Config.JOB_CAPACITY,
+                         max_queued=Config.JOB_QUEUE_LIMIT,
+                         user_rate=Config.USER_JOBS_PER_MINUTE / 60,
+                         user_burst=Config.USER_JOB_BURST)
+
+interpretations = InterpretationCache(
+    Config.INTERPRETATION_CACHE_PATH or None,
+    ttl=Config.INTERPRETATION_CACHE_TTL,
+    max_entries=Config.INTERPRETATION_CACHE_MAX_ENTRIES)
+
+subscribers = SubscriberStore(Config.SUBSCRIBERS_PATH or None)
+
+ai_client = AIClient(
     api_key=Config.OPENROUTER_API_KEY,
+    base_url=Config.OPENROUTER_BASE_URL,
+    max_concurrency=max(1, Config.AI_MAX_CONCURRENCY // Config.PROCESSES),
+    max_connections=Config.AI_MAX_CONNECTIONS,
+    timeout=Config.AI_TIMEOUT,
+    models=Config.MODEL_CHAIN,
+    hedge_after=Config.AI_HEDGE_AFTER,
+    hedge_first_token_after=Config.AI_HEDGE_FIRST_TOKEN_AFTER,
 )
 
 
+broadcaster = DailyBroadcast(
+    subscribers,
+    outbound,
+    compute,
+    functools.partial(ai_client.generate,
+                      max_tokens=Config.BROADCAST_MAX_TOKENS),
+    # Та же доля от лимита процесса, что BROADCAST_RATE от общего
+    rate=Config.BROADCAST_RATE / Config.PROCESSES,
+    ai_concurrency=Config.BROADCAST_AI_CONCURRENCY,
+    shard=Config.PROCESS_INDEX,
+    shards=Config.PROCESSES)
+
+BUSY_TEXT = "⏳ Сейчас слишком много запросов, попробуйте через минуту"
+
+
+@dp.update.outer_middleware()
+async def correlation_id(handler, update: types.Update, data: dict):
+    """Номер обновления в каждой записи журнала о его обработке"""
+    token = log_setup.request_id.set(str(update.update_id))
+    try:
+        return await handler(update, data)
+    finally:
+        log_setup.request_id.reset(token)
+
+
+def queue_position_reporter(status: Message, text: str):
+    """Колбэк для scheduler.run: показывает номер в очереди в status"""
+
+    async def report(position: int):
+        await _edit_text(status.chat.id, status.message_id,
+                         f"⏳ Вы #{position} в очереди. {text}")
+
+    return report
+
+
 def get_main_keyboard():
     return ReplyKeyboardMarkup(
         keyboard=[
@@ -74,36 +245,140 @@ def get_main_keyboard():
 
 
 async def send_safe_message(chat_id: int, text: str):
-    """Отправка сообщения с контролем длины"""
-    if len(text) <= 4096:
-        await bot.send_message(chat_id, text, parse_mode="Markdown")
-    else:
-        parts = [text[i:i + 4000] for i in range(0, len(text), 4000)]
-        for part in parts:
-            await bot.send_message(chat_id, part, parse_mode="Markdown")
-            await asyncio.sleep(0.3)
+    """Отправка сообщения с контролем длины (части не рвут разметку)"""
+    with metrics.span("send"):
+        await outbound.send_text(chat_id, text, parse_mode="Markdown")
+
+
+AI_FAILED_TEXT = "Не удалось получить интерпретацию"
 
 
 async def get_ai_response(prompt: str) -> str:
     """Получение интерпретации от ИИ"""
     try:
-        completion = client.chat.completions.create(
-            model=Config.MODEL_NAME,
-            messages=[{
-                "role": "user",
-                "content": prompt
-            }],
-            temperature=0.7,
-            max_tokens=Config.MAX_TOKENS)
-        return completion.choices[0].message.content
+        with metrics.span("ai"):
+            return await ai_client.generate(prompt,
+                                            max_tokens=Config.MAX_TOKENS)
+    except Exception as e:
+        logger.error("AI error: %s", e)
+        return AI_FAILED_TEXT
+
+
+async def _edit_text(chat_id: int,
+                     message_id: int,
+                     text: str,
+                     markdown: bool = False,
+                     wait: bool = False):
+    """Правка сообщения через очередь чата; без wait не ждем отправки
+    (ожидающая правка заменится следующей)"""
+    sent = outbound.edit(chat_id,
+                         message_id,
+                         text,
+                         parse_mode="Markdown" if markdown else None)
+    if wait:
+        await sent
+
+
+async def stream_ai_response(status: Message, header: str,
+                             prompt: str) -> Optional[str]:
+    """Потоковый вывод интерпретации в сообщение status.
+
+    Правки объединяются не чаще STREAM_EDIT_INTERVAL; при приближении к
+    пределу длины вывод продолжается в новом сообщении. Во время генерации
+    текст показывается без разметки, в конце — с Markdown. Возвращает
+    полный текст или None, если ответ не получен целиком.
+    """
+    chat_id = status.chat.id
+    message_id = status.message_id
+    loop = asyncio.get_running_loop()
+    prefix = header  # то, что стоит перед потоком в текущем сообщении
+    text = ""
+    offset = 0  # с какого символа интерпретации начинается текущее сообщение
+    shown = None
+    last_edit = 0.0
+    complete = False
+
+    try:
+        async for delta in ai_client.stream_generate(
+                prompt, max_tokens=Config.MAX_TOKENS):
+            text += delta
+            page = prefix + text[offset:]
+            while len(page) > Config.STREAM_MESSAGE_LIMIT:
+                part, cut, reopen = cut_markdown(page,
+                                                 Config.STREAM_MESSAGE_LIMIT,
+                                                 len(prefix))
+                await _edit_text(chat_id,
+                                 message_id,
+                                 part,
+                                 markdown=True,
+                                 wait=True)
+                offset += cut - len(prefix)
+                # Разметка, разрезанная границей, продолжается в новом
+                prefix = reopen
+                page = prefix + text[offset:]
+                new_message = await outbound.send(chat_id, page or "…")
+                message_id = new_message.message_id
+                shown = page
+                last_edit = loop.time()
+            if page != shown and loop.time(
+            ) - last_edit >= Config.STREAM_EDIT_INTERVAL:
+                await _edit_text(chat_id, message_id, page)
+                shown = page
+                last_edit = loop.time()
+        complete = bool(text)
     except Exception as e:
-        logger.error(f"AI error: {str(e)}")
-        return "Не удалось получить интерпретацию"
+        logger.error("AI stream error: %s", e)
+        if text:
+            text += "\n\n⚠️ Ответ прерван"
+        else:
+            text = AI_FAILED_TEXT
+
+    if not text:
+        text = AI_FAILED_TEXT
+    await _edit_text(chat_id,
+                     message_id,
+                     prefix + text[offset:],
+                     markdown=True,
+                     wait=True)
+    return text if complete else None
+
+
+async def deliver_interpretation(status: Message, header: str, kind: str,
+                                 chart_signature: str, prompt: str):
+    """Ответ с интерпретацией: из кэша по сигнатуре карты, иначе от ИИ
+    (с сохранением в кэш)"""
+    key = cache_key(kind, Config.INTERPRETATION_DEGREE_BUCKET,
+                    chart_signature)
+    cached = await asyncio.to_thread(interpretations.get, key)
+    if cached is not None:
+        logger.info("Интерпретация из кэша: %s %s", kind, chart_signature)
+        # Первая часть заменяет сообщение о расчете, остальные — новыми
+        parts = split_markdown(header + cached, Config.STREAM_MESSAGE_LIMIT)
+        await _edit_text(status.chat.id,
+                         status.message_id,
+                         parts[0],
+                         markdown=True,
+                         wait=True)
+        for part in parts[1:]:
+            await send_safe_message(status.chat.id, part)
+        return
+
+    if Config.AI_STREAMING:
+        with metrics.span("ai_stream"):
+            interpretation = await stream_ai_response(status, header, prompt)
+    else:
+        interpretation = await get_ai_response(prompt)
+        await send_safe_message(status.chat.id, header + interpretation)
+        if interpretation == AI_FAILED_TEXT:
+            interpretation = None
+    if interpretation:
+        await asyncio.to_thread(interpretations.set, key, interpretation)
 
 
 @dp.message(Command("start"))
 async def cmd_start(message: Message):
-    await message.answer(
+    await outbound.send(
+        message.chat.id,
         "🔮 *AscendBot* - точные расчеты и персональные интерпретации вашей натальной карты\n"
         "Выберите действие:",
         reply_markup=get_main_keyboard(),
@@ -114,7 +389,8 @@ async def cmd_start(message: Message):
 @dp.message(lambda message: message.text == "🌌 Натальная карта")
 async def start_natal_chart(message: Message, state: FSMContext):
     await state.set_state(AstroStates.waiting_birth_date)
-    await message.answer(
+    await outbound.send(
+        message.chat.id,
         "📅 Введите *дату рождения* в формате ДД.ММ.ГГГГ\n"
         "Пример: _15.05.1990_",
         parse_mode="Markdown")
@@ -126,13 +402,15 @@ async def process_birth_date(message: Message, state: FSMContext):
         datetime.strptime(message.text, "%d.%m.%Y")
         await state.update_data(birth_date=message.text)
         await state.set_state(AstroStates.waiting_birth_time)
-        await message.answer(
+        await outbound.send(
+            message.chat.id,
             "⏰ Введите *время рождения* в формате ЧЧ:ММ\n"
             "Пример: _14:30_",
             parse_mode="Markdown")
     except ValueError:
-        await message.answer("❌ Неверный формат даты. Используйте ДД.ММ.ГГГГ",
-                             parse_mode="Markdown")
+        await outbound.send(message.chat.id,
+                            "❌ Неверный формат даты. Используйте ДД.ММ.ГГГГ",
+                            parse_mode="Markdown")
 
 
 @dp.message(AstroStates.waiting_birth_time)
@@ -141,65 +419,67 @@ async def process_birth_time(message: Message, state: FSMContext):
         datetime.strptime(message.text, "%H:%M")
         await state.update_data(birth_time=message.text)
         await state.set_state(AstroStates.waiting_birth_place)
-        await message.answer(
+        await outbound.send(
+            message.chat.id,
             "🌍 Введите *место рождения* (город, страна)\n"
             "Пример: _Москва, Россия_",
             parse_mode="Markdown")
     except ValueError:
-        await message.answer("❌ Неверный формат времени. Используйте ЧЧ:ММ",
-                             parse_mode="Markdown")
+        await outbound.send(message.chat.id,
+                            "❌ Неверный формат времени. Используйте ЧЧ:ММ",
+                            parse_mode="Markdown")
 
 
 @dp.message(AstroStates.waiting_birth_place)
 async def process_birth_place(message: Message, state: FSMContext):
     user_data = await state.get_data()
     place = message.text.strip()
+    status_text = "🔄 Составляю натальную карту и анализирую... Пожалуйста, подождите несколько секунд."
 
-    try:
+    async def job():
         # 1. Расчет позиций планет
-        positions = astro.calculate(user_data['birth_date'],
-                                    user_data['birth_time'], place)
+        positions = await compute.calculate_async(user_data['birth_date'],
+                                                  user_data['birth_time'],
+                                                  place)
 
         # 2. Формируем запрос для ИИ
-        prompt = f"""
-Рассчитана натальная карта:
-- Дата: {user_data['birth_date']}
-- Время: {user_data['birth_time']}
-- Место: {place}
-
-Позиции:
-- Солнце: {positions['planets']['sun']['sign']} ({positions['planets']['sun']['degree']:.1f}°)
-- Луна: {positions['planets']['moon']['sign']} ({positions['planets']['moon']['degree']:.1f}°)
-- Асцендент: {positions['planets']['ascendant']['sign']} ({positions['planets']['ascendant']['degree']:.1f}°)
-
-Дай краткую, лаконичную интерпретацию натальной карты с фокусом на:
-- Основные черты (до 5 пунктов, кратко)
-- Эмоциональные особенности (до 3–5 пунктов)
-- 3 совета по развитию
-
-Форматируй красиво, с эмодзи и подзаголовками. Избегай длинных абзацев. Не пиши 'На основе предоставленных данных...'
-"""
-        # 3. Получаем интерпретацию
-        await message.answer("🔄 Составляю натальную карту и анализирую... Пожалуйста, подождите несколько секунд.")
-
-        interpretation = await get_ai_response(prompt)
+        chart = placements(positions, Config.INTERPRETATION_DEGREE_BUCKET)
+        prompt = natal_prompt(chart, Config.INTERPRETATION_DEGREE_BUCKET)
 
-        # 4. Формируем ответ
-        response = (
+        # 3. Формируем ответ
+        header = (
             f"🌠 *Натальная карта для {user_data['birth_date']}*\n"
             f"📍 Место: {place}\n\n"
             f"☀️ Солнце: {positions['planets']['sun']['sign']} ({positions['planets']['sun']['degree']:.1f}°)\n"
             f"🌙 Луна: {positions['planets']['moon']['sign']} ({positions['planets']['moon']['degree']:.1f}°)\n"
             f"↑ Асцендент: {positions['planets']['ascendant']['sign']} ({positions['planets']['ascendant']['degree']:.1f}°)\n\n"
-            f"{interpretation}")
+        )
 
-        await send_safe_message(message.chat.id, response)
+        # 4. Получаем интерпретацию
+        await deliver_interpretation(status, header, "natal",
+                                     signature(chart), prompt)
 
+    try:
+        status = await outbound.send(message.chat.id, status_text)
+        with metrics.trace("natal"):
+            await scheduler.run(message.chat.id,
+                                job,
+                                cost=Config.NATAL_JOB_COST,
+                                on_position=queue_position_reporter(
+                                    status, status_text))
+
+    except RateLimited as e:
+        await _edit_text(status.chat.id, status.message_id,
+                         f"⏳ Слишком много запросов подряд, повторите через "
+                         f"{e.retry_after:.0f} с")
+    except (SchedulerOverloaded, ComputeQueueFull):
+        await _edit_text(status.chat.id, status.message_id, BUSY_TEXT)
     except ValueError as e:
-        await message.answer(f"❌ Ошибка: {str(e)}")
+        await outbound.send(message.chat.id, f"❌ Ошибка: {str(e)}")
     except Exception as e:
-        logger.error(f"Natal chart error: {str(e)}")
-        await message.answer("⚠️ Произошла ошибка при расчетах")
+        logger.error("Natal chart error: %s", e)
+        await outbound.send(message.chat.id,
+                            "⚠️ Произошла ошибка при расчетах")
     finally:
         await state.clear()
 
@@ -211,7 +491,8 @@ async def process_birth_place(message: Message, state: FSMContext):
 @dp.message(lambda message: message.text == "❤️ Совместимость")
 async def start_compatibility(message: Message, state: FSMContext):
     await state.set_state(CompatibilityStates.waiting_birth_date_1)
-    await message.answer(
+    await outbound.send(
+        message.chat.id,
         "📅 Введите *дату рождения первого человека* в формате ДД.ММ.ГГГГ\n"
         "Пример: _15.05.1990_",
         parse_mode="Markdown")
@@ -223,13 +504,15 @@ async def comp_birth_date_1(message: Message, state: FSMContext):
         datetime.strptime(message.text, "%d.%m.%Y")
         await state.update_data(birth_date_1=message.text)
         await state.set_state(CompatibilityStates.waiting_birth_time_1)
-        await message.answer(
+        await outbound.send(
+            message.chat.id,
             "⏰ Введите *время рождения первого человека* в формате ЧЧ:ММ\n"
             "Пример: _14:30_",
             parse_mode="Markdown")
     except ValueError:
-        await message.answer("❌ Неверный формат даты. Используйте ДД.ММ.ГГГГ",
-                             parse_mode="Markdown")
+        await outbound.send(message.chat.id,
+                            "❌ Неверный формат даты. Используйте ДД.ММ.ГГГГ",
+                            parse_mode="Markdown")
 
 
 @dp.message(CompatibilityStates.waiting_birth_time_1)
@@ -238,13 +521,15 @@ async def comp_birth_time_1(message: Message, state: FSMContext):
         datetime.strptime(message.text, "%H:%M")
         await state.update_data(birth_time_1=message.text)
         await state.set_state(CompatibilityStates.waiting_birth_place_1)
-        await message.answer(
+        await outbound.send(
+            message.chat.id,
             "🌍 Введите *место рождения первого человека* (город, страна)\n"
             "Пример: _Москва, Россия_",
             parse_mode="Markdown")
     except ValueError:
-        await message.answer("❌ Неверный формат времени. Используйте ЧЧ:ММ",
-                             parse_mode="Markdown")
+        await outbound.send(message.chat.id,
+                            "❌ Неверный формат времени. Используйте ЧЧ:ММ",
+                            parse_mode="Markdown")
 
 
 @dp.message(CompatibilityStates.waiting_birth_place_1)
@@ -253,17 +538,19 @@ async def comp_birth_place_1(message: Message, state: FSMContext):
         # Проверка, что место не пустое
         place_1 = message.text.strip()
         if not place_1:
-            await message.answer("❌ Место не может быть пустым")
+            await outbound.send(message.chat.id,
+                                "❌ Место не может быть пустым")
             return
         await state.update_data(birth_place_1=place_1)
         await state.set_state(CompatibilityStates.waiting_birth_date_2)
-        await message.answer(
+        await outbound.send(
+            message.chat.id,
             "📅 Введите *дату рождения второго человека* в формате ДД.ММ.ГГГГ\n"
             "Пример: _15.05.1990_",
             parse_mode="Markdown")
     except Exception as e:
-        logger.error(f"Error comp_birth_place_1: {str(e)}")
-        await message.answer("⚠️ Ошибка. Попробуйте еще раз.")
+        logger.error("Error comp_birth_place_1: %s", e)
+        await outbound.send(message.chat.id, "⚠️ Ошибка. Попробуйте еще раз.")
 
 
 @dp.message(CompatibilityStates.waiting_birth_date_2)
@@ -272,13 +559,15 @@ async def comp_birth_date_2(message: Message, state: FSMContext):
         datetime.strptime(message.text, "%d.%m.%Y")
         await state.update_data(birth_date_2=message.text)
         await state.set_state(CompatibilityStates.waiting_birth_time_2)
-        await message.answer(
+        await outbound.send(
+            message.chat.id,
             "⏰ Введите *время рождения второго человека* в формате ЧЧ:ММ\n"
             "Пример: _14:30_",
             parse_mode="Markdown")
     except ValueError:
-        await message.answer("❌ Неверный формат даты. Используйте ДД.ММ.ГГГГ",
-                             parse_mode="Markdown")
+        await outbound.send(message.chat.id,
+                            "❌ Неверный формат даты. Используйте ДД.ММ.ГГГГ",
+                            parse_mode="Markdown")
 
 
 @dp.message(CompatibilityStates.waiting_birth_time_2)
@@ -287,66 +576,41 @@ async def comp_birth_time_2(message: Message, state: FSMContext):
         datetime.strptime(message.text, "%H:%M")
         await state.update_data(birth_time_2=message.text)
         await state.set_state(CompatibilityStates.waiting_birth_place_2)
-        await message.answer(
+        await outbound.send(
+            message.chat.id,
             "🌍 Введите *место рождения второго человека* (город, страна)\n"
             "Пример: _Москва, Россия_",
             parse_mode="Markdown")
     except ValueError:
-        await message.answer("❌ Неверный формат времени. Используйте ЧЧ:ММ",
-                             parse_mode="Markdown")
+        await outbound.send(message.chat.id,
+                            "❌ Неверный формат времени. Используйте ЧЧ:ММ",
+                            parse_mode="Markdown")
 
 
 @dp.message(CompatibilityStates.waiting_birth_place_2)
 async def comp_birth_place_2(message: Message, state: FSMContext):
     user_data = await state.get_data()
     place_2 = message.text.strip()
+    status_text = "🔄 Анализирую совместимость... Пожалуйста, подождите немного."
 
-    try:
-        if not place_2:
-            await message.answer("❌ Место не может быть пустым")
-            return
-
-        await state.update_data(birth_place_2=place_2)
-        user_data = await state.get_data()
-
+    async def job():
         # Запускаем расчет совместимости
-        pos1 = astro.calculate(user_data['birth_date_1'],
-                               user_data['birth_time_1'],
-                               user_data['birth_place_1'])
-        pos2 = astro.calculate(user_data['birth_date_2'],
-                               user_data['birth_time_2'],
-                               user_data['birth_place_2'])
+        # Обе карты считаются параллельно
+        pos1, pos2 = await asyncio.gather(
+            compute.calculate_async(user_data['birth_date_1'],
+                                    user_data['birth_time_1'],
+                                    user_data['birth_place_1']),
+            compute.calculate_async(user_data['birth_date_2'],
+                                    user_data['birth_time_2'],
+                                    user_data['birth_place_2']))
 
         # Формируем запрос для ИИ
-        prompt = f"""
-Даны две натальные карты для анализа совместимости:
-
-1-й человек:
-- Дата: {user_data['birth_date_1']}
-- Время: {user_data['birth_time_1']}
-- Место: {user_data['birth_place_1']}
-- Солнце: {pos1['planets']['sun']['sign']} ({pos1['planets']['sun']['degree']:.1f}°)
-- Луна: {pos1['planets']['moon']['sign']} ({pos1['planets']['moon']['degree']:.1f}°)
-- Асцендент: {pos1['planets']['ascendant']['sign']} ({pos1['planets']['ascendant']['degree']:.1f}°)
-
-2-й человек:
-- Дата: {user_data['birth_date_2']}
-- Время: {user_data['birth_time_2']}
-- Место: {user_data['birth_place_2']}
-- Солнце: {pos2['planets']['sun']['sign']} ({pos2['planets']['sun']['degree']:.1f}°)
-- Луна: {pos2['planets']['moon']['sign']} ({pos2['planets']['moon']['degree']:.1f}°)
-- Асцендент: {pos2['planets']['ascendant']['sign']} ({pos2['planets']['ascendant']['degree']:.1f}°)
-
-Проанализируй совместимость этих двух людей, выдели сильные и слабые стороны их отношений,
-эмоциональную и духовную совместимость, а также дай 3 практических совета для гармонии в паре.
-
-Форматируй ответ с эмодзи и разделами, избегай воды и обобщений.
-"""
-        await message.answer("🔄 Анализирую совместимость... Пожалуйста, подождите немного.")
+        chart1 = placements(pos1, Config.INTERPRETATION_DEGREE_BUCKET)
+        chart2 = placements(pos2, Config.INTERPRETATION_DEGREE_BUCKET)
+        prompt = compatibility_prompt(chart1, chart2,
+                                      Config.INTERPRETATION_DEGREE_BUCKET)
 
-        interpretation = await get_ai_response(prompt)
-
-        response = (
+        header = (
             f"❤️ *Совместимость пары*\n\n"
             f"👤 1-й человек: {user_data['birth_date_1']}, {user_data['birth_place_1']}\n"
             f"☀️ Солнце: {pos1['planets']['sun']['sign']} ({pos1['planets']['sun']['degree']:.1f}°), "
@@ -356,36 +620,210 @@ async def comp_birth_place_2(message: Message, state: FSMContext):
             f"☀️ Солнце: {pos2['planets']['sun']['sign']} ({pos2['planets']['sun']['degree']:.1f}°), "
             f"🌙 Луна: {pos2['planets']['moon']['sign']} ({pos2['planets']['moon']['degree']:.1f}°), "
             f"↑ Асцендент: {pos2['planets']['ascendant']['sign']} ({pos2['planets']['ascendant']['degree']:.1f}°)\n\n"
-            f"{interpretation}")
+        )
+
+        await deliver_interpretation(status, header, "compatibility",
+                                     signature(chart1, chart2), prompt)
+
+    try:
+        if not place_2:
+            await outbound.send(message.chat.id,
+                                "❌ Место не может быть пустым")
+            return
+
+        await state.update_data(birth_place_2=place_2)
+        user_data = await state.get_data()
+
+        status = await outbound.send(message.chat.id, status_text)
+        with metrics.trace("compatibility"):
+            await scheduler.run(message.chat.id,
+                                job,
+                                cost=Config.COMPATIBILITY_JOB_COST,
+                                on_position=queue_position_reporter(
+                                    status, status_text))
+
+    except RateLimited as e:
+        await _edit_text(status.chat.id, status.message_id,
+                         f"⏳ Слишком много запросов подряд, повторите через "
+                         f"{e.retry_after:.0f} с")
+    except (SchedulerOverloaded, ComputeQueueFull):
+        await _edit_text(status.chat.id, status.message_id, BUSY_TEXT)
+    except ValueError as e:
+        await outbound.send(message.chat.id, f"❌ Ошибка: {str(e)}")
+    except Exception as e:
+        logger.error("Compatibility error: %s", e)
+        await outbound.send(message.chat.id,
+                            "⚠️ Произошла ошибка при расчетах")
+    finally:
+        await state.clear()
+
+
+# --- Ежедневный гороскоп ---
+
+
+@dp.message(Command("subscribe"))
+async def start_subscribe(message: Message, state: FSMContext):
+    await state.set_state(SubscribeStates.waiting_birth_date)
+    await outbound.send(
+        message.chat.id,
+        "🔔 Ежедневный гороскоп по вашим Солнцу и Луне\n\n"
+        "📅 Введите *дату рождения* в формате ДД.ММ.ГГГГ\n"
+        "Пример: _15.05.1990_",
+        parse_mode="Markdown")
+
+
+@dp.message(SubscribeStates.waiting_birth_date)
+async def subscribe_birth_date(message: Message, state: FSMContext):
+    try:
+        datetime.strptime(message.text, "%d.%m.%Y")
+        await state.update_data(birth_date=message.text)
+        await state.set_state(SubscribeStates.waiting_birth_time)
+        await outbound.send(
+            message.chat.id,
+            "⏰ Введите *время рождения* в формате ЧЧ:ММ\n"
+            "Пример: _14:30_",
+            parse_mode="Markdown")
+    except ValueError:
+        await outbound.send(message.chat.id,
+                            "❌ Неверный формат даты. Используйте ДД.ММ.ГГГГ",
+                            parse_mode="Markdown")
+
+
+@dp.message(SubscribeStates.waiting_birth_time)
+async def subscribe_birth_time(message: Message, state: FSMContext):
+    try:
+        datetime.strptime(message.text, "%H:%M")
+        await state.update_data(birth_time=message.text)
+        await state.set_state(SubscribeStates.waiting_birth_place)
+        await outbound.send(
+            message.chat.id,
+            "🌍 Введите *место рождения* (город, страна)\n"
+            "Пример: _Москва, Россия_",
+            parse_mode="Markdown")
+    except ValueError:
+        await outbound.send(message.chat.id,
+                            "❌ Неверный формат времени. Используйте ЧЧ:ММ",
+                            parse_mode="Markdown")
 
-        await send_safe_message(message.chat.id, response)
 
+@dp.message(SubscribeStates.waiting_birth_place)
+async def subscribe_birth_place(message: Message, state: FSMContext):
+    user_data = await state.get_data()
+    try:
+        positions = await compute.calculate_async(user_data['birth_date'],
+                                                  user_data['birth_time'],
+                                                  message.text.strip())
+        sun = positions['planets']['sun']['sign']
+        moon = positions['planets']['moon']['sign']
+        await asyncio.to_thread(subscribers.subscribe, message.chat.id, sun,
+                                moon)
+        await outbound.send(
+            message.chat.id,
+            f"✅ Вы подписаны на ежедневный гороскоп\n"
+            f"☀️ Солнце: {sun}, 🌙 Луна: {moon}\n"
+            f"Прогноз приходит каждый день в {Config.BROADCAST_TIME} UTC.\n"
+            f"Отписаться: /unsubscribe")
+    except ComputeQueueFull:
+        await outbound.send(message.chat.id, BUSY_TEXT)
     except ValueError as e:
-        await message.answer(f"❌ Ошибка: {str(e)}")
+        await outbound.send(message.chat.id, f"❌ Ошибка: {str(e)}")
     except Exception as e:
-        logger.error(f"Compatibility error: {str(e)}")
-        await message.answer("⚠️ Произошла ошибка при расчетах")
+        logger.error("Subscribe error: %s", e)
+        await outbound.send(message.chat.id,
+                            "⚠️ Произошла ошибка при расчетах")
     finally:
         await state.clear()
 
 
+@dp.message(Command("unsubscribe"))
+async def unsubscribe(message: Message, state: FSMContext):
+    await state.clear()
+    if await asyncio.to_thread(subscribers.unsubscribe, message.chat.id):
+        await outbound.send(message.chat.id,
+                            "🔕 Вы отписались от ежедневного гороскопа")
+    else:
+        await outbound.send(message.chat.id,
+                            "Вы не подписаны. Подписаться: /subscribe")
+
+
 @dp.message(lambda message: message.text == "ℹ️ Помощь")
 async def help_message(message: Message):
-    await message.answer(
+    await outbound.send(
+        message.chat.id,
         "Используйте кнопки:\n"
         "🌌 Натальная карта — получить вашу натальную карту с интерпретацией\n"
         "❤️ Совместимость — узнать астрологическую совместимость пары\n"
         "ℹ️ Помощь — показать это сообщение\n\n"
+        "🔔 /subscribe — ежедневный гороскоп, /unsubscribe — отписаться\n\n"
         "Вводите дату и время строго в формате, указанном в подсказках.")
 
 
+# Выставляется, когда warm_up() загрузил данные и клиентов
+ready = asyncio.Event()
+
+
+async def warm_up():
+    """Прогрев после старта: клиент ИИ, калькуляторы, TimezoneFinder.
+
+    Бот принимает сообщения и до его окончания — первые запросы просто
+    загрузят нужное сами. После прогрева /readyz отвечает 200.
+    """
+    started = time.perf_counter()
+    try:
+        # Клиент ИИ раньше пула: процессы расчетов наследуют готовую память
+        await ai_client.warm_up()
+        await compute.warm_up()
+    except Exception:
+        logger.exception("Прогрев не удался, данные загрузятся по запросу")
+    ready.set()
+    logger.info("Прогрев завершен за %.2f с", time.perf_counter() - started)
+
+
+async def readyz(request):
+    from aiohttp import web
+    if ready.is_set():
+        return web.Response(text="ok")
+    return web.Response(status=503, text="warming up")
+
+
+async def start_metrics(port: int = Config.METRICS_PORT):
+    """Включает /metrics, /readyz и семплер стеков по настройкам Config;
+    возвращает AppRunner сервера метрик или None"""
+    metrics.slow_threshold = Config.SLOW_REQUEST_SECONDS
+    if Config.PROFILE_SAMPLE_INTERVAL > 0:
+        metrics.start_sampler(Config.PROFILE_SAMPLE_INTERVAL)
+    if port:
+        return await metrics.start_http_server(Config.METRICS_HOST, port,
+                                               routes=[("/readyz", readyz)])
+    return None
+
+
+async def shutdown():
+    """Закрывает клиентов и пулы; вызывается при остановке процесса"""
+    await broadcaster.stop()
+    await ai_client.close()
+    await outbound.close()
+    await storage.close()
+    await bot.session.close()
+    compute.shutdown()
+    interpretations.close()
+    subscribers.close()
+
+
 if __name__ == "__main__":
     import asyncio
 
     async def main():
+        metrics_server = await start_metrics()
+        warming = asyncio.create_task(warm_up())
+        if Config.BROADCAST_ENABLED:
+            broadcaster.start(Config.BROADCAST_TIME)
         try:
             await dp.start_polling(bot)
         finally:
-            await bot.session.close()
+            warming.cancel()
+            if metrics_server is not None:
+                await metrics_server.cleanup()
+            await shutdown()
 
     asyncio.run(main())
@@ -0,0 +1,387 @@
+"""Ежедневная рассылка гороскопов подписчикам.
+
+Подписчик хранится со знаками своего Солнца и Луны. Раз в день рассылка
+один раз считает транзиты на полдень UTC, получает от ИИ по одному тексту на
+каждую встречающуюся пару Солнце × Луна (не больше 144 запросов при любом
+числе подписчиков) и раздает тексты через OutboundDispatcher со своим
+лимитом скорости, чтобы диалоги с ботом не ждали рассылку.
+
+Тексты и прогресс (последний обработанный chat_id, счетчики) сохраняются в
+SQLite после каждой пачки: после перезапуска рассылка продолжается с места
+остановки без повторных запросов к ИИ (повторно прогноз могут получить
+только подписчики прерванной пачки). Заблокировавшие бота пользователи
+отписываются автоматически.
+
+В режиме вебхука каждый из shards обработчиков рассылает свою часть
+подписчиков (chat_id % shards == shard — как и обновления) со своей долей
+лимита, прогресс у каждой части свой. Тексты групп тоже поделены: каждый
+обработчик запрашивает у ИИ свои и ждет остальные в общей базе. Смена
+числа обработчиков посреди рассылки может пропустить или повторить часть
+подписчиков этого дня.
+
+    python broadcast.py stats
+    python broadcast.py run --date 2026-10-17
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from datetime import date, datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import swisseph as swe
+from aiogram.exceptions import TelegramForbiddenError
+
+from prompts import daily_prompt, transits
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+Group = Tuple[str, str]  # (знак Солнца, знак Луны)
+
+
+class SubscriberStore:
+    """Подписчики, тексты рассылок и их прогресс в SQLite"""
+
+    def __init__(self, path: Optional[str] = "subscribers.sqlite3"):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path or ":memory:",
+                                   check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        # Файл могут делить процессы вебхука
+        self._db.execute("PRAGMA busy_timeout=5000")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS subscribers (
+                chat_id INTEGER PRIMARY KEY, sun TEXT NOT NULL,
+                moon TEXT NOT NULL, subscribed_at REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS broadcast_texts (
+                day TEXT, sun TEXT, moon TEXT, text TEXT NOT NULL,
+                PRIMARY KEY (day, sun, moon)) WITHOUT ROWID;
+        """)
+        columns = [
+            row[1] for row in self._db.execute("PRAGMA table_info(broadcasts)")
+        ]
+        if columns and "shard" not in columns:
+            # Прогресс без деления на части считается частью 0
+            self._db.execute("ALTER TABLE broadcasts RENAME TO broadcasts_old")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS broadcasts ("
+            "day TEXT, shard INTEGER NOT NULL, last_chat_id INTEGER NOT NULL, "
+            "sent INTEGER NOT NULL, failed INTEGER NOT NULL, "
+            "skipped INTEGER NOT NULL, finished INTEGER NOT NULL, "
+            "updated_at REAL NOT NULL, PRIMARY KEY (day, shard))")
+        if columns and "shard" not in columns:
+            self._db.execute(
+                "INSERT INTO broadcasts SELECT day, 0, last_chat_id, sent, "
+                "failed, skipped, finished, updated_at FROM broadcasts_old")
+            self._db.execute("DROP TABLE broadcasts_old")
+        self._db.commit()
+
+    def subscribe(self, chat_id: int, sun: str, moon: str):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO subscribers "
+                "(chat_id, sun, moon, subscribed_at) VALUES (?, ?, ?, ?)",
+                (chat_id, sun, moon, time.time()))
+
+    def unsubscribe(self, *chat_ids: int) -> int:
+        with self._lock, self._db:
+            return self._db.executemany(
+                "DELETE FROM subscribers WHERE chat_id = ?",
+                [(chat_id, ) for chat_id in chat_ids]).rowcount
+
+    def count(self) -> int:
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM subscribers").fetchone()[0]
+
+    def groups(self) -> Dict[Group, int]:
+        """Число подписчиков по парам Солнце × Луна"""
+        with self._lock:
+            rows = self._db.execute("SELECT sun, moon, COUNT(*) "
+                                    "FROM subscribers GROUP BY sun, moon")
+            return {(sun, moon): count for sun, moon, count in rows}
+
+    def page(self,
+             after: int,
+             limit: int,
+             shard: int = 0,
+             shards: int = 1) -> List[Tuple[int, str, str]]:
+        """Следующие limit подписчиков части shard с chat_id больше after"""
+        with self._lock:
+            # Остаток как в Python: у отрицательных chat_id он тоже >= 0
+            return self._db.execute(
+                "SELECT chat_id, sun, moon FROM subscribers "
+                "WHERE chat_id > ? AND (chat_id % ? + ?) % ? = ? "
+                "ORDER BY chat_id LIMIT ?",
+                (after, shards, shards, shards, shard, limit)).fetchall()
+
+    def texts(self, day: str) -> Dict[Group, str]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT sun, moon, text FROM broadcast_texts WHERE day = ?",
+                (day, ))
+            return {(sun, moon): text for sun, moon, text in rows}
+
+    def save_text(self, day: str, group: Group, text: str):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO broadcast_texts "
+                "(day, sun, moon, text) VALUES (?, ?, ?, ?)",
+                (day, *group, text))
+
+    def progress(self, day: str, shard: int = 0) -> Dict[str, int]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT last_chat_id, sent, failed, skipped, finished "
+                "FROM broadcasts WHERE day = ? AND shard = ?",
+                (day, shard)).fetchone()
+        keys = ("last_chat_id", "sent", "failed", "skipped", "finished")
+        # chat_id групп отрицательные — начинаем с самого малого
+        return dict(zip(keys, row or (-2**63, 0, 0, 0, 0)))
+
+    def save_progress(self, day: str, progress: Dict[str, int],
+                      shard: int = 0):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO broadcasts (day, shard, last_chat_id, "
+                "sent, failed, skipped, finished, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (day, shard, progress["last_chat_id"], progress["sent"],
+                 progress["failed"], progress["skipped"],
+                 progress["finished"], time.time()))
+
+    def purge_texts(self, before: str) -> int:
+        """Удаляет тексты рассылок за дни раньше before"""
+        with self._lock, self._db:
+            return self._db.execute(
+                "DELETE FROM broadcast_texts WHERE day < ?",
+                (before, )).rowcount
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class DailyBroadcast:
+    """Рассылка прогноза на день.
+
+    compute — ComputeExecutor для транзитов, generate(prompt) — текст от ИИ,
+    rate — сообщений рассылки в секунду (остаток общего лимита Telegram
+    остается диалогам), batch_size — подписчиков между сохранениями
+    прогресса, ai_concurrency — одновременных запросов к ИИ. shard/shards —
+    какую часть подписчиков рассылает этот процесс; чужие тексты он ждет
+    не дольше text_wait секунд, затем запрашивает сам.
+    """
+
+    def __init__(self,
+                 store: SubscriberStore,
+                 outbound,
+                 compute,
+                 generate: Callable[[str], Awaitable[str]],
+                 rate: float = 20,
+                 batch_size: int = 500,
+                 ai_concurrency: int = 8,
+                 ai_attempts: int = 3,
+                 shard: int = 0,
+                 shards: int = 1,
+                 text_wait: float = 600):
+        self.store = store
+        self.shard = shard
+        self.shards = shards
+        self.text_wait = text_wait
+        self.outbound = outbound
+        self.compute = compute
+        self.generate = generate
+        self.batch_size = batch_size
+        self.ai_concurrency = ai_concurrency
+        self.ai_attempts = ai_attempts
+        self._bucket = TokenBucket(rate, rate)
+        self._running: Optional[asyncio.Task] = None
+
+    async def _sky(self, day: date):
+        jd = swe.julday(day.year, day.month, day.day, 12.0)
+        return transits(await self.compute.compute_chart_async(jd, 0.0, 0.0))
+
+    def _owner(self, group: Group) -> int:
+        """Часть, которая запрашивает текст группы (одинаково во всех
+        процессах, в отличие от hash)"""
+        return zlib.crc32("|".join(group).encode("utf-8")) % self.shards
+
+    async def _texts(self, day: date, groups) -> Dict[Group, str]:
+        """Тексты для групп: сохраненные за этот день или новые от ИИ"""
+        key = day.isoformat()
+        texts = await asyncio.to_thread(self.store.texts, key)
+        missing = [group for group in groups if group not in texts]
+        if not missing:
+            return texts
+        own = [group for group in missing if self._owner(group) == self.shard]
+        others = [group for group in missing if group not in own]
+        sky = None
+        semaphore = asyncio.Semaphore(self.ai_concurrency)
+
+        async def generate(group: Group):
+            prompt = daily_prompt(f"{day:%d.%m.%Y}", sky, *group)
+            async with semaphore:
+                for attempt in range(1, self.ai_attempts + 1):
+                    try:
+                        text = await self.generate(prompt)
+                        break
+                    except Exception as e:
+                        logger.warning("Прогноз %s × %s, попытка %s: %s",
+                                       *group, attempt, e)
+                else:
+                    return
+            texts[group] = text
+            await asyncio.to_thread(self.store.save_text, key, group, text)
+
+        if own:
+            logger.info("Рассылка %s: %s новых текстов из %s", key, len(own),
+                        len(groups))
+            sky = await self._sky(day)
+            await asyncio.gather(*(generate(group) for group in own))
+        deadline = time.monotonic() + self.text_wait
+        while others and time.monotonic() < deadline:
+            await asyncio.sleep(min(5, self.text_wait))
+            texts.update(await asyncio.to_thread(self.store.texts, key))
+            others = [group for group in others if group not in texts]
+        if others:
+            logger.warning("Рассылка %s: %s текстов других частей не готовы, "
+                           "запрашиваем сами", key, len(others))
+            sky = sky or await self._sky(day)
+            await asyncio.gather(*(generate(group) for group in others))
+        return texts
+
+    @staticmethod
+    def _message(day: date, group: Group, text: str) -> str:
+        return (f"🔮 *Прогноз на {day:%d.%m.%Y}*\n"
+                f"☀️ {group[0]} · 🌙 {group[1]}\n\n{text}\n\n"
+                f"Отписаться: /unsubscribe")
+
+    async def run(self, day: date) -> Dict[str, int]:
+        """Рассылка за day; продолжает прерванную, завершенную пропускает"""
+        key = day.isoformat()
+        progress = await asyncio.to_thread(self.store.progress, key,
+                                           self.shard)
+        if progress["finished"]:
+            return progress
+        groups = await asyncio.to_thread(self.store.groups)
+        texts = await self._texts(day, groups)
+        skipped_groups = [group for group in groups if group not in texts]
+        if skipped_groups:
+            logger.error("Рассылка %s: нет текстов для %s групп", key,
+                         len(skipped_groups))
+        started = time.monotonic()
+        while True:
+            page = await asyncio.to_thread(self.store.page,
+                                           progress["last_chat_id"],
+                                           self.batch_size, self.shard,
+                                           self.shards)
+            if not page:
+                break
+            chats, sends = [], []
+            for chat_id, sun, moon in page:
+                text = texts.get((sun, moon))
+                if text is None:
+                    progress["skipped"] += 1
+                    continue
+                await self._bucket.acquire()
+                chats.append(chat_id)
+                sends.append(
+                    asyncio.ensure_future(
+                        self.outbound.send_text(
+                            chat_id, self._message(day, (sun, moon), text))))
+            results = await asyncio.gather(*sends, return_exceptions=True)
+            blocked = []
+            for chat_id, result in zip(chats, results):
+                if isinstance(result, TelegramForbiddenError):
+                    blocked.append(chat_id)
+                if isinstance(result, BaseException):
+                    progress["failed"] += 1
+                else:
+                    progress["sent"] += 1
+            if blocked:
+                await asyncio.to_thread(self.store.unsubscribe, *blocked)
+            progress["last_chat_id"] = page[-1][0]
+            await asyncio.to_thread(self.store.save_progress, key, progress,
+                                    self.shard)
+            logger.info("Рассылка %s [%s/%s]: отправлено %s, ошибок %s, %.0f с",
+                        key, self.shard, self.shards, progress["sent"],
+                        progress["failed"], time.monotonic() - started)
+        progress["finished"] = 1
+        await asyncio.to_thread(self.store.save_progress, key, progress,
+                                self.shard)
+        await asyncio.to_thread(self.store.purge_texts,
+                                (day - timedelta(days=7)).isoformat())
+        logger.info("Рассылка %s [%s/%s] завершена: %s", key, self.shard,
+                    self.shards, progress)
+        return progress
+
+    async def run_daily(self, at: str = "06:00"):
+        """Бесконечный цикл: рассылка каждый день в at (ЧЧ:ММ по UTC).
+        Если сегодняшняя рассылка прервана или уже пропущена — сразу"""
+        hour, minute = map(int, at.split(":"))
+        while True:
+            now = datetime.now(timezone.utc)
+            start = now.replace(hour=hour, minute=minute, second=0,
+                                microsecond=0)
+            if start <= now:
+                # Сегодняшнее время прошло: досылаем, если не закончили
+                try:
+                    await self.run(now.date())
+                except Exception:
+                    logger.exception("Рассылка прервана")
+                    await asyncio.sleep(60)
+                    continue
+                start += timedelta(days=1)
+            await asyncio.sleep((start - datetime.now(timezone.utc)
+                                 ).total_seconds())
+
+    def start(self, at: str = "06:00") -> asyncio.Task:
+        self._running = asyncio.create_task(self.run_daily(at))
+        return self._running
+
+    async def stop(self):
+        """Останавливает цикл; прогресс уже сохранен по пачкам"""
+        if self._running is not None:
+            self._running.cancel()
+            await asyncio.gather(self._running, return_exceptions=True)
+            self._running = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("stats", help="подписчики и группы")
+    run = commands.add_parser("run", help="разослать прогноз сейчас")
+    run.add_argument("--date",
+                     type=date.fromisoformat,
+                     default=datetime.now(timezone.utc).date())
+    args = parser.parse_args()
+
+    if args.command == "stats":
+        from dotenv import load_dotenv
+        load_dotenv()
+        store = SubscriberStore(
+            os.getenv('SUBSCRIBERS_PATH', 'subscribers.sqlite3'))
+        groups = store.groups()
+        print(f"Подписчиков: {store.count()}, групп Солнце × Луна: "
+              f"{len(groups)}")
+        store.close()
+    else:
+        import log_setup
+        log_setup.setup()
+        import bot as app
+
+        async def main():
+            try:
+                print(await app.broadcaster.run(args.date))
+            finally:
+                await app.shutdown()
+
+        asyncio.run(main())
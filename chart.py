@@ -0,0 +1,147 @@
+import json
+import math
+import struct
+from array import array
+from typing import Any, Dict, Optional
+
+SIGNS = [
+    "Овен", "Телец", "Близнецы", "Рак", "Лев", "Дева", "Весы", "Скорпион",
+    "Стрелец", "Козерог", "Водолей", "Рыбы"
+]
+
+# Порядок тел в массивах Chart
+BODIES = ("sun", "moon", "mercury", "venus", "mars", "jupiter", "saturn",
+          "uranus", "neptune", "pluto", "north_node", "south_node", "chiron")
+BODY_INDEX = {name: i for i, name in enumerate(BODIES)}
+
+_HEADER = struct.Struct("<5d")
+_BODY_ARRAYS = struct.Struct(f"<{2 * len(BODIES)}d")
+_CUSPS = struct.Struct("<12d")
+
+
+def sign_of(longitude: float) -> Optional[str]:
+    if math.isnan(longitude):
+        return None
+    return SIGNS[int(longitude // 30) % 12]
+
+
+class Chart:
+    """Натальная карта: долготы и скорости тел, куспиды домов, ASC и MC.
+
+    Данные лежат в плоских массивах double, поэтому объект компактен и
+    дешево сериализуется (to_bytes / pickle). Старое словарное
+    представление ({"planets": ..., "metadata": ...}) строится лениво
+    при первом обращении по ключу. Недоступные тела (например, Хирон без
+    файлов эфемерид) хранятся как NaN.
+    """
+
+    __slots__ = ("jd", "lat", "lon", "ascendant", "mc", "longitudes",
+                 "speeds", "cusps", "metadata", "_view")
+
+    def __init__(self,
+                 jd: float,
+                 lat: float,
+                 lon: float,
+                 longitudes: array,
+                 speeds: array,
+                 cusps: array,
+                 ascendant: float,
+                 mc: float,
+                 metadata: Optional[Dict[str, Any]] = None):
+        self.jd = jd
+        self.lat = lat
+        self.lon = lon
+        self.longitudes = longitudes
+        self.speeds = speeds
+        self.cusps = cusps
+        self.ascendant = ascendant
+        self.mc = mc
+        self.metadata = metadata or {}
+        self._view = None
+
+    def longitude(self, body: str) -> float:
+        return self.longitudes[BODY_INDEX[body]]
+
+    def sign(self, body: str) -> Optional[str]:
+        return sign_of(self.longitude(body))
+
+    def degree(self, body: str) -> float:
+        return self.longitude(body) % 30
+
+    def is_retrograde(self, body: str) -> bool:
+        return self.speeds[BODY_INDEX[body]] < 0
+
+    def house_of(self, longitude: float) -> int:
+        """Номер дома (1–12), в который попадает долгота"""
+        for i in range(12):
+            start, end = self.cusps[i], self.cusps[(i + 1) % 12]
+            if (longitude - start) % 360 < (end - start) % 360:
+                return i + 1
+        return 12
+
+    def _point(self, longitude: float) -> Dict[str, Any]:
+        return {"sign": sign_of(longitude), "degree": longitude % 30}
+
+    def to_dict(self) -> Dict[str, Any]:
+        if self._view is None:
+            planets = {}
+            for i, name in enumerate(BODIES):
+                longitude = self.longitudes[i]
+                if math.isnan(longitude):
+                    continue
+                point = self._point(longitude)
+                point["retrograde"] = self.speeds[i] < 0
+                planets[name] = point
+            planets["ascendant"] = self._point(self.ascendant)
+            planets["mc"] = self._point(self.mc)
+            self._view = {
+                "planets": planets,
+                "houses": [self._point(cusp) for cusp in self.cusps],
+                "metadata": self.metadata,
+            }
+        return self._view
+
+    # Совместимость со словарным результатом AstroCalculator.calculate
+    def __getitem__(self, key: str):
+        return self.to_dict()[key]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.to_dict()
+
+    def get(self, key: str, default=None):
+        return self.to_dict().get(key, default)
+
+    def keys(self):
+        return self.to_dict().keys()
+
+    def to_bytes(self) -> bytes:
+        return b"".join((
+            _HEADER.pack(self.jd, self.lat, self.lon, self.ascendant,
+                         self.mc),
+            self.longitudes.tobytes(),
+            self.speeds.tobytes(),
+            self.cusps.tobytes(),
+            json.dumps(self.metadata, ensure_ascii=False,
+                       separators=(",", ":")).encode("utf-8"),
+        ))
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "Chart":
+        jd, lat, lon, ascendant, mc = _HEADER.unpack_from(data)
+        offset = _HEADER.size
+        bodies = array("d")
+        bodies.frombytes(data[offset:offset + _BODY_ARRAYS.size])
+        offset += _BODY_ARRAYS.size
+        cusps = array("d")
+        cusps.frombytes(data[offset:offset + _CUSPS.size])
+        offset += _CUSPS.size
+        metadata = json.loads(data[offset:]) if len(data) > offset else {}
+        return cls(jd, lat, lon, bodies[:len(BODIES)], bodies[len(BODIES):],
+                   cusps, ascendant, mc, metadata)
+
+    def __reduce__(self):
+        return (Chart.from_bytes, (self.to_bytes(), ))
+
+    def __repr__(self) -> str:
+        return (f"Chart(jd={self.jd:.5f}, sun={self.sign('sun')}, "
+                f"moon={self.sign('moon')}, asc={sign_of(self.ascendant)})")
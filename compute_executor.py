@@ -0,0 +1,174 @@
+import asyncio
+import contextvars
+import gc
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+import swisseph as swe
+
+import log_setup
+import metrics
+from astro_engine import AstroCalculator, timezone_finder
+from chart import Chart
+
+logger = logging.getLogger(__name__)
+
+# Калькулятор процесса-воркера: каждый процесс держит свой экземпляр
+_worker_calculator: Optional[AstroCalculator] = None
+
+
+def _init_worker(factory: Callable[[], AstroCalculator], log_queue=None):
+    global _worker_calculator
+    if log_queue is not None:
+        log_setup.setup_child(log_queue)
+    _worker_calculator = factory()
+    _worker_calculator.warm_up()
+
+
+def _started() -> bool:
+    return True
+
+
+def _run(request_id: str, method: str, *args):
+    """Вызов в процессе пула; замеры этапов возвращаются вместе с
+    результатом, чтобы основной процесс учел их в своих метриках"""
+    log_setup.request_id.set(request_id)
+    with metrics.capture() as spans:
+        try:
+            return getattr(_worker_calculator, method)(*args), spans, None
+        except Exception as e:
+            return None, spans, e
+
+
+class ComputeQueueFull(RuntimeError):
+    """Очередь расчетов переполнена — запрос отклонен"""
+
+
+class ComputeExecutor:
+    """Выполняет расчеты AstroCalculator вне цикла событий.
+
+    mode="thread" — пул потоков с одним общим калькулятором (настройки
+    Swiss Ephemeris у каждого потока свои, поэтому путь к эфемеридам
+    задается в каждом потоке пула), mode="process" — пул процессов, в
+    каждом свой калькулятор из factory.
+    Калькуляторы создаются при первом расчете или в warm_up().
+    Одновременно в работе и очереди не больше max_pending задач; если место
+    не освободилось за submit_timeout секунд, выбрасывается ComputeQueueFull.
+    """
+
+    def __init__(self,
+                 factory: Callable[[], AstroCalculator],
+                 mode: str = "thread",
+                 workers: Optional[int] = None,
+                 max_pending: int = 64,
+                 submit_timeout: float = 10.0):
+        if mode not in ("thread", "process"):
+            raise ValueError(f"Неизвестный режим пула: {mode}")
+        self.mode = mode
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.submit_timeout = submit_timeout
+        self._slots = asyncio.Semaphore(max_pending)
+        self._factory = factory
+        self._calculator: Optional[AstroCalculator] = None
+        self._calculator_lock = threading.Lock()
+        if mode == "process":
+            # fork: воркеры наследуют загруженные в warm_up данные
+            context = (multiprocessing.get_context("fork") if "fork"
+                       in multiprocessing.get_all_start_methods() else None)
+            self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                             mp_context=context,
+                                             initializer=_init_worker,
+                                             initargs=(
+                                                 factory,
+                                                 log_setup.child_queue()))
+        else:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers,
+                                            thread_name_prefix="astro",
+                                            initializer=self._init_thread)
+        logger.info("Пул расчетов: %s, воркеров: %s, очередь: %s", mode,
+                    self.workers, max_pending)
+
+    @property
+    def calculator(self) -> AstroCalculator:
+        """Общий калькулятор режима потоков"""
+        with self._calculator_lock:
+            if self._calculator is None:
+                self._calculator = self._factory()
+            return self._calculator
+
+    def _init_thread(self):
+        swe.set_ephe_path(self.calculator.ephe_path)
+
+    def _call(self, method: str, *args):
+        return getattr(self.calculator, method)(*args)
+
+    async def warm_up(self):
+        """Создает калькуляторы и загружает их данные заранее.
+
+        Загруженное живет до конца процесса, поэтому объекты процесса
+        замораживаются для сборщика мусора (gc.freeze — он больше не
+        обходит их и не трогает их страницы). В режиме процессов здесь
+        загружается TimezoneFinder и только после заморозки запускаются
+        воркеры: общие данные им достаются без копирования.
+        """
+        loop = asyncio.get_running_loop()
+        if self.mode == "thread":
+            await loop.run_in_executor(self._pool,
+                                       lambda: self.calculator.warm_up())
+        else:
+            await asyncio.to_thread(timezone_finder)
+        gc.collect()
+        gc.freeze()
+        if self.mode == "process":
+            # Первая задача запускает все воркеры, каждый прогревается сам
+            await loop.run_in_executor(self._pool, _started)
+
+    async def _submit(self, method: str, *args):
+        try:
+            with metrics.span("compute_wait"):
+                await asyncio.wait_for(self._slots.acquire(),
+                                       self.submit_timeout)
+        except asyncio.TimeoutError:
+            raise ComputeQueueFull("Очередь расчетов переполнена")
+        try:
+            loop = asyncio.get_running_loop()
+            if self.mode == "thread":
+                # Копия контекста — чтобы замеры в потоке попали в трассу
+                context = contextvars.copy_context()
+                return await loop.run_in_executor(self._pool, context.run,
+                                                  self._call, method, *args)
+            result, spans, error = await loop.run_in_executor(
+                self._pool, _run, log_setup.request_id.get(), method, *args)
+            metrics.replay(spans)
+            if error is not None:
+                raise error
+            return result
+        finally:
+            self._slots.release()
+
+    async def calculate_async(self, date_str: str, time_str: str,
+                              place: str) -> Dict[str, Any]:
+        return await self._submit("calculate", date_str, time_str, place)
+
+    async def compute_chart_async(self, jd: float, lat: float,
+                                  lon: float) -> Chart:
+        return await self._submit("compute_chart", jd, lat, lon)
+
+    async def calculate_compatibility_async(self, person1: dict,
+                                            person2: dict) -> dict:
+        """Как AstroCalculator.calculate_compatibility, но обе карты
+        считаются параллельно"""
+        data1, data2 = await asyncio.gather(
+            self.calculate_async(person1['date_str'], person1['time_str'],
+                                 person1['place']),
+            self.calculate_async(person2['date_str'], person2['time_str'],
+                                 person2['place']))
+        return AstroCalculator.compare(data1, data2)
+
+    def shutdown(self, wait: bool = True):
+        self._pool.shutdown(wait=wait, cancel_futures=not wait)
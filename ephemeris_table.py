@@ -0,0 +1,216 @@
+"""Предрасчитанная таблица эфемерид для быстрых поисков долгот.
+
+Долготы и скорости тел хранятся с шагом в сутки в файле .npy (формы
+дни × тела × 2), который открывается через mmap и делится между процессами.
+Между узлами позиция восстанавливается кубическим полиномом Эрмита по
+долготам и скоростям на концах шага. При сборке точность проверяется на
+случайных моментах против живого Swiss Ephemeris; максимальная ошибка
+сохраняется в метаданных рядом с таблицей.
+
+    python ephemeris_table.py build ephemeris.npy --start 1900 --end 2100
+    python ephemeris_table.py report ephemeris.npy --samples 5000
+"""
+import argparse
+import json
+import logging
+import math
+import time
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import swisseph as swe
+
+logger = logging.getLogger(__name__)
+
+# Тела таблицы (без Хирона: ему нужны отдельные файлы астероидов)
+TABLE_BODIES = (swe.SUN, swe.MOON, swe.MERCURY, swe.VENUS, swe.MARS,
+                swe.JUPITER, swe.SATURN, swe.URANUS, swe.NEPTUNE, swe.PLUTO,
+                swe.TRUE_NODE)
+
+
+def _meta_path(path: str) -> str:
+    return path[:-4] + ".json" if path.endswith(".npy") else path + ".json"
+
+
+class EphemerisTable:
+    """Таблица долгот с интерполяцией Эрмита; поиск за O(1)"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(_meta_path(path), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.data = np.load(path, mmap_mode="r")
+        self.start_jd = self.meta["start_jd"]
+        self.step = self.meta["step"]
+        self.end_jd = self.start_jd + self.step * (len(self.data) - 1)
+        self.columns = {
+            planet_id: i
+            for i, planet_id in enumerate(self.meta["bodies"])
+        }
+        # Плоское представление для скалярных поисков без накладных
+        # расходов NumPy: [день][тело][долгота, скорость]
+        self._flat = memoryview(self.data).cast("B").cast("d")
+        self._row = 2 * len(self.columns)
+        # Максимальная ошибка долготы по всем телам, угловые секунды
+        self.error_bound = max(self.meta["max_error_arcsec"].values(),
+                               default=math.inf)
+
+    def covers(self, jd: float, planet_id: int) -> bool:
+        return (planet_id in self.columns
+                and self.start_jd <= jd < self.end_jd)
+
+    def _interpolate(self, jd, columns):
+        t = (np.asarray(jd, dtype=np.float64) - self.start_jd) / self.step
+        i = np.clip(np.floor(t).astype(np.int64), 0, len(self.data) - 2)
+        u = (t - i)[..., None]
+        i = i[..., None]
+        p0 = self.data[i, columns, 0]
+        p1 = self.data[i + 1, columns, 0]
+        v0 = self.data[i, columns, 1] * self.step
+        v1 = self.data[i + 1, columns, 1] * self.step
+        delta = (p1 - p0 + 180.0) % 360.0 - 180.0
+        u2, u3 = u * u, u * u * u
+        lon = (p0 + (u3 - 2 * u2 + u) * v0 + (3 * u2 - 2 * u3) * delta +
+               (u3 - u2) * v1)
+        speed = ((6 * u - 6 * u2) * delta + (3 * u2 - 4 * u + 1) * v0 +
+                 (3 * u2 - 2 * u) * v1) / self.step
+        return lon % 360.0, speed
+
+    def position(self, jd: float, planet_id: int) -> Tuple[float, float]:
+        """(долгота, скорость в градусах в сутки) тела на момент jd (UT)"""
+        t = (jd - self.start_jd) / self.step
+        i = min(max(int(t), 0), len(self.data) - 2)
+        u = t - i
+        base = i * self._row + 2 * self.columns[planet_id]
+        flat = self._flat
+        p0, v0 = flat[base], flat[base + 1] * self.step
+        p1, v1 = flat[base + self._row], flat[base + self._row + 1] * self.step
+        delta = (p1 - p0 + 180.0) % 360.0 - 180.0
+        u2 = u * u
+        u3 = u2 * u
+        lon = (p0 + (u3 - 2 * u2 + u) * v0 + (3 * u2 - 2 * u3) * delta +
+               (u3 - u2) * v1)
+        speed = ((6 * u - 6 * u2) * delta + (3 * u2 - 4 * u + 1) * v0 +
+                 (3 * u2 - 2 * u) * v1) / self.step
+        return lon % 360.0, speed
+
+    def positions(self, jds) -> Tuple[np.ndarray, np.ndarray]:
+        """Долготы и скорости всех тел таблицы для массива jd: (N, тела)"""
+        columns = list(range(len(self.columns)))
+        jds = np.asarray(jds, dtype=np.float64)
+        return self._interpolate(jds.reshape(-1), columns)
+
+
+def _live(jd: float, planet_id: int, flags: int) -> Tuple[float, float]:
+    xx, _ = swe.calc_ut(jd, planet_id, flags)
+    return xx[0], xx[3]
+
+
+def ephemeris_source(flags: int = swe.FLG_SWIEPH) -> str:
+    """Какие эфемериды реально используются: swiss или moshier"""
+    _, retflag = swe.calc_ut(2451545.0, swe.SUN, flags)
+    return "moshier" if retflag & swe.FLG_MOSEPH else "swiss"
+
+
+def accuracy_report(table: EphemerisTable,
+                    samples: int = 5000,
+                    seed: int = 0) -> Dict[str, float]:
+    """Максимальная ошибка долготы (угл. сек.) по каждому телу на samples
+    случайных моментах против Swiss Ephemeris"""
+    rng = np.random.default_rng(seed)
+    jds = rng.uniform(table.start_jd, table.end_jd, samples)
+    lon, _ = table.positions(jds)
+    flags = table.meta["flags"]
+    report = {}
+    for planet_id, column in table.columns.items():
+        live = np.array([_live(jd, planet_id, flags)[0] for jd in jds])
+        error = np.abs((lon[:, column] - live + 180.0) % 360.0 - 180.0)
+        report[swe.get_planet_name(planet_id)] = float(error.max() * 3600)
+    return report
+
+
+def build(path: str,
+          start_year: int = 1900,
+          end_year: int = 2100,
+          samples: int = 5000,
+          ephe_path: str = "."):
+    swe.set_ephe_path(ephe_path)
+    flags = swe.FLG_SWIEPH | swe.FLG_SPEED
+    source = ephemeris_source(flags)
+    if source == "moshier":
+        logger.warning("Файлы Swiss Ephemeris не найдены, таблица строится "
+                       "по аналитической теории Moshier")
+    started = time.time()
+    start_jd = swe.julday(start_year, 1, 1, 0.0)
+    end_jd = swe.julday(end_year + 1, 1, 1, 0.0)
+    days = int(end_jd - start_jd) + 1
+    data = np.empty((days, len(TABLE_BODIES), 2), dtype=np.float64)
+    for day in range(days):
+        jd = start_jd + day
+        for column, planet_id in enumerate(TABLE_BODIES):
+            data[day, column] = _live(jd, planet_id, flags)
+    np.save(path, data)
+    meta = {
+        "start_jd": start_jd,
+        "step": 1.0,
+        "bodies": list(TABLE_BODIES),
+        "flags": flags,
+        "source": source,
+        "built_at": int(time.time()),
+        "max_error_arcsec": {},
+    }
+    with open(_meta_path(path), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+
+    table = EphemerisTable(path)
+    report = accuracy_report(table, samples)
+    meta["max_error_arcsec"] = report
+    with open(_meta_path(path), "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=1)
+    logger.info("Таблица эфемерид: %s дней × %s тел за %.0f с, источник %s",
+                days, len(TABLE_BODIES), time.time() - started, source)
+    return report
+
+
+def load_if_exists(path: Optional[str],
+                   max_error_arcsec: float = 1.0
+                   ) -> Optional[EphemerisTable]:
+    """Открывает таблицу, если файл есть и его точность не хуже заданной"""
+    if not path:
+        return None
+    try:
+        table = EphemerisTable(path)
+    except FileNotFoundError:
+        return None
+    if table.error_bound > max_error_arcsec:
+        logger.warning("Таблица эфемерид %s не используется: ошибка "
+                       "%.2f\" > %s\"", path, table.error_bound,
+                       max_error_arcsec)
+        return None
+    return table
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    build_cmd = commands.add_parser("build", help="построить таблицу")
+    build_cmd.add_argument("path", help="файл .npy")
+    build_cmd.add_argument("--start", type=int, default=1900)
+    build_cmd.add_argument("--end", type=int, default=2100)
+    build_cmd.add_argument("--samples", type=int, default=5000)
+    build_cmd.add_argument("--ephe-path", default=".")
+    report_cmd = commands.add_parser("report",
+                                     help="сверка с Swiss Ephemeris")
+    report_cmd.add_argument("path")
+    report_cmd.add_argument("--samples", type=int, default=5000)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        report = build(args.path, args.start, args.end, args.samples,
+                       args.ephe_path)
+    else:
+        report = accuracy_report(EphemerisTable(args.path), args.samples)
+    for body, error in report.items():
+        print(f"{body:>12}: {error:8.4f}\"")
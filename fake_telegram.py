@@ -0,0 +1,255 @@
+"""Поддельный сервер Bot API для локальных проверок.
+
+Отвечает на методы, которыми пользуется бот (getMe, sendMessage,
+editMessageText, setWebhook, deleteWebhook, getUpdates), запоминает все
+вызовы и умеет доставлять боту обновления — в вебхук или через getUpdates.
+Бот направляется на сервер переменной TELEGRAM_API_SERVER.
+
+Проверка вебхука: сервер ждет, пока бот установит вебхук, затем 200 чатов
+отправляют /start и сервер ждет ответа каждому:
+
+    python fake_telegram.py --port 8081 --chats 200 &
+    TELEGRAM_API_SERVER=http://127.0.0.1:8081 \\
+        WEBHOOK_URL=http://127.0.0.1:8080/webhook python webhook.py
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+BOT_USER = {
+    "id": 42,
+    "is_bot": True,
+    "first_name": "FakeAscendBot",
+    "username": "fake_ascend_bot",
+}
+
+
+def make_update(update_id: int, chat_id: int, text: str) -> Dict[str, Any]:
+    """Обновление с текстовым сообщением из личного чата chat_id"""
+    user = {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {
+                "id": chat_id,
+                "type": "private"
+            },
+            "from": user,
+            "text": text,
+        },
+    }
+
+
+class FakeTelegram:
+    """Сервер Bot API в памяти.
+
+    calls — все вызовы методов [(метод, параметры, время)],
+    replies[chat_id] — тексты отправленных и исправленных сообщений.
+    retry_after_every > 0 — каждый такой по счету sendMessage отвечает 429,
+    latency — задержка ответа на каждый вызов в секундах.
+    """
+
+    def __init__(self,
+                 host: str = "127.0.0.1",
+                 port: int = 8081,
+                 retry_after_every: int = 0,
+                 latency: float = 0.0):
+        self.host = host
+        self.port = port
+        self.retry_after_every = retry_after_every
+        self.latency = latency
+        self.calls: List[tuple] = []
+        self.replies: Dict[int, List[str]] = defaultdict(list)
+        self.reply_event = asyncio.Event()
+        self._message_ids = itertools.count(1000)
+        self._update_ids = itertools.count(1)
+        self._updates: asyncio.Queue = asyncio.Queue()
+        self._sends = 0
+        self.webhook_url: Optional[str] = None
+        self.webhook_set = asyncio.Event()
+        self.webhook_secret: Optional[str] = None
+        self._runner: Optional[web.AppRunner] = None
+        self._http: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def _message(self, chat_id: int, text: str,
+                 message_id: Optional[int] = None) -> Dict[str, Any]:
+        return {
+            "message_id": message_id or next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {
+                "id": chat_id,
+                "type": "private" if chat_id > 0 else "group"
+            },
+            "from": BOT_USER,
+            "text": text,
+        }
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        if not params and request.can_read_body:
+            params = await request.json()
+        self.calls.append((method, params, time.monotonic()))
+        if self.latency and method != "getUpdates":
+            await asyncio.sleep(self.latency)
+        result: Any = True
+        if method == "getMe":
+            result = BOT_USER
+        elif method == "sendMessage":
+            self._sends += 1
+            if self.retry_after_every and (self._sends %
+                                           self.retry_after_every == 0):
+                return web.json_response(
+                    {
+                        "ok": False,
+                        "error_code": 429,
+                        "description": "Too Many Requests: retry after 1",
+                        "parameters": {
+                            "retry_after": 1
+                        },
+                    },
+                    status=429)
+            chat_id = int(params["chat_id"])
+            self.replies[chat_id].append(params["text"])
+            self.reply_event.set()
+            result = self._message(chat_id, params["text"])
+        elif method == "editMessageText":
+            chat_id = int(params["chat_id"])
+            self.replies[chat_id].append(params["text"])
+            self.reply_event.set()
+            result = self._message(chat_id, params["text"],
+                                   int(params["message_id"]))
+        elif method == "setWebhook":
+            self.webhook_url = params.get("url")
+            self.webhook_secret = params.get("secret_token")
+            self.webhook_set.set()
+        elif method == "deleteWebhook":
+            self.webhook_url = None
+        elif method == "getUpdates":
+            result = await self._get_updates(float(params.get("timeout", 0)))
+        return web.json_response({"ok": True, "result": result})
+
+    async def _get_updates(self, timeout: float) -> List[Dict[str, Any]]:
+        updates = []
+        try:
+            updates.append(await asyncio.wait_for(self._updates.get(),
+                                                  timeout))
+        except asyncio.TimeoutError:
+            return updates
+        while not self._updates.empty() and len(updates) < 100:
+            updates.append(self._updates.get_nowait())
+        return updates
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self._http = aiohttp.ClientSession()
+        logger.info("Поддельный Bot API: %s", self.base_url)
+
+    async def stop(self):
+        if self._http is not None:
+            await self._http.close()
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def send_update(self,
+                          chat_id: int,
+                          text: str,
+                          webhook: Optional[str] = None,
+                          secret: Optional[str] = None) -> int:
+        """Доставляет сообщение пользователя боту: в вебхук (webhook или
+        установленный ботом), иначе в очередь getUpdates. Возвращает HTTP
+        статус вебхука (200 для getUpdates)"""
+        update = make_update(next(self._update_ids), chat_id, text)
+        url = webhook or self.webhook_url
+        if url is None:
+            await self._updates.put(update)
+            return 200
+        headers = {}
+        secret = secret or self.webhook_secret
+        if secret:
+            headers["X-Telegram-Bot-Api-Secret-Token"] = secret
+        async with self._http.post(url, json=update,
+                                   headers=headers) as response:
+            return response.status
+
+    async def wait_replies(self, chat_ids, count: int = 1,
+                           timeout: float = 30.0) -> bool:
+        """Ждет, пока каждый из chat_ids получит не меньше count ответов"""
+        deadline = time.monotonic() + timeout
+        while True:
+            if all(len(self.replies[chat_id]) >= count
+                   for chat_id in chat_ids):
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            self.reply_event.clear()
+            try:
+                await asyncio.wait_for(self.reply_event.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--webhook",
+                        help="адрес вебхука (по умолчанию — установленный "
+                        "ботом через setWebhook)")
+    parser.add_argument("--secret", default=None)
+    parser.add_argument("--chats", type=int, default=0,
+                        help="сколько чатов отправят /start")
+    parser.add_argument("--retry-after-every", type=int, default=0)
+    args = parser.parse_args()
+
+    async def main():
+        server = FakeTelegram(port=args.port,
+                              retry_after_every=args.retry_after_every)
+        await server.start()
+        try:
+            if args.chats:
+                if not args.webhook:
+                    await server.webhook_set.wait()
+                chat_ids = range(1, args.chats + 1)
+                started = time.monotonic()
+                statuses = await asyncio.gather(*(server.send_update(
+                    chat_id, "/start", args.webhook, args.secret)
+                                                  for chat_id in chat_ids))
+                ok = await server.wait_replies(chat_ids)
+                print(
+                    json.dumps(
+                        {
+                            "chats": args.chats,
+                            "accepted": statuses.count(200),
+                            "all_replied": ok,
+                            "seconds": round(time.monotonic() - started, 3),
+                        },
+                        ensure_ascii=False))
+            else:
+                await asyncio.Event().wait()
+        finally:
+            await server.stop()
+
+    asyncio.run(main())
@@ -0,0 +1,163 @@
+"""Хранилище состояний диалогов (FSM aiogram) в SQLite.
+
+Состояние и данные каждого ключа лежат одной строкой таблицы fsm (данные —
+компактный JSON). Недавно использованные ключи держатся в LRU в памяти;
+изменения копятся и пишутся одной транзакцией раз в flush_interval секунд.
+Пустые состояния (после state.clear()) удаляются, а брошенные на полпути
+диалоги удаляются после ttl секунд без активности, поэтому ни память, ни
+файл не растут со временем. После перезапуска пользователь продолжает
+диалог с того же шага.
+"""
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+logger = logging.getLogger(__name__)
+
+
+def _key(key: StorageKey) -> str:
+    return (f"{key.bot_id}:{key.chat_id}:{key.user_id}:"
+            f"{key.thread_id or ''}:{key.business_connection_id or ''}:"
+            f"{key.destiny}")
+
+
+class SQLiteStorage(BaseStorage):
+
+    def __init__(self,
+                 path: str = "fsm.sqlite3",
+                 max_memory_entries: int = 4096,
+                 ttl: float = 7 * 24 * 3600,
+                 flush_interval: float = 1.0,
+                 purge_interval: float = 3600.0):
+        self.max_memory_entries = max_memory_entries
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.purge_interval = purge_interval
+        # key -> [state, data, updated_at]
+        self._memory: "OrderedDict[str, list]" = OrderedDict()
+        self._dirty = set()
+        self._flusher: Optional[asyncio.Task] = None
+        self._last_purge = 0.0
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        # Один файл могут делить процессы вебхука
+        self._db.execute("PRAGMA busy_timeout=5000")
+        self._db.execute("CREATE TABLE IF NOT EXISTS fsm ("
+                         "key TEXT PRIMARY KEY, state TEXT, data TEXT, "
+                         "updated_at REAL NOT NULL) WITHOUT ROWID")
+        self._db.execute("CREATE INDEX IF NOT EXISTS fsm_updated_at "
+                         "ON fsm (updated_at)")
+        self._db.commit()
+        self._purge()
+
+    def _entry(self, key: StorageKey) -> list:
+        name = _key(key)
+        now = time.time()
+        entry = self._memory.get(name)
+        if entry is None:
+            row = self._db.execute(
+                "SELECT state, data, updated_at FROM fsm WHERE key = ?",
+                (name, )).fetchone()
+            if row is not None:
+                entry = [row[0], json.loads(row[1]) if row[1] else {}, row[2]]
+            else:
+                entry = [None, {}, now]
+            self._memory[name] = entry
+            self._evict()
+        else:
+            self._memory.move_to_end(name)
+        if entry[2] < now - self.ttl:
+            # Диалог брошен слишком давно — начинаем с чистого листа
+            entry[0], entry[1] = None, {}
+        return entry
+
+    def _touch(self, key: StorageKey, entry: list):
+        entry[2] = time.time()
+        self._dirty.add(_key(key))
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_later())
+
+    def _evict(self):
+        """Вытесняет давно не использованные ключи; несохраненные остаются
+        в памяти до записи"""
+        while len(self._memory) > self.max_memory_entries:
+            name = next(iter(self._memory))
+            if name in self._dirty:
+                break
+            del self._memory[name]
+
+    async def set_state(self, key: StorageKey, state: StateType = None):
+        entry = self._entry(key)
+        entry[0] = state.state if isinstance(state, State) else state
+        self._touch(key, entry)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return self._entry(key)[0]
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]):
+        entry = self._entry(key)
+        entry[1] = dict(data)
+        self._touch(key, entry)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict(self._entry(key)[1])
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self.flush()
+
+    def flush(self):
+        """Записывает накопленные изменения одной транзакцией"""
+        if not self._dirty:
+            return
+        upserts, deletes = [], []
+        for name in self._dirty:
+            entry = self._memory.get(name)
+            if entry is None:
+                continue
+            state, data, updated_at = entry
+            if state is None and not data:
+                deletes.append((name, ))
+            else:
+                upserts.append(
+                    (name, state,
+                     json.dumps(data, ensure_ascii=False,
+                                separators=(",", ":")), updated_at))
+        self._dirty.clear()
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO fsm (key, state, data, updated_at) "
+                "VALUES (?, ?, ?, ?)", upserts)
+            self._db.executemany("DELETE FROM fsm WHERE key = ?", deletes)
+        self._evict()
+        if time.time() - self._last_purge >= self.purge_interval:
+            self._purge()
+
+    def _purge(self):
+        """Удаляет диалоги без активности дольше ttl"""
+        cutoff = time.time() - self.ttl
+        with self._db:
+            removed = self._db.execute("DELETE FROM fsm WHERE updated_at < ?",
+                                       (cutoff, )).rowcount
+        for name in [
+                name for name, entry in self._memory.items()
+                if entry[2] < cutoff and name not in self._dirty
+        ]:
+            del self._memory[name]
+        self._last_purge = time.time()
+        if removed:
+            logger.info("Удалено брошенных диалогов: %s", removed)
+
+    async def close(self):
+        if self._flusher is not None and not self._flusher.done():
+            self._flusher.cancel()
+        self.flush()
+        self._db.close()
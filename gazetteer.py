@@ -0,0 +1,325 @@
+"""Локальный справочник городов вместо сетевого геокодинга.
+
+Индекс строится из дампа GeoNames (cities500.txt / cities15000.txt) и
+хранится в каталоге из нескольких файлов, которые открываются через mmap:
+
+    entries.npy      координаты, население, индексы пояса и страны
+    keys.bin         отсортированные нормализованные названия (UTF-8)
+    key_offsets.npy  границы названий в keys.bin
+    key_entry.npy    номер города для каждого названия
+    tri_*.npy        триграммный индекс названий для нечеткого поиска
+    meta.json        списки часовых поясов и стран, синонимы стран
+
+Сборка индекса:
+
+    python gazetteer.py build cities15000.txt gazetteer [--country-info countryInfo.txt]
+"""
+import argparse
+import bisect
+import json
+import logging
+import mmap
+import os
+import re
+import time
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ENTRY_DTYPE = np.dtype([("lat", "<f4"), ("lon", "<f4"),
+                        ("population", "<u4"), ("tz", "<u2"),
+                        ("country", "<u2")])
+
+# Названия стран, которые пользователи чаще всего пишут по-русски
+COUNTRY_ALIASES = {
+    "россия": "RU", "рф": "RU", "российская федерация": "RU",
+    "украина": "UA", "беларусь": "BY", "белоруссия": "BY",
+    "казахстан": "KZ", "узбекистан": "UZ", "кыргызстан": "KG",
+    "киргизия": "KG", "таджикистан": "TJ", "туркменистан": "TM",
+    "азербайджан": "AZ", "армения": "AM", "грузия": "GE",
+    "молдова": "MD", "молдавия": "MD", "латвия": "LV", "литва": "LT",
+    "эстония": "EE", "германия": "DE", "франция": "FR", "италия": "IT",
+    "испания": "ES", "польша": "PL", "чехия": "CZ", "израиль": "IL",
+    "турция": "TR", "сша": "US", "великобритания": "GB", "англия": "GB",
+    "китай": "CN", "япония": "JP", "индия": "IN", "канада": "CA",
+    "usa": "US", "uk": "GB", "russian federation": "RU",
+}
+
+_NAME_RE = re.compile(r"^[0-9a-zа-я' ]+$")
+
+
+def normalize_name(name: str) -> str:
+    name = name.lower().replace("ё", "е")
+    name = re.sub(r"[-‐–—_.,()\"«»]", " ", name)
+    return " ".join(name.split())
+
+
+def trigrams(key: str) -> List[int]:
+    padded = f"  {key} "
+    return sorted({
+        zlib.crc32(padded[i:i + 3].encode("utf-8"))
+        for i in range(len(padded) - 2)
+    })
+
+
+class Gazetteer:
+    """Поиск города по названию: точное совпадение, префикс, триграммы.
+
+    Уточнения через запятую понимаются, только если это страны
+    («Париж, Франция»). Возвращает (lat, lon, tz) или None, если уверенного
+    совпадения нет или уточнение незнакомо («Париж, Техас») — тогда
+    вызывающий код обращается к сетевому геокодеру.
+    """
+
+    def __init__(self, path: str, min_similarity: float = 0.75):
+        self.path = path
+        self.min_similarity = min_similarity
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        self.timezones = meta["timezones"]
+        self.countries = meta["countries"]
+        country_index = {code: i for i, code in enumerate(self.countries)}
+        self.country_aliases = {
+            alias: country_index[code]
+            for alias, code in {**meta["country_aliases"],
+                                **COUNTRY_ALIASES}.items()
+            if code in country_index
+        }
+
+        def load(name):
+            return np.load(os.path.join(path, name), mmap_mode="r")
+
+        self.entries = load("entries.npy")
+        self.key_offsets = load("key_offsets.npy")
+        self.key_entry = load("key_entry.npy")
+        self.key_trigrams = load("key_trigrams.npy")
+        self.tri_hashes = load("tri_hashes.npy")
+        self.tri_offsets = load("tri_offsets.npy")
+        self.tri_postings = load("tri_postings.npy")
+        with open(os.path.join(path, "keys.bin"), "rb") as f:
+            self._keys = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._sorted_keys = _KeyView(self._keys, self.key_offsets)
+        logger.info("Справочник городов: %s городов, %s названий",
+                    len(self.entries), len(self._sorted_keys))
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _result(self, entry_id: int) -> Tuple[float, float, str]:
+        entry = self.entries[entry_id]
+        return (float(entry["lat"]), float(entry["lon"]),
+                self.timezones[int(entry["tz"])])
+
+    def _best(self, key_ids, country: Optional[int]) -> Optional[int]:
+        entry_ids = np.asarray(self.key_entry[key_ids])
+        if country is not None:
+            entry_ids = entry_ids[self.entries["country"][entry_ids] ==
+                                  country]
+        if len(entry_ids) == 0:
+            return None
+        populations = self.entries["population"][entry_ids]
+        return int(entry_ids[int(np.argmax(populations))])
+
+    def _fuzzy(self, key: str, country: Optional[int]) -> Optional[int]:
+        query = np.array(trigrams(key), dtype="<u4")
+        pos = np.searchsorted(self.tri_hashes, query)
+        pos = np.minimum(pos, len(self.tri_hashes) - 1)
+        pos = pos[self.tri_hashes[pos] == query]
+        if len(pos) == 0:
+            return None
+        postings = np.concatenate([
+            self.tri_postings[self.tri_offsets[p]:self.tri_offsets[p + 1]]
+            for p in pos
+        ])
+        key_ids, common = np.unique(postings, return_counts=True)
+        similarity = 2.0 * common / (len(query) + self.key_trigrams[key_ids])
+        good = similarity >= self.min_similarity
+        if not good.any():
+            return None
+        key_ids, similarity = key_ids[good], similarity[good]
+        # Сначала по похожести, при равенстве — по населению
+        order = np.lexsort((-self.entries["population"][
+            self.key_entry[key_ids]].astype(np.int64), -similarity))
+        for key_id in key_ids[order]:
+            entry_id = self._best([key_id], country)
+            if entry_id is not None:
+                return entry_id
+        return None
+
+    def lookup(self, place: str) -> Optional[Tuple[float, float, str]]:
+        parts = [normalize_name(part) for part in place.split(",")]
+        parts = [part for part in parts if part]
+        if not parts:
+            return None
+        key, qualifiers = parts[0], parts[1:]
+        country = None
+        for qualifier in qualifiers:
+            if qualifier not in self.country_aliases:
+                # Штат, область или незнакомая страна: справочник их не
+                # различает, и самый крупный тезка был бы ошибкой
+                return None
+            country = self.country_aliases[qualifier]
+
+        encoded = key.encode("utf-8")
+        lo = bisect.bisect_left(self._sorted_keys, encoded)
+        hi = bisect.bisect_right(self._sorted_keys, encoded, lo)
+        entry_id = self._best(np.arange(lo, hi), country) if hi > lo else None
+
+        if entry_id is None and len(key) >= 4:
+            # Недописанное название: «екатеринб» -> «екатеринбург»
+            end = bisect.bisect_left(self._sorted_keys, encoded + b"\xff", lo)
+            if 0 < end - lo <= 64:
+                entry_id = self._best(np.arange(lo, end), country)
+
+        if entry_id is None:
+            entry_id = self._fuzzy(key, country)
+        if entry_id is None:
+            return None
+        return self._result(entry_id)
+
+    def close(self):
+        self._keys.close()
+
+
+class _KeyView:
+    """Последовательность названий из keys.bin для bisect"""
+
+    def __init__(self, blob, offsets):
+        self._blob = blob
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        return self._blob[int(self._offsets[i]):int(self._offsets[i + 1])]
+
+
+def _read_country_info(path: str) -> Dict[str, str]:
+    aliases = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            cols = line.rstrip("\n").split("\t")
+            if len(cols) > 4 and cols[4]:
+                aliases[normalize_name(cols[4])] = cols[0]
+    return aliases
+
+
+def build(source: str, out_dir: str, country_info: Optional[str] = None):
+    """Собирает индекс из дампа GeoNames"""
+    started = time.time()
+    tz_finder = None
+    timezones, tz_index = [], {}
+    countries, country_index = [], {}
+    entries = []
+    names = []  # (key, entry_id)
+
+    with open(source, encoding="utf-8") as f:
+        for line in f:
+            cols = line.rstrip("\n").split("\t")
+            if len(cols) < 18 or cols[6] != "P":
+                continue
+            lat, lon = float(cols[4]), float(cols[5])
+            tz = cols[17]
+            if not tz:
+                if tz_finder is None:
+                    from timezonefinder import TimezoneFinder
+                    tz_finder = TimezoneFinder()
+                tz = tz_finder.timezone_at(lat=lat, lng=lon)
+                if not tz:
+                    continue
+            if tz not in tz_index:
+                tz_index[tz] = len(timezones)
+                timezones.append(tz)
+            code = cols[8]
+            if code not in country_index:
+                country_index[code] = len(countries)
+                countries.append(code)
+
+            entry_id = len(entries)
+            entries.append((lat, lon, min(int(cols[14] or 0), 2**32 - 1),
+                            tz_index[tz], country_index[code]))
+            keys = {normalize_name(cols[1]), normalize_name(cols[2])}
+            for alt in cols[3].split(",") if cols[3] else ():
+                alt = normalize_name(alt)
+                if 0 < len(alt) <= 64 and _NAME_RE.match(alt):
+                    keys.add(alt)
+            names.extend((key.encode("utf-8"), entry_id) for key in keys
+                         if key)
+
+    names.sort()
+    os.makedirs(out_dir, exist_ok=True)
+
+    np.save(os.path.join(out_dir, "entries.npy"),
+            np.array(entries, dtype=ENTRY_DTYPE))
+    with open(os.path.join(out_dir, "keys.bin"), "wb") as f:
+        f.write(b"".join(key for key, _ in names))
+    np.save(os.path.join(out_dir, "key_offsets.npy"),
+            np.cumsum([0] + [len(key) for key, _ in names], dtype="<u8"))
+    np.save(os.path.join(out_dir, "key_entry.npy"),
+            np.array([entry_id for _, entry_id in names], dtype="<u4"))
+
+    postings: Dict[int, List[int]] = {}
+    key_trigrams = np.empty(len(names), dtype="<u2")
+    for key_id, (key, _) in enumerate(names):
+        grams = trigrams(key.decode("utf-8"))
+        key_trigrams[key_id] = len(grams)
+        for gram in grams:
+            postings.setdefault(gram, []).append(key_id)
+    hashes = sorted(postings)
+    np.save(os.path.join(out_dir, "key_trigrams.npy"), key_trigrams)
+    np.save(os.path.join(out_dir, "tri_hashes.npy"),
+            np.array(hashes, dtype="<u4"))
+    np.save(
+        os.path.join(out_dir, "tri_offsets.npy"),
+        np.cumsum([0] + [len(postings[h]) for h in hashes], dtype="<u8"))
+    np.save(
+        os.path.join(out_dir, "tri_postings.npy"),
+        np.array([key_id for h in hashes for key_id in postings[h]],
+                 dtype="<u4"))
+
+    aliases = _read_country_info(country_info) if country_info else {}
+    with open(os.path.join(out_dir, "meta.json"), "w",
+              encoding="utf-8") as f:
+        json.dump(
+            {
+                "source": os.path.basename(source),
+                "built_at": int(time.time()),
+                "timezones": timezones,
+                "countries": countries,
+                "country_aliases": aliases,
+            },
+            f,
+            ensure_ascii=False)
+
+    logger.info("Справочник собран: %s городов, %s названий за %.1f с",
+                len(entries), len(names), time.time() - started)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    build_cmd = commands.add_parser("build", help="собрать индекс")
+    build_cmd.add_argument("source", help="cities*.txt из GeoNames")
+    build_cmd.add_argument("out_dir")
+    build_cmd.add_argument("--country-info", help="countryInfo.txt")
+    lookup_cmd = commands.add_parser("lookup", help="найти место")
+    lookup_cmd.add_argument("index_dir")
+    lookup_cmd.add_argument("place")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build(args.source, args.out_dir, args.country_info)
+    else:
+        gazetteer = Gazetteer(args.index_dir)
+        started = time.perf_counter()
+        result = gazetteer.lookup(args.place)
+        elapsed = (time.perf_counter() - started) * 1e6
+        print(f"{result} ({elapsed:.0f} мкс)")
@@ -0,0 +1,174 @@
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
+
+import metrics
+
+Coordinates = Tuple[float, float, str]
+
+
+class PlaceNotFound(ValueError):
+    """Место или его часовой пояс не найдены (результат кэшируется)"""
+
+
+def normalize_place(place: str) -> str:
+    """Ключ кэша: «  Москва ,россия » и «москва, Россия» дают один ключ"""
+    key = place.lower().replace("ё", "е")
+    key = re.sub(r"[\"'«»().]", " ", key)
+    parts = [" ".join(part.split()) for part in key.split(",")]
+    return ", ".join(part for part in parts if part)
+
+
+class _Flight:
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class GeoCache:
+    """Двухуровневый кэш геокодинга: LRU в памяти и SQLite на диске.
+
+    Хранит координаты и часовой пояс с TTL, отдельно (с коротким TTL)
+    запоминает ненайденные места. Одновременные запросы одного и того же
+    места выполняют только один вызов к геокодеру.
+    """
+
+    def __init__(self,
+                 path: Optional[str] = "geocache.sqlite3",
+                 max_memory_entries: int = 4096,
+                 ttl: float = 90 * 24 * 3600,
+                 negative_ttl: float = 24 * 3600):
+        self.max_memory_entries = max_memory_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # key -> (expires_at, (lat, lon, tz) | None, error | None)
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS places ("
+                             "key TEXT PRIMARY KEY, lat REAL, lon REAL, "
+                             "tz TEXT, error TEXT, expires_at REAL NOT NULL)")
+            self._db.commit()
+            self.purge_expired()
+
+    def _remember(self, key: str, entry: tuple):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _lookup(self, key: str) -> Optional[tuple]:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._memory.move_to_end(key)
+                    return entry
+                del self._memory[key]
+            if self._db is None:
+                return None
+            row = self._db.execute(
+                "SELECT lat, lon, tz, error, expires_at FROM places "
+                "WHERE key = ?", (key, )).fetchone()
+            if row is None or row[4] <= now:
+                return None
+            lat, lon, tz, error, expires_at = row
+            entry = (expires_at, None if error else (lat, lon, tz), error)
+            self._remember(key, entry)
+            return entry
+
+    def _store(self, key: str, value: Optional[Coordinates],
+               error: Optional[str]):
+        ttl = self.ttl if error is None else self.negative_ttl
+        expires_at = time.time() + ttl
+        lat, lon, tz = value if value else (None, None, None)
+        with self._lock:
+            self._remember(key, (expires_at, value, error))
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO places "
+                    "(key, lat, lon, tz, error, expires_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, lat, lon, tz, error, expires_at))
+                self._db.commit()
+
+    def get_or_compute(
+            self, place: str,
+            compute: Callable[[str], Coordinates]) -> Coordinates:
+        """Возвращает (lat, lon, tz) из кэша или вызывает compute(place).
+
+        PlaceNotFound из compute кэшируется как отрицательный результат,
+        прочие ошибки (сеть, таймауты) — нет.
+        """
+        key = normalize_place(place)
+        entry = self._lookup(key)
+        metrics.cache_result("geocode", entry is not None)
+        if entry is not None:
+            _, value, error = entry
+            if error is not None:
+                raise PlaceNotFound(error)
+            return value
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            # Предыдущий лидер мог успеть сохранить результат
+            entry = self._lookup(key)
+            if entry is not None and entry[2] is not None:
+                raise PlaceNotFound(entry[2])
+            if entry is not None:
+                flight.result = entry[1]
+                return flight.result
+            flight.result = compute(place)
+            self._store(key, flight.result, None)
+            return flight.result
+        except PlaceNotFound as e:
+            if entry is None:
+                self._store(key, None, str(e))
+            flight.error = e
+            raise
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.event.set()
+
+    def purge_expired(self) -> int:
+        """Удаляет просроченные записи с диска, возвращает их число"""
+        if self._db is None:
+            return 0
+        with self._lock:
+            cursor = self._db.execute(
+                "DELETE FROM places WHERE expires_at <= ?", (time.time(), ))
+            self._db.commit()
+            return cursor.rowcount
+
+    def close(self):
+        if self._db is not None:
+            with self._lock:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,220 @@
+"""Кэш интерпретаций ИИ по сигнатуре карты.
+
+Ключ — хэш версии шаблона запроса, вида интерпретации, шага градусов и
+сигнатуры положений (см. prompts.py). Два уровня: LRU в памяти и SQLite с
+TTL и ограничением числа записей (вытесняются давно не использованные;
+проверка при открытии и после каждых evict_every записей).
+
+Предварительное заполнение всех натальных комбинаций:
+
+    python interpretation_cache.py prewarm --bucket 30 --concurrency 4
+"""
+import argparse
+import asyncio
+import hashlib
+import itertools
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import metrics
+from prompts import PROMPT_VERSION
+
+logger = logging.getLogger(__name__)
+
+
+def cache_key(kind: str, bucket: int, signature: str) -> str:
+    raw = f"v{PROMPT_VERSION}|{kind}|{bucket}|{signature}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class InterpretationCache:
+
+    def __init__(self,
+                 path: Optional[str] = "interpretations.sqlite3",
+                 max_memory_entries: int = 2048,
+                 ttl: float = 30 * 24 * 3600,
+                 max_entries: int = 200_000,
+                 evict_every: int = 1000):
+        self.max_memory_entries = max_memory_entries
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        # key -> (expires_at, text)
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS interpretations ("
+                "key TEXT PRIMARY KEY, text TEXT NOT NULL, "
+                "expires_at REAL NOT NULL, last_used REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS "
+                             "interpretations_last_used "
+                             "ON interpretations (last_used)")
+            self._db.commit()
+            with self._lock:
+                self._evict()
+
+    def _remember(self, key: str, expires_at: float, text: str):
+        self._memory[key] = (expires_at, text)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and entry[0] > now:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                metrics.cache_result("interpretation", True)
+                return entry[1]
+            row = None
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT text, expires_at FROM interpretations "
+                    "WHERE key = ? AND expires_at > ?", (key, now)).fetchone()
+            if row is None:
+                self.misses += 1
+                metrics.cache_result("interpretation", False)
+                return None
+            self._db.execute(
+                "UPDATE interpretations SET last_used = ? WHERE key = ?",
+                (now, key))
+            self._db.commit()
+            self._remember(key, row[1], row[0])
+            self.hits += 1
+            metrics.cache_result("interpretation", True)
+            return row[0]
+
+    def contains(self, key: str) -> bool:
+        with self._lock:
+            if key in self._memory:
+                return True
+            if self._db is None:
+                return False
+            return self._db.execute(
+                "SELECT 1 FROM interpretations WHERE key = ? "
+                "AND expires_at > ?", (key, time.time())).fetchone() is not None
+
+    def set(self, key: str, text: str):
+        now = time.time()
+        expires_at = now + self.ttl
+        with self._lock:
+            self._remember(key, expires_at, text)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO interpretations "
+                    "(key, text, expires_at, last_used) VALUES (?, ?, ?, ?)",
+                    (key, text, expires_at, now))
+                self._db.commit()
+                self._writes += 1
+                if self._writes % self.evict_every == 0:
+                    self._evict()
+
+    def _evict(self):
+        """Удаляет просроченные записи и самые давно не использованные
+        сверх max_entries; вызывается под self._lock"""
+        self._db.execute("DELETE FROM interpretations WHERE expires_at <= ?",
+                         (time.time(), ))
+        self._db.execute(
+            "DELETE FROM interpretations WHERE key IN ("
+            "SELECT key FROM interpretations ORDER BY last_used DESC "
+            "LIMIT -1 OFFSET ?)", (self.max_entries, ))
+        self._db.commit()
+
+    def close(self):
+        if self._db is not None:
+            with self._lock:
+                self._db.close()
+                self._db = None
+
+
+async def prewarm(cache: InterpretationCache, ai, model: str,
+                  max_tokens: int, bucket: int, concurrency: int):
+    """Генерирует интерпретации для всех натальных комбинаций, которых еще
+    нет в кэше"""
+    from chart import SIGNS
+    from prompts import natal_prompt, signature
+
+    starts = range(0, 30, bucket)
+    point = list(itertools.product(SIGNS, starts))
+    combos = list(itertools.product(point, repeat=3))
+    semaphore = asyncio.Semaphore(concurrency)
+    done = 0
+
+    async def generate(chart):
+        nonlocal done
+        key = cache_key("natal", bucket, signature(chart))
+        if cache.contains(key):
+            return
+        async with semaphore:
+            try:
+                text = await ai.complete(natal_prompt(chart, bucket),
+                                         model=model,
+                                         max_tokens=max_tokens)
+            except Exception as e:
+                logger.error("Прогрев %s: %s", signature(chart), e)
+                return
+        cache.set(key, text)
+        done += 1
+        if done % 50 == 0:
+            logger.info("Прогрев: %s новых интерпретаций", done)
+
+    logger.info("Прогрев кэша: %s комбинаций", len(combos))
+    await asyncio.gather(*(generate(chart) for chart in combos))
+    logger.info("Прогрев завершен: %s новых интерпретаций", done)
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    from ai_client import AIClient
+
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s - %(levelname)s - %(message)s")
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    prewarm_cmd = commands.add_parser("prewarm",
+                                      help="заполнить натальные комбинации")
+    prewarm_cmd.add_argument("--db",
+                             default=os.getenv('INTERPRETATION_CACHE_PATH',
+                                               'interpretations.sqlite3'))
+    prewarm_cmd.add_argument("--bucket",
+                             type=int,
+                             default=int(
+                                 os.getenv('INTERPRETATION_DEGREE_BUCKET',
+                                           '30')))
+    prewarm_cmd.add_argument("--model",
+                             default="deepseek/deepseek-r1-0528:free")
+    prewarm_cmd.add_argument("--max-tokens", type=int, default=2000)
+    prewarm_cmd.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    async def main():
+        ai = AIClient(api_key=os.getenv('OPENROUTER_API_KEY'),
+                      base_url=os.getenv('OPENROUTER_BASE_URL',
+                                         "https://openrouter.ai/api/v1"),
+                      max_concurrency=args.concurrency)
+        cache = InterpretationCache(args.db, ttl=365 * 24 * 3600)
+        try:
+            await prewarm(cache, ai, args.model, args.max_tokens,
+                          args.bucket, args.concurrency)
+        finally:
+            cache.close()
+            await ai.close()
+
+    asyncio.run(main())
@@ -0,0 +1,190 @@
+"""Журнал, который не блокирует цикл событий.
+
+setup() оставляет у корневого логгера один обработчик — очередь; файл и
+консоль пишет отдельный поток. Если он не успевает и очередь заполнена,
+новые записи отбрасываются (счетчик astro_log_dropped_total), а не тормозят
+обработку сообщений. В файл пишется по строке JSON на запись с ротацией по
+размеру (LOG_MAX_BYTES) или по времени (LOG_ROTATE_WHEN, например
+midnight). В каждой записи есть request_id — номер обновления Telegram,
+при обработке которого она сделана.
+
+Дочерние процессы (пул расчетов, обработчики вебхука) вызывают
+setup_child(child_queue()) и отправляют записи в поток записи основного
+процесса: файл один, и ротацию делает только один процесс.
+
+Сообщения пишутся в %-стиле — logger.info("Место: %s", place): строка
+собирается только для записей нужного уровня и уже в потоке записи.
+"""
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
+from datetime import datetime, timezone
+from typing import Optional
+
+import metrics
+
+# Номер обновления Telegram, которое сейчас обрабатывается
+request_id: contextvars.ContextVar[str] = contextvars.ContextVar(
+    "request_id", default="-")
+
+TEXT_FORMAT = ("%(asctime)s - %(processName)s - %(name)s - %(levelname)s - "
+               "[%(request_id)s] %(message)s")
+
+# Аргументы этих типов можно подставить в сообщение позже, в другом потоке
+_IMMUTABLE = (str, int, float, bool, bytes, type(None))
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_child_listener: Optional[logging.handlers.QueueListener] = None
+_child_queue = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись одной строкой JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time":
+            datetime.fromtimestamp(record.created, timezone.utc).isoformat(
+                timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.processName,
+            "request_id": getattr(record, "request_id", "-"),
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Кладет запись в очередь, не собирая сообщение в потоке вызова, и
+    отбрасывает ее, если очередь полна"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        if not hasattr(record, "request_id"):
+            record.request_id = request_id.get()
+        args = record.args
+        if isinstance(args, dict):
+            args = args.values()
+        if args and not all(isinstance(arg, _IMMUTABLE) for arg in args):
+            # Изменяемые объекты могут поменяться до записи
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            # Трассировка держит кадры стека живыми — собираем ее сразу
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.LOG_DROPPED.inc()
+
+
+class _QueueListener(logging.handlers.QueueListener):
+
+    def enqueue_sentinel(self):
+        # Очередь может быть полна — стоп-сигнал ждет места
+        self.queue.put(self._sentinel)
+
+
+def _file_handler(path: str) -> logging.Handler:
+    backups = int(os.getenv("LOG_BACKUPS", "5"))
+    when = os.getenv("LOG_ROTATE_WHEN", "")
+    if when:
+        handler = logging.handlers.TimedRotatingFileHandler(
+            path, when=when, backupCount=backups, encoding="utf-8")
+    else:
+        handler = logging.handlers.RotatingFileHandler(
+            path,
+            maxBytes=int(os.getenv("LOG_MAX_BYTES", str(50 * 2**20))),
+            backupCount=backups,
+            encoding="utf-8")
+    if os.getenv("LOG_FORMAT", "json") == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+    return handler
+
+
+def _install(log_queue, level: Optional[str]):
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(_QueueHandler(log_queue))
+    root.setLevel((level or os.getenv("LOG_LEVEL", "INFO")).upper())
+
+
+def setup(path: Optional[str] = None, level: Optional[str] = None):
+    """Настраивает журнал процесса по переменным LOG_*.
+
+    path — файл журнала (по умолчанию LOG_PATH или bot.log, пустая строка —
+    только консоль), level — уровень (по умолчанию LOG_LEVEL или INFO).
+    """
+    global _listener, _child_listener, _child_queue
+    stop()
+    if path is None:
+        path = os.getenv("LOG_PATH", "bot.log")
+    handlers = []
+    if os.getenv("LOG_CONSOLE", "1") == "1":
+        console = logging.StreamHandler()
+        console.setFormatter(logging.Formatter(TEXT_FORMAT))
+        handlers.append(console)
+    if path:
+        handlers.append(_file_handler(path))
+
+    size = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+    log_queue = queue.Queue(size)
+    _install(log_queue, level)
+    _listener = _QueueListener(log_queue, *handlers,
+                               respect_handler_level=True)
+    _listener.start()
+    # Записи дочерних процессов идут в те же обработчики
+    _child_queue = multiprocessing.get_context("spawn").Queue(size)
+    _child_listener = _QueueListener(_child_queue, *handlers,
+                                     respect_handler_level=True)
+    _child_listener.start()
+    metrics.QUEUE_DEPTH.set_function(log_queue.qsize, queue="log")
+
+
+def setup_child(log_queue, level: Optional[str] = None):
+    """Журнал дочернего процесса: записи уходят в log_queue основного"""
+    global _child_queue
+    _install(log_queue, level)
+    _child_queue = log_queue
+
+
+def child_queue():
+    """Очередь для setup_child в дочерних процессах; None, если журнал
+    этого процесса не настроен через setup()"""
+    return _child_queue
+
+
+def stop():
+    """Дописывает очередь и останавливает поток записи"""
+    global _listener, _child_listener
+    for listener in (_child_listener, _listener):
+        if listener is not None:
+            listener.stop()
+    if _listener is not None:
+        for handler in _listener.handlers:
+            handler.close()
+    _listener = _child_listener = None
+
+
+atexit.register(stop)
@@ -0,0 +1,412 @@
+"""Метрики и замеры этапов обработки запросов.
+
+Счетчики, гистограммы и датчики в формате Prometheus; span("stage")
+замеряет этап (геокодинг, часовой пояс, эфемериды, ИИ, отправка в
+Telegram) и пишет его в гистограмму astro_stage_seconds. trace("natal")
+объединяет этапы одного запроса: медленные запросы (дольше
+slow_threshold) попадают в журнал с разбивкой по этапам, а если включен
+StackSampler — и с самыми частыми стеками за время запроса.
+
+    start_http_server("0.0.0.0", 9100)  # /metrics и /debug/slow
+"""
+import contextvars
+import heapq
+import itertools
+import json
+import logging
+import math
+import sys
+import threading
+import time
+from collections import Counter as _Tally
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_registry: List["_Metric"] = []
+_lock = threading.Lock()
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str],
+                   extra: str = "") -> str:
+    pairs = [
+        f'{name}="{str(value)}"'.replace("\n", " ")
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values: Dict[tuple, object] = {}
+        _registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"
+        ]
+        with _lock:
+            items = list(self._values.items())
+        for key, value in sorted(items):
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key: tuple, value) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labels, key)} "
+            f"{_format_value(value)}"
+        ]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+
+class Gauge(_Metric):
+    """Датчик: значение задается set() или вычисляется при выдаче
+    функцией из set_function()"""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._functions: Dict[tuple, Callable[[], float]] = {}
+
+    def set(self, value: float, **labels):
+        with _lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, function: Callable[[], float], **labels):
+        self._functions[self._key(labels)] = function
+
+    def render(self) -> List[str]:
+        for key, function in list(self._functions.items()):
+            try:
+                value = function()
+            except Exception:
+                continue
+            with _lock:
+                self._values[key] = value
+        return super().render()
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self,
+                 name: str,
+                 help: str,
+                 labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (math.inf, )
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with _lock:
+            state = self._values.get(key)
+            if state is None:
+                # [счетчики по корзинам, сумма, количество]
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts = state[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def _render_value(self, key: tuple, value) -> List[str]:
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            le = 'le="' + _format_value(bound) + '"'
+            lines.append(f"{self.name}_bucket"
+                         f"{_format_labels(self.labels, key, le)} "
+                         f"{cumulative}")
+        labels = _format_labels(self.labels, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def render() -> str:
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- Метрики бота ---
+
+STAGE_SECONDS = Histogram("astro_stage_seconds",
+                          "Длительность этапов обработки", ("stage", ))
+STAGE_ERRORS = Counter("astro_stage_errors_total", "Ошибки этапов",
+                       ("stage", ))
+REQUEST_SECONDS = Histogram("astro_request_seconds",
+                            "Полное время обработки запроса", ("kind", ))
+CACHE_REQUESTS = Counter("astro_cache_requests_total", "Обращения к кэшам",
+                         ("cache", "result"))
+CACHE_HIT_RATIO = Gauge("astro_cache_hit_ratio", "Доля попаданий в кэш",
+                        ("cache", ))
+AI_REQUESTS = Counter("astro_ai_requests_total", "Запросы к моделям",
+                      ("model", "result"))
+AI_SECONDS = Histogram("astro_ai_seconds", "Время успешного ответа модели",
+                       ("model", ))
+TELEGRAM_REQUESTS = Counter("astro_telegram_requests_total",
+                            "Вызовы Bot API", ("method", "result"))
+QUEUE_DEPTH = Gauge("astro_queue_depth", "Задачи в очередях", ("queue", ))
+LOG_DROPPED = Counter("astro_log_dropped_total",
+                      "Записи журнала, отброшенные при полной очереди")
+
+
+def cache_result(cache: str, hit: bool):
+    """Учитывает обращение к кэшу и поддерживает датчик доли попаданий"""
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+    key = CACHE_HIT_RATIO._key({"cache": cache})
+    if key not in CACHE_HIT_RATIO._functions:
+
+        def ratio() -> float:
+            hits = CACHE_REQUESTS.value(cache=cache, result="hit")
+            misses = CACHE_REQUESTS.value(cache=cache, result="miss")
+            return hits / (hits + misses) if hits + misses else 0.0
+
+        CACHE_HIT_RATIO.set_function(ratio, cache=cache)
+
+
+# --- Замеры этапов и трассы запросов ---
+
+
+class Trace:
+    """Этапы одного запроса: [(этап, начало от старта трассы, длительность)]"""
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.spans: List[Tuple[str, float, float]] = []
+        self.total = 0.0
+        self.stacks: List[Tuple[str, int]] = []
+
+    def as_dict(self) -> dict:
+        return {
+            "kind": self.kind,
+            "started_at": self.started_at,
+            "total": round(self.total, 4),
+            "spans": [(stage, round(offset, 4), round(duration, 4))
+                      for stage, offset, duration in self.spans],
+            "stacks": self.stacks,
+        }
+
+
+_current_trace: contextvars.ContextVar[Optional[Trace]] = (
+    contextvars.ContextVar("astro_trace", default=None))
+_captured: contextvars.ContextVar[Optional[list]] = contextvars.ContextVar(
+    "astro_captured_spans", default=None)
+
+slow_threshold = 5.0
+_slowest: List[Tuple[float, int, Trace]] = []
+_slowest_limit = 20
+_trace_ids = itertools.count()
+sampler: Optional["StackSampler"] = None
+# Функции (этап, длительность, ошибка), получающие каждый замер
+span_listeners: List[Callable[[str, float, bool], None]] = []
+
+
+def record_span(stage: str, duration: float, error: bool = False):
+    STAGE_SECONDS.observe(duration, stage=stage)
+    if error:
+        STAGE_ERRORS.inc(stage=stage)
+    for listener in span_listeners:
+        listener(stage, duration, error)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.spans.append(
+            (stage, time.perf_counter() - duration - trace.started, duration))
+    captured = _captured.get()
+    if captured is not None:
+        captured.append((stage, duration, error))
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """Замер этапа; работает и в потоках пула, если задача запущена
+    в копии контекста (contextvars.copy_context().run)"""
+    started = time.perf_counter()
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        record_span(stage, time.perf_counter() - started, error)
+
+
+@contextmanager
+def capture() -> Iterator[list]:
+    """Собирает замеры этапов в список — для передачи из процесса пула
+    в основной процесс (см. replay)"""
+    spans: list = []
+    token = _captured.set(spans)
+    try:
+        yield spans
+    finally:
+        _captured.reset(token)
+
+
+def replay(spans: Sequence[Tuple[str, float, bool]]):
+    for stage, duration, error in spans:
+        record_span(stage, duration, error)
+
+
+@contextmanager
+def trace(kind: str) -> Iterator[Trace]:
+    """Трасса запроса: общее время в astro_request_seconds, медленные
+    запросы — в журнал и в список /debug/slow"""
+    current = Trace(kind)
+    token = _current_trace.set(current)
+    try:
+        yield current
+    finally:
+        _current_trace.reset(token)
+        current.total = time.perf_counter() - current.started
+        REQUEST_SECONDS.observe(current.total, kind=kind)
+        if current.total >= slow_threshold:
+            _remember_slow(current)
+
+
+def _remember_slow(current: Trace):
+    if sampler is not None:
+        current.stacks = sampler.top_stacks(current.started,
+                                            current.started + current.total)
+    stages = ", ".join(f"{stage} {duration:.3f}"
+                       for stage, _, duration in current.spans)
+    logger.warning("Медленный запрос %s: %.2f с (%s)", current.kind,
+                   current.total, stages)
+    with _lock:
+        entry = (current.total, next(_trace_ids), current)
+        if len(_slowest) < _slowest_limit:
+            heapq.heappush(_slowest, entry)
+        else:
+            heapq.heappushpop(_slowest, entry)
+
+
+def slowest() -> List[dict]:
+    with _lock:
+        entries = sorted(_slowest, key=lambda entry: -entry[0])
+    return [entry[2].as_dict() for entry in entries]
+
+
+class StackSampler:
+    """Фоновый семплер стеков всех потоков (раз в interval секунд).
+
+    Хранит последние max_samples стеков с моментами снятия; для медленного
+    запроса выдаются самые частые стеки за время его выполнения.
+    """
+
+    def __init__(self,
+                 interval: float = 0.01,
+                 max_samples: int = 50_000,
+                 depth: int = 30):
+        self.interval = interval
+        self.depth = depth
+        self._samples = deque(maxlen=max_samples)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name="stack-sampler",
+                                        daemon=True)
+
+    def start(self) -> "StackSampler":
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _collapse(self, frame) -> str:
+        names = []
+        while frame is not None and len(names) < self.depth:
+            code = frame.f_code
+            names.append(f"{code.co_filename.rsplit('/', 1)[-1]}:"
+                         f"{code.co_name}:{frame.f_lineno}")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            now = time.perf_counter()
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self._samples.append((now, self._collapse(frame)))
+
+    def top_stacks(self, start: float, end: float,
+                   limit: int = 10) -> List[Tuple[str, int]]:
+        tally = _Tally(stack for moment, stack in list(self._samples)
+                       if start <= moment <= end)
+        return tally.most_common(limit)
+
+
+def start_sampler(interval: float) -> StackSampler:
+    global sampler
+    sampler = StackSampler(interval).start()
+    logger.info("Семплер стеков включен: раз в %.0f мс", interval * 1000)
+    return sampler
+
+
+async def start_http_server(host: str, port: int, routes=()):
+    """HTTP-сервер с /metrics и /debug/slow; routes — дополнительные
+    (путь, обработчик aiohttp). Возвращает AppRunner для остановки"""
+    from aiohttp import web
+
+    async def metrics_handler(request):
+        return web.Response(text=render(),
+                            content_type="text/plain",
+                            charset="utf-8")
+
+    async def slow_handler(request):
+        return web.Response(text=json.dumps(slowest(), ensure_ascii=False),
+                            content_type="application/json")
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    app.router.add_get("/debug/slow", slow_handler)
+    for path, handler in routes:
+        app.router.add_get(path, handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Метрики: http://%s:%s/metrics", host, port)
+    return runner
@@ -0,0 +1,285 @@
+"""Исходящие сообщения Telegram с учетом лимитов.
+
+Все отправки и правки идут через OutboundDispatcher: у каждого чата своя
+очередь (порядок сообщений сохраняется) и свое ведро токенов, а общее ведро
+держит глобальный лимит бота (~30 сообщений в секунду). Чаты обслуживаются
+параллельно. TelegramRetryAfter не теряет сообщение: очередь чата ждет
+указанное время и повторяет запрос; сетевые сбои и ответы 5xx
+повторяются с растущей паузой. Правки одного сообщения, еще не
+отправленные, схлопываются в последнюю.
+"""
+import asyncio
+import logging
+import re
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import (TelegramBadRequest, TelegramNetworkError,
+                                TelegramRetryAfter, TelegramServerError)
+
+import metrics
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Сущности старого Markdown Telegram: блок кода, код, жирный, курсив
+_MARKERS = re.compile(r"```|`|\*|_")
+MESSAGE_LIMIT = 4000
+
+
+def _split_point(text: str, limit: int) -> int:
+    """Позиция разреза не дальше limit: абзац, строка или пробел"""
+    for separator in ("\n\n", "\n", " "):
+        cut = text.rfind(separator, limit // 2, limit)
+        if cut != -1:
+            return cut + len(separator)
+    return limit
+
+
+def _open_entities(text: str) -> List[str]:
+    """Незакрытые маркеры Markdown в text, от внешнего к внутреннему"""
+    stack: List[str] = []
+    for match in _MARKERS.finditer(text):
+        marker = match.group()
+        if stack and stack[-1] in ("```", "`"):
+            # Внутри кода значим только закрывающий маркер
+            if marker == stack[-1]:
+                stack.pop()
+        elif marker in stack:
+            del stack[stack.index(marker):]
+        else:
+            stack.append(marker)
+    return stack
+
+
+def cut_markdown(text: str, limit: int,
+                 start: int = 0) -> Tuple[str, int, str]:
+    """Отрезает от text первую часть не длиннее limit, не разрывая разметку.
+
+    Режем по абзацам, строкам или пробелам и не внутри ссылки [..](..).
+    start — длина маркеров, заново открытых в начале text: разрез всегда
+    дальше них, иначе деление не продвинется. Возвращает (часть с
+    закрытыми сущностями, позиция разреза, маркеры для начала остатка).
+    """
+    # Запас под закрывающие маркеры
+    cut = _split_point(text, limit - 8)
+    # Ссылку длиннее половины части все равно придется разрезать
+    link = text.rfind("[", max(start, limit // 2), cut)
+    if link != -1 and text.find(")", link) >= cut:
+        cut = link
+    part = text[:cut]
+    entities = _open_entities(part)
+    closers = "".join(reversed(entities))
+    if closers:
+        part = part.rstrip()
+    return part + closers, cut, "".join(entities)
+
+
+def split_markdown(text: str, limit: int = MESSAGE_LIMIT) -> List[str]:
+    """Делит text на части не длиннее limit, не разрывая разметку.
+
+    Незакрытые на границе сущности закрываются в конце части и открываются
+    заново в начале следующей.
+    """
+    parts = []
+    reopen = ""
+    while text:
+        text = reopen + text
+        if len(text) <= limit:
+            parts.append(text)
+            break
+        part, cut, entities = cut_markdown(text, limit, len(reopen))
+        parts.append(part)
+        reopen = entities
+        text = text[cut:]
+    return parts
+
+
+class _Operation:
+    __slots__ = ("method", "kwargs", "future")
+
+    def __init__(self, method: str, kwargs: Dict[str, Any]):
+        self.method = method
+        self.kwargs = kwargs
+        self.future = asyncio.get_running_loop().create_future()
+        # Ошибку уже записали в лог — не ругаемся, если ее никто не ждал
+        self.future.add_done_callback(
+            lambda future: future.cancelled() or future.exception())
+
+
+class OutboundDispatcher:
+    """Очереди исходящих сообщений по чатам с глобальным и чатовым лимитами.
+
+    global_rate — сообщений в секунду на бота, chat_rate/chat_burst — на
+    личный чат, group_rate — на группу (отрицательный chat_id). Сетевой сбой
+    или 5xx повторяется до retries раз с паузой retry_delay, 2·retry_delay
+    и т. д., но не больше max_retry_delay.
+    """
+
+    def __init__(self,
+                 bot: Bot,
+                 global_rate: float = 30,
+                 chat_rate: float = 1,
+                 chat_burst: float = 3,
+                 group_rate: float = 20 / 60,
+                 retries: int = 4,
+                 retry_delay: float = 1.0,
+                 max_retry_delay: float = 30.0):
+        self.bot = bot
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self._global = TokenBucket(global_rate, global_rate)
+        self._global_lock = asyncio.Lock()
+        self._queues: Dict[int, deque] = {}
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._workers: Dict[int, asyncio.Task] = {}
+        metrics.QUEUE_DEPTH.set_function(
+            lambda: sum(map(len, self._queues.values())), queue="outbound")
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if len(self._buckets) > 10_000:
+                # Полные ведра ничем не отличаются от новых
+                self._buckets = {
+                    key: value
+                    for key, value in self._buckets.items()
+                    if not value.full or key in self._queues
+                }
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate, 1)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    def _enqueue(self, chat_id: int, operation: _Operation) -> asyncio.Future:
+        self._queues.setdefault(chat_id, deque()).append(operation)
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._worker(chat_id))
+        return operation.future
+
+    def send(self, chat_id: int, text: str, **kwargs) -> asyncio.Future:
+        """Отправка одного сообщения (параметры как у Bot.send_message);
+        результат — объект Message"""
+        kwargs.update(chat_id=chat_id, text=text)
+        return self._enqueue(chat_id, _Operation("send_message", kwargs))
+
+    async def send_text(self,
+                        chat_id: int,
+                        text: str,
+                        parse_mode: Optional[str] = "Markdown",
+                        **kwargs) -> list:
+        """Отправка текста любой длины частями; возвращает список Message"""
+        parts = (split_markdown(text)
+                 if parse_mode else [text[i:i + MESSAGE_LIMIT]
+                                     for i in range(0, len(text),
+                                                    MESSAGE_LIMIT)])
+        futures = [
+            self.send(chat_id, part, parse_mode=parse_mode, **kwargs)
+            for part in parts
+        ]
+        return list(await asyncio.gather(*futures))
+
+    def edit(self,
+             chat_id: int,
+             message_id: int,
+             text: str,
+             parse_mode: Optional[str] = None) -> asyncio.Future:
+        """Правка сообщения. Если в очереди уже ждет правка того же
+        сообщения, она заменяется новым текстом"""
+        queue = self._queues.get(chat_id, ())
+        # Первая операция очереди уже может выполняться — ее не трогаем
+        for operation in list(queue)[1:]:
+            if (operation.method == "edit_message_text"
+                    and operation.kwargs["message_id"] == message_id):
+                operation.kwargs.update(text=text, parse_mode=parse_mode)
+                return operation.future
+        return self._enqueue(
+            chat_id,
+            _Operation(
+                "edit_message_text",
+                dict(chat_id=chat_id,
+                     message_id=message_id,
+                     text=text,
+                     parse_mode=parse_mode)))
+
+    async def _call(self, chat_id: int, operation: _Operation):
+        bucket = self._bucket(chat_id)
+        kwargs = operation.kwargs
+        failures = 0
+        while True:
+            await bucket.acquire()
+            async with self._global_lock:
+                await self._global.acquire()
+            try:
+                with metrics.span("telegram"):
+                    result = await getattr(self.bot,
+                                           operation.method)(**kwargs)
+                metrics.TELEGRAM_REQUESTS.inc(method=operation.method,
+                                              result="ok")
+                return result
+            except TelegramRetryAfter as e:
+                metrics.TELEGRAM_REQUESTS.inc(method=operation.method,
+                                              result="retry_after")
+                logger.warning("Флуд-контроль в чате %s: ждем %s с", chat_id,
+                               e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                metrics.TELEGRAM_REQUESTS.inc(method=operation.method,
+                                              result="transient")
+                failures += 1
+                if failures > self.retries:
+                    raise
+                delay = min(self.retry_delay * 2**(failures - 1),
+                            self.max_retry_delay)
+                logger.warning("Сбой Telegram в чате %s: %s, повтор через %s с",
+                               chat_id, e, delay)
+                await asyncio.sleep(delay)
+            except TelegramBadRequest as e:
+                metrics.TELEGRAM_REQUESTS.inc(method=operation.method,
+                                              result="bad_request")
+                if "not modified" in str(e):
+                    return None
+                if not kwargs.get("parse_mode"):
+                    raise
+                # Разметка не разобралась — отправляем как обычный текст
+                kwargs = dict(kwargs, parse_mode=None)
+
+    async def _worker(self, chat_id: int):
+        queue = self._queues[chat_id]
+        try:
+            while queue:
+                operation = queue[0]
+                try:
+                    result = await self._call(chat_id, operation)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error("Не удалось отправить в чат %s: %s", chat_id,
+                                 e)
+                    operation.future.set_exception(e)
+                else:
+                    operation.future.set_result(result)
+                queue.popleft()
+        finally:
+            for operation in queue:
+                operation.future.cancel()
+            del self._queues[chat_id]
+            del self._workers[chat_id]
+
+    async def close(self, timeout: float = 10.0):
+        """Дожидается отправки очередей (не дольше timeout) и
+        останавливает обработчики"""
+        workers = list(self._workers.values())
+        if not workers:
+            return
+        _, pending = await asyncio.wait(workers, timeout=timeout)
+        for worker in pending:
+            worker.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
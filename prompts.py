@@ -0,0 +1,105 @@
+"""Шаблоны запросов к ИИ.
+
+Запрос строится только из положений (знак и диапазон градусов) Солнца,
+Луны и Асцендента, поэтому одинаковые карты дают одинаковый запрос и
+интерпретацию можно брать из кэша. При любом изменении текста шаблонов
+нужно увеличить PROMPT_VERSION — старые записи кэша перестанут совпадать.
+"""
+from typing import Tuple
+
+PROMPT_VERSION = 2
+
+NATAL_POINTS = (("sun", "Солнце"), ("moon", "Луна"), ("ascendant",
+                                                      "Асцендент"))
+
+# ((знак, начало диапазона градусов), ...) в порядке NATAL_POINTS
+Placements = Tuple[Tuple[str, int], ...]
+
+
+def placements(positions, bucket: int) -> Placements:
+    """Положения точек карты с градусами, округленными вниз до bucket"""
+    planets = positions['planets']
+    return tuple((planets[name]['sign'],
+                  int(planets[name]['degree'] // bucket) * bucket)
+                 for name, _ in NATAL_POINTS)
+
+
+def signature(*charts: Placements) -> str:
+    return "/".join("|".join(f"{sign}:{start}" for sign, start in chart)
+                    for chart in charts)
+
+
+def _positions_text(chart: Placements, bucket: int) -> str:
+    lines = []
+    for (_, label), (sign, start) in zip(NATAL_POINTS, chart):
+        if bucket >= 30:
+            lines.append(f"- {label}: {sign}")
+        else:
+            lines.append(f"- {label}: {sign} ({start}–{start + bucket}°)")
+    return "\n".join(lines)
+
+
+def natal_prompt(chart: Placements, bucket: int) -> str:
+    return f"""
+Рассчитана натальная карта.
+
+Позиции:
+{_positions_text(chart, bucket)}
+
+Дай краткую, лаконичную интерпретацию натальной карты с фокусом на:
+- Основные черты (до 5 пунктов, кратко)
+- Эмоциональные особенности (до 3–5 пунктов)
+- 3 совета по развитию
+
+Форматируй красиво, с эмодзи и подзаголовками. Избегай длинных абзацев. Не пиши 'На основе предоставленных данных...'
+"""
+
+
+def compatibility_prompt(chart1: Placements, chart2: Placements,
+                         bucket: int) -> str:
+    return f"""
+Даны две натальные карты для анализа совместимости:
+
+1-й человек:
+{_positions_text(chart1, bucket)}
+
+2-й человек:
+{_positions_text(chart2, bucket)}
+
+Проанализируй совместимость этих двух людей, выдели сильные и слабые стороны их отношений,
+эмоциональную и духовную совместимость, а также дай 3 практических совета для гармонии в паре.
+
+Форматируй ответ с эмодзи и разделами, избегай воды и обобщений.
+"""
+
+
+# Планеты, транзиты которых попадают в ежедневный прогноз
+TRANSIT_POINTS = (("sun", "Солнце"), ("moon", "Луна"), ("mercury", "Меркурий"),
+                  ("venus", "Венера"), ("mars", "Марс"), ("jupiter", "Юпитер"),
+                  ("saturn", "Сатурн"), ("uranus", "Уран"),
+                  ("neptune", "Нептун"), ("pluto", "Плутон"))
+
+
+def transits(chart) -> Tuple[Tuple[str, str, bool], ...]:
+    """(название, знак, ретроградность) планет TRANSIT_POINTS в chart"""
+    return tuple((label, chart.sign(name), chart.is_retrograde(name))
+                 for name, label in TRANSIT_POINTS)
+
+
+def daily_prompt(day: str, sky: Tuple[Tuple[str, str, bool], ...], sun: str,
+                 moon: str) -> str:
+    positions = "\n".join(
+        f"- {label}: {sign}{' (ретроградный)' if retrograde else ''}"
+        for label, sign, retrograde in sky)
+    return f"""
+Транзиты на {day}:
+{positions}
+
+Составь короткий гороскоп на этот день для человека с Солнцем в знаке {sun} и Луной в знаке {moon}.
+Учитывай, как сегодняшние транзиты затрагивают его Солнце и Луну:
+- Общий настрой дня (1–2 предложения)
+- Работа и дела, отношения, самочувствие — по 1–2 предложения
+- Совет дня
+
+Не больше 700 символов, с эмодзи, без вступлений и общих слов.
+"""
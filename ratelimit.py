@@ -0,0 +1,45 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """Ведро токенов: в среднем rate токенов в секунду, всплеск до capacity"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+    def delay(self, cost: float = 1.0) -> float:
+        """Через сколько секунд наберется cost токенов (0 — уже есть)"""
+        self._refill()
+        if self.tokens >= cost:
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+    def try_acquire(self, cost: float = 1.0) -> bool:
+        if self.delay(cost) > 0:
+            return False
+        self.tokens -= cost
+        return True
+
+    async def acquire(self, cost: float = 1.0):
+        """Ждет, пока наберется cost токенов, и забирает их"""
+        while True:
+            wait = self.delay(cost)
+            if wait <= 0:
+                self.tokens -= cost
+                return
+            await asyncio.sleep(wait)
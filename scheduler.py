@@ -0,0 +1,192 @@
+"""Планировщик тяжелых задач бота (расчет карты + интерпретация).
+
+Каждый пользователь получает ведро токенов: слишком частые запросы сразу
+отклоняются с RateLimited. Принятые задачи выполняются в порядке взвешенной
+справедливой очереди (WFQ): у каждой задачи виртуальное время окончания
+max(текущее, последнее у пользователя) + стоимость, поэтому один активный
+пользователь не отодвигает остальных, а тяжелые задачи (совместимость)
+весят больше легких. Если в очереди больше max_queued единиц стоимости,
+новые задачи отклоняются с SchedulerOverloaded.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Hashable, Optional
+
+import metrics
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+PositionCallback = Callable[[int], Awaitable[None]]
+
+
+class RateLimited(RuntimeError):
+    """Пользователь исчерпал лимит задач"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Повторите через {retry_after:.0f} с")
+        self.retry_after = retry_after
+
+
+class SchedulerOverloaded(RuntimeError):
+    """Очередь задач переполнена — задача отклонена"""
+
+
+class _Entry:
+    __slots__ = ("finish", "seq", "user", "cost", "started", "position",
+                 "on_position", "notified_at", "notifier")
+
+    def __init__(self, finish: float, seq: int, user: Hashable, cost: float,
+                 on_position: Optional[PositionCallback]):
+        self.finish = finish
+        self.seq = seq
+        self.user = user
+        self.cost = cost
+        self.started = asyncio.get_running_loop().create_future()
+        self.position = 0
+        self.on_position = on_position
+        self.notified_at = 0.0
+        self.notifier: Optional[asyncio.Task] = None
+
+    def __lt__(self, other: "_Entry") -> bool:
+        return (self.finish, self.seq) < (other.finish, other.seq)
+
+
+class JobScheduler:
+    """Справедливая очередь задач с ограничением по пользователям.
+
+    capacity — сколько единиц стоимости выполняется одновременно,
+    max_queued — сколько единиц может ждать в очереди,
+    user_rate/user_burst — ведро токенов пользователя (единиц в секунду и
+    размер всплеска). Пока задача ждет, on_position получает ее номер в
+    очереди (не чаще раза в position_interval секунд).
+    """
+
+    def __init__(self,
+                 capacity: float = 16,
+                 max_queued: float = 100,
+                 user_rate: float = 3 / 60,
+                 user_burst: float = 3,
+                 position_interval: float = 3.0):
+        self.capacity = capacity
+        self.max_queued = max_queued
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.position_interval = position_interval
+        self.running = 0.0
+        self.queued = 0.0
+        self._virtual_time = 0.0
+        self._last_finish: Dict[Hashable, float] = {}
+        self._buckets: Dict[Hashable, TokenBucket] = {}
+        self._queue = []
+        self._seq = itertools.count()
+        metrics.QUEUE_DEPTH.set_function(lambda: len(self._queue),
+                                         queue="jobs")
+        metrics.QUEUE_DEPTH.set_function(lambda: self.running,
+                                         queue="jobs_running")
+
+    def _bucket(self, user: Hashable) -> TokenBucket:
+        bucket = self._buckets.get(user)
+        if bucket is None:
+            if len(self._buckets) > 10_000:
+                # Полные ведра ничем не отличаются от новых
+                self._buckets = {
+                    key: value
+                    for key, value in self._buckets.items() if not value.full
+                }
+            bucket = TokenBucket(self.user_rate, self.user_burst)
+            self._buckets[user] = bucket
+        return bucket
+
+    def _admit(self, user: Hashable, cost: float,
+               on_position: Optional[PositionCallback]) -> _Entry:
+        bucket = self._bucket(user)
+        wait = bucket.delay(cost)
+        if wait > 0:
+            raise RateLimited(wait)
+        if self.queued + cost > self.max_queued:
+            logger.warning(
+                "Очередь задач переполнена: %g единиц, задача %s отклонена",
+                self.queued, user)
+            raise SchedulerOverloaded("Очередь задач переполнена")
+        bucket.try_acquire(cost)
+        start = max(self._virtual_time, self._last_finish.get(user, 0.0))
+        entry = _Entry(start + cost, next(self._seq), user, cost, on_position)
+        self._last_finish[user] = entry.finish
+        return entry
+
+    def _dispatch(self):
+        """Запускает задачи из головы очереди, пока хватает мощности"""
+        changed = False
+        while self._queue and (self.running == 0 or self.running +
+                               self._queue[0].cost <= self.capacity):
+            entry = heapq.heappop(self._queue)
+            self.queued -= entry.cost
+            self.running += entry.cost
+            self._virtual_time = entry.finish
+            if not entry.started.done():
+                entry.started.set_result(None)
+            changed = True
+        if not self._queue:
+            # Очередь пуста — история пользователей больше не нужна
+            self._last_finish.clear()
+        if changed:
+            self._update_positions()
+
+    def _update_positions(self):
+        for position, entry in enumerate(sorted(self._queue), start=1):
+            if entry.position == position:
+                continue
+            entry.position = position
+            if entry.on_position is not None and entry.notifier is None:
+                entry.notifier = asyncio.create_task(self._notify(entry))
+
+    async def _notify(self, entry: _Entry):
+        try:
+            wait = entry.notified_at + self.position_interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if entry.started.done():
+                return
+            entry.notified_at = time.monotonic()
+            await entry.on_position(entry.position)
+        except Exception as e:
+            logger.warning("Не удалось сообщить позицию в очереди: %s", e)
+        finally:
+            entry.notifier = None
+
+    async def run(self,
+                  user: Hashable,
+                  job: Callable[[], Awaitable],
+                  cost: float = 1.0,
+                  on_position: Optional[PositionCallback] = None):
+        """Выполняет job в порядке очереди и возвращает его результат"""
+        entry = self._admit(user, cost, on_position)
+        heapq.heappush(self._queue, entry)
+        self.queued += entry.cost
+        self._dispatch()
+        if not entry.started.done():
+            self._update_positions()
+            logger.info("Задача %s ждет в очереди: #%s", user, entry.position)
+            try:
+                with metrics.span("queue_wait"):
+                    await entry.started
+            except asyncio.CancelledError:
+                if not entry.started.done():
+                    self._queue.remove(entry)
+                    heapq.heapify(self._queue)
+                    self.queued -= entry.cost
+                    self._update_positions()
+                    raise
+                # Задачу успели запустить — освобождаем ее место
+                self.running -= entry.cost
+                self._dispatch()
+                raise
+        try:
+            return await job()
+        finally:
+            self.running -= entry.cost
+            self._dispatch()
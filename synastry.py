@@ -0,0 +1,177 @@
+"""Синастрия: матрица аспектов между двумя картами и поиск лучших пар.
+
+Все расчеты идут над векторами долгот (точки POINTS) средствами NumPy:
+матрица аспектов двух карт — одна операция над массивом P×P×A, а оценка
+одной карты против N сохраненных — над массивом N×P×P порциями.
+"""
+import os
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from chart import BODY_INDEX, Chart
+
+POINTS = ("sun", "moon", "mercury", "venus", "mars", "jupiter", "saturn",
+          "uranus", "neptune", "pluto", "north_node", "chiron", "ascendant",
+          "mc")
+
+# (название, угол, орбис, вес в оценке совместимости)
+ASPECTS = (
+    ("conjunction", 0.0, 8.0, 2.0),
+    ("opposition", 180.0, 8.0, -1.0),
+    ("trine", 120.0, 7.0, 3.0),
+    ("square", 90.0, 6.0, -2.0),
+    ("sextile", 60.0, 4.0, 2.0),
+)
+ASPECT_NAMES_RU = {
+    "conjunction": "соединение",
+    "opposition": "оппозиция",
+    "trine": "трин",
+    "square": "квадрат",
+    "sextile": "секстиль",
+}
+
+_ANGLES = np.array([aspect[1] for aspect in ASPECTS], dtype=np.float32)
+_ORBS = np.array([aspect[2] for aspect in ASPECTS], dtype=np.float32)
+_WEIGHTS = np.array([aspect[3] for aspect in ASPECTS], dtype=np.float32)
+
+# Личные точки важнее высших планет
+_POINT_WEIGHTS = np.array(
+    [3, 3, 1.5, 2, 2, 1, 1, 0.5, 0.5, 0.5, 1, 0.5, 2.5, 1],
+    dtype=np.float32)
+_PAIR_WEIGHTS = np.outer(_POINT_WEIGHTS, _POINT_WEIGHTS)
+
+
+def chart_vector(chart: Chart) -> np.ndarray:
+    """Долготы POINTS карты; недоступные тела — NaN"""
+    values = []
+    for name in POINTS:
+        if name == "ascendant":
+            values.append(chart.ascendant)
+        elif name == "mc":
+            values.append(chart.mc)
+        else:
+            values.append(chart.longitudes[BODY_INDEX[name]])
+    return np.array(values, dtype=np.float32)
+
+
+def _separation(lon1: np.ndarray, lon2: np.ndarray) -> np.ndarray:
+    """Угловое расстояние 0..180 между каждой точкой lon1 и lon2
+    (последние оси: P1×P2)"""
+    diff = lon1[..., :, None] - lon2[..., None, :]
+    return np.abs((diff + 180.0) % 360.0 - 180.0)
+
+
+def aspect_matrix(lon1: np.ndarray,
+                  lon2: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Матрица аспектов P1×P2.
+
+    Возвращает (индекс аспекта в ASPECTS или -1, отклонение от точного
+    угла в градусах или NaN).
+    """
+    deviation = np.abs(_separation(lon1, lon2)[..., None] - _ANGLES)
+    deviation = np.where(deviation <= _ORBS, deviation, np.inf)
+    best = np.argmin(deviation, axis=-1)
+    orb = np.take_along_axis(deviation, best[..., None], axis=-1)[..., 0]
+    found = np.isfinite(orb)
+    return np.where(found, best, -1), np.where(found, orb, np.nan)
+
+
+def aspects_between(chart1: Chart, chart2: Chart) -> List[Dict[str, Any]]:
+    """Список аспектов между картами, от самых точных"""
+    kinds, orbs = aspect_matrix(chart_vector(chart1), chart_vector(chart2))
+    result = []
+    for i, j in zip(*np.nonzero(kinds >= 0)):
+        result.append({
+            "point1": POINTS[i],
+            "point2": POINTS[j],
+            "aspect": ASPECTS[kinds[i, j]][0],
+            "orb": round(float(orbs[i, j]), 2),
+        })
+    result.sort(key=lambda aspect: aspect["orb"])
+    return result
+
+
+# Оценка аспекта по расстоянию с шагом 1/_STEPS градуса: сила линейно
+# падает от 1 (точный аспект) до 0 (край орбиса); орбисы не пересекаются,
+# поэтому у пары точек не больше одного аспекта. Последний элемент — для
+# NaN (тело недоступно).
+_STEPS = 20
+_SCORE_TABLE = np.zeros(180 * _STEPS + 2, dtype=np.float32)
+for _angle, _orb, _weight in zip(_ANGLES, _ORBS, _WEIGHTS):
+    _SCORE_TABLE[:-1] += _weight * np.clip(
+        1.0 - np.abs(np.arange(180 * _STEPS + 1) / _STEPS - _angle) / _orb,
+        0.0, None)
+
+
+def _scores(query: np.ndarray, stored: np.ndarray) -> np.ndarray:
+    """Оценка совместимости query (P) с каждой строкой stored (N×P)"""
+    separation = _separation(stored, query)  # N×P×P
+    separation *= _STEPS
+    index = np.nan_to_num(separation, nan=len(_SCORE_TABLE) - 1)
+    index = np.rint(index, out=index).astype(np.int16)
+    return (_SCORE_TABLE[index] * _PAIR_WEIGHTS).sum(axis=(1, 2))
+
+
+def synastry_score(chart1: Chart, chart2: Chart) -> float:
+    return float(
+        _scores(chart_vector(chart1), chart_vector(chart2)[None, :])[0])
+
+
+class ChartIndex:
+    """Хранилище векторов долгот для поиска лучших пар.
+
+    Векторы лежат в матрице N×len(POINTS) (float32); сохраненный индекс
+    открывается через mmap, поэтому его могут делить несколько процессов.
+    """
+
+    def __init__(self,
+                 ids: Optional[Sequence[Any]] = None,
+                 vectors: Optional[np.ndarray] = None):
+        self.ids = list(ids or [])
+        self._vectors = (vectors if vectors is not None else np.empty(
+            (0, len(POINTS)), dtype=np.float32))
+        self._pending: List[np.ndarray] = []
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, chart_id: Any, chart: Chart):
+        self.ids.append(chart_id)
+        self._pending.append(chart_vector(chart))
+
+    @property
+    def vectors(self) -> np.ndarray:
+        if self._pending:
+            self._vectors = np.vstack([self._vectors] + self._pending)
+            self._pending = []
+        return self._vectors
+
+    def best_matches(self,
+                     chart: Chart,
+                     top_k: int = 10,
+                     chunk_size: int = 4096) -> List[Tuple[Any, float]]:
+        """top_k сохраненных карт с наибольшей оценкой совместимости"""
+        vectors = self.vectors
+        if len(vectors) == 0:
+            return []
+        query = chart_vector(chart)
+        scores = np.concatenate([
+            _scores(query, vectors[start:start + chunk_size])
+            for start in range(0, len(vectors), chunk_size)
+        ])
+        top_k = min(top_k, len(scores))
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        return [(self.ids[i], float(scores[i])) for i in best]
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "vectors.npy"), self.vectors)
+        np.save(os.path.join(path, "ids.npy"), np.array(self.ids))
+
+    @classmethod
+    def load(cls, path: str) -> "ChartIndex":
+        return cls(ids=np.load(os.path.join(path, "ids.npy")).tolist(),
+                   vectors=np.load(os.path.join(path, "vectors.npy"),
+                                   mmap_mode="r"))
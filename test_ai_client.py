@@ -0,0 +1,65 @@
+"""Цепочка моделей AIClient: страхующие запросы и переход по цепочке.
+
+    python -m unittest test_ai_client
+"""
+import asyncio
+import time
+import unittest
+
+from ai_client import AIClient, AIUnavailable
+
+# a отвечает медленно, b сразу падает, c отвечает быстро
+DELAYS = {"a": 1.0, "b": 0.0, "c": 0.05}
+
+
+class _Chain(AIClient):
+
+    def __init__(self):
+        super().__init__("key", models=("a", "b", "c"), hedge_after=0.1,
+                         hedge_first_token_after=0.1)
+        self.called = []
+
+    async def complete(self, prompt, model, max_tokens, temperature=0.7):
+        self.called.append(model)
+        await asyncio.sleep(DELAYS[model])
+        if model == "b":
+            raise ConnectionError("b недоступна")
+        return model
+
+    async def stream(self, prompt, model, max_tokens, temperature=0.7):
+        self.called.append(model)
+        await asyncio.sleep(DELAYS[model])
+        if model == "b":
+            raise ConnectionError("b недоступна")
+        for delta in (model, "!"):
+            yield delta
+
+
+class ChainTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_failed_hedge_starts_next_model(self):
+        client = _Chain()
+        started = time.monotonic()
+        text = await client.generate("prompt", max_tokens=10)
+        self.assertEqual(text, "c")
+        self.assertEqual(client.called, ["a", "b", "c"])
+        self.assertLess(time.monotonic() - started, 0.5)
+
+    async def test_failed_hedge_stream_starts_next_model(self):
+        client = _Chain()
+        started = time.monotonic()
+        text = "".join(
+            [delta async for delta in client.stream_generate("prompt", 10)])
+        self.assertEqual(text, "c!")
+        self.assertEqual(client.called, ["a", "b", "c"])
+        self.assertLess(time.monotonic() - started, 0.5)
+
+    async def test_all_models_fail(self):
+        client = _Chain()
+        client.models = ("b", )
+        with self.assertRaises(AIUnavailable):
+            await client.generate("prompt", max_tokens=10)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,223 @@
+"""Режим вебхука с несколькими процессами-обработчиками.
+
+Входной процесс (aiohttp) принимает обновления от Telegram, проверяет
+секретный заголовок и раскладывает их по WEBHOOK_WORKERS процессам по
+chat_id: все сообщения одного чата попадают в один процесс, поэтому
+состояние диалога (FSM) живет в одном месте. Каждый обработчик импортирует
+bot.py и передает обновления в Dispatcher. Обработчики порождает
+forkserver, заранее загрузивший тяжелые библиотеки (aiogram, numpy,
+swisseph): их импорт не повторяется при каждом запуске и перезапуске
+обработчика, а страницы кода общие. Общие лимиты бота (сообщений в
+секунду в Telegram, одновременных запросов к ИИ, скорость рассылки)
+делятся между обработчиками поровну; ежедневную рассылку каждый
+обработчик ведет для своих чатов (по тому же chat_id).
+
+При SIGTERM/SIGINT входной процесс перестает принимать запросы, а
+обработчики дорабатывают уже полученные обновления и закрываются
+(не дольше WEBHOOK_DRAIN_TIMEOUT секунд).
+
+    WEBHOOK_URL=https://example.com/webhook python webhook.py
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import time
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+from dotenv import load_dotenv
+
+import log_setup
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+# Загружаются один раз в forkserver, обработчики получают их готовыми
+PRELOAD = ["aiogram", "aiohttp", "numpy", "swisseph", "pytz", "dotenv"]
+
+
+class WebhookConfig:
+    URL = os.getenv('WEBHOOK_URL', '')
+    HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+    PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+    PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+    SECRET = os.getenv('WEBHOOK_SECRET', '')
+    WORKERS = int(os.getenv('WEBHOOK_WORKERS', '0')) or os.cpu_count() or 1
+    # Сколько обновлений может ждать в очереди одного обработчика
+    QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))
+    DRAIN_TIMEOUT = float(os.getenv('WEBHOOK_DRAIN_TIMEOUT', '30'))
+
+
+def chat_id_of(update: Dict[str, Any]) -> int:
+    """chat_id обновления (или id пользователя, если чата нет)"""
+    for key, value in update.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or value.get("message", {}).get("chat")
+        if chat:
+            return chat["id"]
+        sender = value.get("from") or value.get("user")
+        if sender:
+            return sender["id"]
+    return 0
+
+
+def _worker_main(index: int,
+                 workers: int,
+                 queue: multiprocessing.Queue,
+                 log_queue=None):
+    """Процесс-обработчик: Dispatcher из bot.py над своей очередью"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    if log_queue is not None:
+        # Журнал пишет входной процесс
+        log_setup.setup_child(log_queue)
+    # Лимиты Telegram и ИИ общие на бота — делим их между обработчиками
+    os.environ["BOT_PROCESSES"] = str(workers)
+    os.environ["BOT_PROCESS_INDEX"] = str(index)
+    import bot as app
+
+    async def serve():
+        loop = asyncio.get_running_loop()
+        port = app.Config.METRICS_PORT
+        metrics_server = await app.start_metrics(port + index if port else 0)
+        warming = asyncio.create_task(app.warm_up())
+        # Каждый обработчик рассылает свою часть подписчиков
+        if app.Config.BROADCAST_ENABLED:
+            app.broadcaster.start(app.Config.BROADCAST_TIME)
+        tasks = set()
+        while True:
+            update = await loop.run_in_executor(None, queue.get)
+            if update is None:
+                break
+            task = asyncio.create_task(app.dp.feed_raw_update(app.bot, update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            logger.info("Обработчик %s: завершаем %s обновлений", index,
+                        len(tasks))
+            await asyncio.gather(*tasks, return_exceptions=True)
+        warming.cancel()
+        if metrics_server is not None:
+            await metrics_server.cleanup()
+        await app.shutdown()
+
+    asyncio.run(serve())
+    logger.info("Обработчик %s остановлен", index)
+
+
+class ShardedWebhook:
+    """Входной процесс: раскладывает обновления по обработчикам"""
+
+    def __init__(self,
+                 workers: int,
+                 queue_size: int = 1000,
+                 secret: str = ""):
+        self.secret = secret
+        self.queue_size = queue_size
+        self.workers = workers
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            self._context = multiprocessing.get_context("forkserver")
+            self._context.set_forkserver_preload(PRELOAD)
+        else:
+            self._context = multiprocessing.get_context("spawn")
+        self._queues: List[multiprocessing.Queue] = []
+        self._processes: List[Optional[multiprocessing.Process]] = []
+        for index in range(workers):
+            self._queues.append(self._context.Queue(queue_size))
+            self._processes.append(None)
+            self._start_worker(index)
+
+    def _start_worker(self, index: int):
+        process = self._context.Process(target=_worker_main,
+                                        args=(index, self.workers,
+                                              self._queues[index],
+                                              log_setup.child_queue()),
+                                        name=f"bot-worker-{index}")
+        process.start()
+        self._processes[index] = process
+        logger.info("Обработчик %s запущен, pid %s", index, process.pid)
+
+    def route(self, update: Dict[str, Any]) -> int:
+        index = chat_id_of(update) % len(self._queues)
+        if not self._processes[index].is_alive():
+            logger.error("Обработчик %s упал, перезапускаем", index)
+            self._start_worker(index)
+        return index
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret and request.headers.get(SECRET_HEADER) != self.secret:
+            return web.Response(status=403)
+        update = await request.json()
+        index = self.route(update)
+        try:
+            self._queues[index].put_nowait(update)
+        except Exception:
+            # Очередь полна: Telegram повторит доставку позже
+            logger.warning("Очередь обработчика %s переполнена", index)
+            return web.Response(status=503)
+        return web.Response()
+
+    def drain(self, timeout: float):
+        """Просит обработчики завершиться и ждет их не дольше timeout"""
+        for queue in self._queues:
+            queue.put(None)
+        deadline = time.monotonic() + timeout
+        for index, process in enumerate(self._processes):
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.warning("Обработчик %s не успел завершиться", index)
+                process.terminate()
+                process.join()
+
+
+async def set_webhook(url: str, secret: str):
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+
+    api_server = os.getenv('TELEGRAM_API_SERVER')
+    bot = Bot(token=os.getenv('TELEGRAM_BOT_TOKEN'),
+              session=AiohttpSession(api=TelegramAPIServer.from_base(
+                  api_server)) if api_server else None)
+    try:
+        await bot.set_webhook(url, secret_token=secret or None)
+        logger.info("Вебхук установлен: %s", url)
+    finally:
+        await bot.session.close()
+
+
+async def run(config=WebhookConfig):
+    sharded = ShardedWebhook(config.WORKERS, config.QUEUE_SIZE,
+                             config.SECRET)
+    app = web.Application()
+    app.router.add_post(config.PATH, sharded.handle)
+    runner = web.AppRunner(app)
+    try:
+        await runner.setup()
+        await web.TCPSite(runner, config.HOST, config.PORT).start()
+        logger.info("Вебхук слушает %s:%s%s, обработчиков: %s", config.HOST,
+                    config.PORT, config.PATH, config.WORKERS)
+        # Telegram начнет слать обновления сразу — только после запуска сервера
+        if config.URL:
+            await set_webhook(config.URL, config.SECRET)
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        await stop.wait()
+        logger.info("Остановка: перестаем принимать обновления")
+    finally:
+        await runner.cleanup()
+        await asyncio.to_thread(sharded.drain, config.DRAIN_TIMEOUT)
+
+
+if __name__ == "__main__":
+    log_setup.setup()
+    asyncio.run(run())